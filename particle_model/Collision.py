@@ -1,12 +1,10 @@
 """ Module contains routines to deal with calculating wear from
 collision information."""
 
-import copy
 import numpy
 
 from particle_model.Debug import logger
 from particle_model.ParticleBase import ParticleBase
-import vtk
 
 class BadCollisionException(Exception):
     """ Exception to deal with bad collisions"""
@@ -37,115 +35,378 @@ class CollisionException(Exception):
         Exception.__init__(self, particle, pos_i, cell_index, delta_t)
         self.args = particle, pos_i, cell_index, delta_t
         self.pos = pos_i
-        self.info = CollisionInfo(particle, pos_i, cell_index, angle, normal)
+        self.info = CollisionInfo(pos_i, particle.vel, particle.time,
+                                  cell_index, angle, normal)
         self.delta_t = delta_t
         self.vel = None
 
 class CollisionInfo(object):
-    """ Utility class for collision information """
-    def __init__(self, particle, pos, cell, angle, normal):
+    """ Utility class for the information on a single collision """
+
+    __slots__ = ('pos', 'vel', 'time', 'cell', 'angle', 'normal')
+
+    def __init__(self, pos, vel, time, cell, angle, normal):
         """ Initialise from particle collision information."""
-        self.particle = copy.copy(particle)
-        self.pos = copy.deepcopy(pos)
-        self.vel = copy.deepcopy(particle.vel)
-        self.time = copy.deepcopy(particle.time)
+        self.pos = numpy.array(pos, float)
+        self.vel = numpy.array(vel, float)
+        self.time = time
         self.cell = cell
-        self.angle = copy.deepcopy(angle)
-        self.normal = copy.deepcopy(normal)
+        self.angle = angle
+        self.normal = numpy.array(normal, float)
 
-    def get_wear(self):
+    def get_wear(self, material=None, surface_ids=None):
         """ Calculate wear induced by this collision"""
-        return mclaury_mass_coeff(self)
-
-    def write_data(self, poly_data):
-        """ Write data to polyfile """
-        del poly_data
-        wear = self.get_wear()
-        del wear
-        raise NotImplementedError
+        return mclaury_mass_coeff(self, material, surface_ids)
+
+class CollisionLog(object):
+    """ Append-only columnar store of wall collisions.
+
+    Each column is a numpy array, grown geometrically as collisions are
+    added. Columns are exposed as attributes (time, pos, vel, angle,
+    normal, cell, particle_id, species) with one row per collision, so the
+    log can be passed directly to the vectorised wear models."""
+
+    COLUMNS = (('time', (), float),
+               ('pos', (3,), float),
+               ('vel', (3,), float),
+               ('angle', (), float),
+               ('normal', (3,), float),
+               ('cell', (), int),
+               ('particle_id', (), int),
+               ('species', (), int))
+
+    def __init__(self, capacity=256):
+        self._size = 0
+        self._columns = {}
+        for name, shape, dtype in self.COLUMNS:
+            self._columns[name] = numpy.empty((capacity,)+shape, dtype)
+        self.species_names = []
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def __nonzero__(self):
+        return self.__bool__()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._columns[name][:self._size]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError(index)
+        return CollisionInfo(self.pos[index], self.vel[index],
+                             self.time[index], self.cell[index],
+                             self.angle[index], self.normal[index])
+
+    def __iter__(self):
+        for index in range(self._size):
+            yield self[index]
+
+    def get_species(self, name):
+        """ Get the integer code for a particle species name."""
+        if name not in self.species_names:
+            self.species_names.append(name)
+        return self.species_names.index(name)
+
+    def reserve(self, capacity):
+        """ Ensure space for at least capacity collisions."""
+        old_capacity = len(self._columns['time'])
+        if capacity <= old_capacity:
+            return
+        capacity = max(capacity, 2*old_capacity)
+        for name, shape, dtype in self.COLUMNS:
+            column = numpy.empty((capacity,)+shape, dtype)
+            column[:self._size] = self._columns[name][:self._size]
+            self._columns[name] = column
+
+    def append(self, info, particle_id=-1, species=None):
+        """ Add a collision to the log."""
+        self.reserve(self._size+1)
+        row = self._size
+        self._columns['time'][row] = info.time
+        self._columns['pos'][row] = info.pos
+        self._columns['vel'][row] = info.vel
+        self._columns['angle'][row] = info.angle
+        self._columns['normal'][row] = info.normal
+        self._columns['cell'][row] = info.cell
+        self._columns['particle_id'][row] = particle_id
+        self._columns['species'][row] = self.get_species(species)
+        self._size += 1
+
+    def extend(self, columns, species_names=None):
+        """ Add collisions held as columns, as from a checkpoint.
+
+        Args:
+            columns (dict): Array of values for each column.
+            species_names (list): Names for the species codes in columns."""
+        size = len(columns['time'])
+        self.reserve(self._size+size)
+        for name, _, _ in self.COLUMNS:
+            value = columns[name]
+            if name == 'species' and species_names:
+                value = numpy.array([self.get_species(_) for _ in species_names],
+                                    int)[value]
+            self._columns[name][self._size:self._size+size] = value
+        self._size += size
+
+    def for_particle(self, particle_id):
+        """ List the collisions of a single particle."""
+        return [self[index] for index
+                in numpy.flatnonzero(self.particle_id == particle_id)]
+
+    def get_wear(self, model=None, boundary=None, **kwargs):
+        """ Evaluate a wear model over every collision in the log.
+
+        Args:
+            model (callable): The wear model, by default mclaury_mass_coeff.
+            boundary (BoundaryData): If given, its wear material is used and
+            the surface ids of the cells hit are looked up from it."""
+        model = model or mclaury_mass_coeff
+        if boundary is not None:
+            kwargs.setdefault('material', boundary.wear.material)
+            kwargs.setdefault('surface_ids', get_surface_ids(boundary, self.cell))
+        return model(self, **kwargs)
+
+class WearAccumulator(object):
+    """ Per node sums of collision wear on a boundary mesh, binned by time window."""
+
+    def __init__(self, bin_width=None, max_bins=None, material=None):
+        """ Initialise the accumulator.
+
+        Args:
+            bin_width (float): Width of the time windows. If None all wear is
+            kept in a single bin.
+            max_bins (int): Maximum number of windows to keep. Oldest windows
+            are dropped first. If None all windows are kept.
+            material (dict or MaterialTable): Wear model material parameters
+            for collisions on this boundary."""
+        self.bin_width = bin_width
+        self.max_bins = max_bins
+        self.material = material
+        self.measure = numpy.zeros(0)
+        self.total = numpy.zeros(0)
+        self.bins = {}
+        self._ncells = None
+
+    def reset(self, boundary):
+        """ Cache the control volume measures of the nodes of boundary.
+
+        Stored wear is kept if the boundary mesh has not changed size."""
+
+        ids = boundary.cell_point_ids
+        npts = (ids >= 0).sum(axis=1)
+        valid = ids >= 0
+
+        measure = numpy.bincount(ids[valid],
+                                 numpy.repeat(boundary.areas/numpy.maximum(npts, 1),
+                                              npts),
+                                 minlength=len(boundary.points))
+
+        if len(measure) != len(self.measure) or len(ids) != self._ncells:
+            self.total = numpy.zeros(len(measure))
+            self.bins = {}
+
+        self.measure = measure
+        self._ncells = len(ids)
+
+    def get_state(self):
+        """ Get the accumulated wear as arrays, for checkpointing."""
+        keys = sorted(self.bins)
+        return {'total': self.total,
+                'keys': numpy.array(keys, int),
+                'bins': numpy.array([self.bins[_] for _ in keys]).reshape((len(keys),
+                                                                          len(self.total)))}
+
+    def set_state(self, state):
+        """ Restore wear saved by get_state."""
+        self.total = numpy.array(state['total'], float)
+        self.bins = dict((int(key), numpy.array(value, float))
+                         for key, value in zip(state['keys'], state['bins']))
+
+    def get_bin(self, time):
+        """ Index of the time window (k*bin_width, (k+1)*bin_width] containing time.
+
+        Windows are closed at the top, to match timesteps, which cover
+        (t-delta_t, t], so a collision at the end of a step lands in the
+        same window as the rest of that step."""
+        if not self.bin_width:
+            return 0
+        return int(numpy.ceil(time/self.bin_width-1.0e-8))-1
+
+    def add(self, node, wear, time):
+        """ Add the wear from a single collision at time to node."""
+
+        key = self.get_bin(time)
+        if key not in self.bins:
+            self.bins[key] = numpy.zeros(len(self.measure))
+            if self.max_bins and len(self.bins) > self.max_bins:
+                del self.bins[min(self.bins)]
+        self.bins[key][node] += wear
+        self.total[node] += wear
+
+    def window_sum(self, t_min, t_max):
+        """ Per node wear summed over (t_min, t_max].
+
+        Windows only partly inside the interval contribute in proportion
+        to their overlap with it, treating wear as spread evenly over each
+        window, so the interval need not line up with bin_width (e.g. after
+        the timestep changes)."""
+
+        if not self.bin_width:
+            return self.total.copy()
+
+        out = numpy.zeros(len(self.measure))
+        for key in range(self.get_bin(t_min), self.get_bin(t_max)+1):
+            if key not in self.bins:
+                continue
+            overlap = (min(t_max, (key+1)*self.bin_width)
+                       -max(t_min, key*self.bin_width))/self.bin_width
+            if overlap > 1.0-1.0e-8:
+                out += self.bins[key]
+            elif overlap > 1.0e-8:
+                out += overlap*self.bins[key]
+        return out
+
+    def rate(self, t_min, t_max, delta_t=None):
+        """ Wear rate per unit boundary measure over (t_min, t_max]."""
+
+        delta_t = delta_t or (t_max-t_min)
+        wear = self.window_sum(t_min, t_max)/delta_t
+        wear[self.measure > 0.0] /= self.measure[self.measure > 0.0]
+        return wear
 
 STANDARD_MATERIAL = {'n': 2, 'k': 1., 'H':1., 'F_s': 1., 'F_B':1.}
 
-def basic_mclaury_mass_coeff(collision, material=None):
-    """ Wear rate coefficient of collision from Mclaury correlation"""
+class MaterialTable(object):
+    """ Wear model material parameters keyed by boundary surface id.
+
+    Surface ids without an entry use the default material."""
+
+    def __init__(self, materials=None, default=None):
+        self.materials = dict(materials or {})
+        self.default = default or STANDARD_MATERIAL
+
+    def __getitem__(self, surface_id):
+        return self.materials.get(surface_id, self.default)
+
+    def __setitem__(self, surface_id, material):
+        self.materials[surface_id] = material
+
+    def lookup(self, surface_ids):
+        """ Get arrays of each material parameter for an array of surface ids."""
+        if surface_ids is None:
+            raise ValueError('A MaterialTable needs the surface ids of the collisions')
+        surface_ids = numpy.asarray(surface_ids)
+        out = {}
+        for key, value in self.default.items():
+            out[key] = numpy.full(surface_ids.shape, value, float)
+            for surface_id, material in self.materials.items():
+                out[key][surface_ids == surface_id] = material.get(key, value)
+        return out
+
+def get_surface_ids(boundary, cells):
+    """ Surface ids of boundary cells, or None if the boundary has none."""
+    if boundary is None or not boundary.has_surface_ids():
+        return None
+    #otherwise
+    return numpy.asarray(boundary.surface_ids)[cells]
+
+def get_material(material=None, surface_ids=None):
+    """ Resolve material parameters, either a dict or a MaterialTable.
+
+    Raises ValueError for a MaterialTable without surface_ids."""
+    if isinstance(material, MaterialTable):
+        return material.lookup(surface_ids)
+    #otherwise
+    return material or STANDARD_MATERIAL
+
+def mclaury_angle_response(theta):
+    """ Mclaury angle response function"""
+    theta = numpy.asarray(theta, float)
+    return numpy.where(numpy.tan(theta) > 1.0/3.0,
+                       numpy.cos(theta)**2/3.0,
+                       numpy.sin(2.0*theta)-3.0*numpy.sin(theta)**2)
+
+def basic_mclaury_wear(angle, speed, material=None):
+    """ Wear rate coefficients from the basic Mclaury correlation
+
+    Args:
+        angle (ndarray): Impact angles.
+        speed (ndarray): Impact speeds.
+        material (dict): Material parameters, scalars or arrays matching angle."""
     material = material or STANDARD_MATERIAL
 
-    n_exp = material['n']
-    coeff = material['k']
-    hardness = material['H']
-    sharpness_factor = material['F_s']
-    penetration_factor = material['F_B']
+    return (material['k']*material['H']*material['F_s']*material['F_B']
+            *numpy.asarray(speed, float)**material['n']
+            *mclaury_angle_response(angle))
 
-    def fun(theta):
-        """ Mclaury angle response function"""
-        if numpy.tan(theta) > 1.0/3.0:
-            return numpy.cos(theta)**2/3.0
-        #otherwise
-        return numpy.sin(2.0*theta)-3.0*numpy.sin(theta)**2
+def mclaury_wear(angle, speed, material=None, vel0=0.1, beta=1.0):
+    """ Wear rate coefficients from the Mclaury correlation
 
-    vel = numpy.sqrt(numpy.sum(collision.vel**2))
+    Args:
+        angle (ndarray): Impact angles.
+        speed (ndarray): Impact speeds.
+        material (dict): Material parameters, scalars or arrays matching angle."""
+    material = material or STANDARD_MATERIAL
 
-    return coeff*hardness*sharpness_factor*penetration_factor*vel**n_exp*fun(collision.angle)
+    angle = numpy.asarray(angle, float)
+    speed = numpy.asarray(speed, float)
 
+    return (material['k']*material['H']*material['F_s']*material['F_B']
+            *(speed**material['n']*mclaury_angle_response(angle)
+              +numpy.maximum(0.0, beta*(speed*numpy.sin(angle)-vel0)**2)))
 
-def mclaury_mass_coeff(collision, material=None):
-    """ Wear rate coefficient of collision from Mclaury correlation"""
-    material = material or STANDARD_MATERIAL
+def collision_speed(collision):
+    """ Impact speed of a collision, or array of speeds for a CollisionLog."""
+    return numpy.sqrt(numpy.sum(numpy.asarray(collision.vel)**2, axis=-1))
 
-    n_exp = material['n']
-    coeff = material['k']
-    hardness = material['H']
-    sharpness_factor = material['F_s']
-    penetration_factor = material['F_B']
+def basic_mclaury_mass_coeff(collision, material=None, surface_ids=None):
+    """ Wear rate coefficient of collision from Mclaury correlation
 
-    logger.info('collision angle: %s', collision.angle)
-    logger.info('collision normal: %s', collision.normal)
+    collision may be a single CollisionInfo or a CollisionLog, in which case
+    an array of coefficients is returned."""
+    return basic_mclaury_wear(collision.angle, collision_speed(collision),
+                              get_material(material, surface_ids))
 
-    def fun(theta):
-        """ Mclaury angle response function"""
-        if numpy.tan(theta) > 1.0/3.0:
-            return numpy.cos(theta)**2/3.0
-        #otherwise
-        return numpy.sin(2.0*theta)-3.0*numpy.sin(theta)**2
 
-    vel = numpy.sqrt(numpy.dot(collision.vel, collision.vel))
-    vel0 = 0.1
-    beta = 1.0
+def mclaury_mass_coeff(collision, material=None, surface_ids=None):
+    """ Wear rate coefficient of collision from Mclaury correlation
 
-    return (coeff*hardness*sharpness_factor*penetration_factor
-            *(vel**n_exp*fun(collision.angle)
-              +max(0.0, beta*(vel*numpy.sin(collision.angle)-vel0)**2)))
+    collision may be a single CollisionInfo or a CollisionLog, in which case
+    an array of coefficients is returned."""
+    return mclaury_wear(collision.angle, collision_speed(collision),
+                        get_material(material, surface_ids))
+
+def as_collision_log(col_list):
+    """ Convert an iterable of collisions to a CollisionLog."""
+    if isinstance(col_list, CollisionLog):
+        return col_list
+    log = CollisionLog()
+    for col in col_list:
+        log.append(col)
+    return log
 
 
 def collision_angle(particle, pos_0, pos_i, cell_index):
     """ Calulate the surface normal and angle of incidence of a collision event."""
 
-    cell = particle.system.boundary.bnd.GetCell(cell_index)
-
-    normal = numpy.zeros(3)
-
     veci = pos_i-pos_0
 
-    vec1 = (numpy.array(cell.GetPoints().GetPoint(1))
-            -numpy.array(cell.GetPoints().GetPoint(0)))
-
-    if cell.GetCellType() == vtk.VTK_TRIANGLE:
-        vec2 = (numpy.array(cell.GetPoints().GetPoint(2))
-                -numpy.array(cell.GetPoints().GetPoint(0)))
-    else:
-        vec2 = numpy.array((veci[1]*vec1[2]-veci[2]*vec1[1],
-                            veci[2]*vec1[0]-veci[0]*vec1[2],
-                            veci[0]*vec1[1]-veci[1]*vec1[0]))
-
-    normal[0] = vec1[1]*vec2[2]-vec1[2]*vec2[1]
-    normal[1] = vec1[2]*vec2[0]-vec1[0]*vec2[2]
-    normal[2] = vec1[0]*vec2[1]-vec1[1]*vec2[0]
+    normal = particle.system.boundary.get_normal(cell_index, veci)
 
-    if sum(normal**2) > 1.0e-32:
-        normal = normal / numpy.sqrt(sum(normal**2))
-    else:
+    if not normal.any():
         logger.error(normal)
-        logger.error("%s, %s", vec1, vec2)
+        logger.error("degenerate boundary cell %s", cell_index)
         raise BadCollisionException
 
     normal = normal * numpy.sign(numpy.dot(normal, -veci))
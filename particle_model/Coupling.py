@@ -1,165 +1,277 @@
 """ Module dealing with coupling in fluidity"""
 
+import hashlib
+from collections import OrderedDict
+
 import numpy
 import vtk
 
 import particle_model.vtkParticlesPython as vtp
 from particle_model import IO
+from particle_model import Parallel
+from particle_model import SolidInteractions
+from particle_model.Debug import logger
 
 ARGV = [0.0, 0.0, 0.0]
 ARGI = vtk.mutable(0)
 ARGR = vtk.mutable(0.0)
 
-def get_cv_fraction(bucket, data):
-    """Calculate the particle volume fraction using control volumes"""
+# control volume duals, keyed on the fingerprint of the linear mesh
+CONTROL_VOLUMES = OrderedDict()
+MAX_CONTROL_VOLUMES = 2
 
-    linear_data = IO.get_linear_block(data)
-    is2d = linear_data.GetCell(0).GetCellType() == vtk.VTK_TRIANGLE
+# the last particle control volume lookup
+CV_LOOKUP = {}
 
-    cvs = vtp.vtkShowCVs()
-    cvs.SetContinuity(-1)
-    if vtk.vtkVersion.GetVTKMajorVersion() < 6:
-        cvs.SetInput(linear_data)
-    else:
-        cvs.SetInputData(linear_data)
-    cvs.Update()
-    cv_data = cvs.GetOutput()
+def mesh_fingerprint(linear_data):
+    """ Return a key identifying the points and connectivity of a mesh.
 
-    locator = vtk.vtkCellLocator()
-    locator.SetDataSet(cv_data)
-    locator.BuildLocator()
+    Fluidity hands over a new block every step, so the key is built from
+    the mesh data rather than the object."""
 
-    output = numpy.zeros(linear_data.GetNumberOfPoints())
-    volume = numpy.zeros(linear_data.GetNumberOfPoints())
+    points = numpy.ascontiguousarray(IO.get_point_array(linear_data))
+    cells = numpy.ascontiguousarray(IO.get_cell_point_ids(linear_data))
 
-    for _ in range(linear_data.GetNumberOfCells()):
+    digest = hashlib.sha1(points.tobytes())
+    digest.update(cells.tobytes())
 
-        cell = linear_data.GetCell(_)
-        pnt_ids = cell.GetPointIds()
-        cv_mass = IO.get_measure(cell)/cell.GetNumberOfPoints()
+    return (points.shape[0], cells.shape[0], digest.hexdigest())
 
-        for dummy_1 in range(pnt_ids.GetNumberOfIds()):
-            volume[pnt_ids.GetId(dummy_1)] += cv_mass
+class ControlVolumes(object):
+    """ The control volume dual of a linear mesh, with its cell locator
+    and the volume of the control volume around each node."""
 
-    for par in bucket:
-        index = locator.FindCell(par.pos)
-        if index < 0:
-            continue
-        ele, l_id = divmod(index, linear_data.GetCell(0).GetNumberOfPoints())
+    def __init__(self, linear_data, key=None):
+        """ Build the dual mesh.
 
-        gid = linear_data.GetCell(ele).GetPointId(l_id)
+        Args:
+            linear_data (vtkUnstructuredGrid): The P1 mesh.
+            key (tuple): The mesh fingerprint, if already known."""
 
-        if is2d:
-            output[gid] += par.parameters.get_area()
+        self.key = key or mesh_fingerprint(linear_data)
+        self.is2d = linear_data.GetCell(0).GetCellType() == vtk.VTK_TRIANGLE
+        if self.is2d:
+            self.dim = 2
         else:
-            output[gid] += par.parameters.get_volume()
+            self.dim = 3
 
-    return output/volume
+        cvs = vtp.vtkShowCVs()
+        cvs.SetContinuity(-1)
+        if vtk.vtkVersion.GetVTKMajorVersion() < 6:
+            cvs.SetInput(linear_data)
+        else:
+            cvs.SetInputData(linear_data)
+        cvs.Update()
+        self.cv_data = cvs.GetOutput()
 
+        self.locator = vtk.vtkCellLocator()
+        self.locator.SetDataSet(self.cv_data)
+        self.locator.BuildLocator()
 
-def get_solid_velocity(bucket, data, volfrac):
-    """Calculate the particle volume fraction using control volumes"""
+        # control volume k lies in element k//npts, around its local node k%npts
+        cells = IO.get_cell_point_ids(linear_data)
+        self.node_ids = cells.ravel()
+
+        npts = cells.shape[1]
+        measure = SolidInteractions.cell_measures(linear_data)
+        self.volume = SolidInteractions.deposit(self.node_ids,
+                                                numpy.repeat(measure/npts, npts),
+                                                linear_data.GetNumberOfPoints())
+
+    def __len__(self):
+        return self.volume.size
+
+    def find_nodes(self, points):
+        """ Find the node whose control volume contains each point.
+
+        Returns the node index, or -1 where a point is not in the mesh."""
+
+        index = Parallel.find_cell(self.cv_data, points, self.locator)
+        return numpy.where(index < 0, -1, self.node_ids[index])
+
+    def nearest_nodes(self, points):
+        """ Find the node whose control volume is nearest to each point."""
+
+        nodes = self.find_nodes(points)
+        for k in numpy.flatnonzero(nodes < 0):
+            self.locator.FindClosestPoint(points[k], ARGV, ARGI, ARGI, ARGR)
+            nodes[k] = self.node_ids[int(ARGI)]
+        return nodes
+
+    def particle_measure(self, parameters):
+        """ The size of a particle in the measure of the mesh.
+
+        That is its area for a 2D mesh and its volume in 3D."""
+
+        if self.is2d:
+            return parameters.get_area()
+        #otherwise
+        return parameters.get_volume()
+
+def get_control_volumes(data):
+    """ Get the (cached) control volume dual of the linear block of data."""
 
     linear_data = IO.get_linear_block(data)
-    is2d = linear_data.GetCell(0).GetCellType() == vtk.VTK_TRIANGLE
-    if is2d:
-        dim = 2
-    else:
-        dim = 3
+    key = mesh_fingerprint(linear_data)
 
-    cvs = vtp.vtkShowCVs()
-    cvs.SetContinuity(-1)
-    if vtk.vtkVersion.GetVTKMajorVersion() < 6:
-        cvs.SetInput(linear_data)
-    else:
-        cvs.SetInputData(linear_data)
-    cvs.Update()
-    cv_data = cvs.GetOutput()
+    if key not in CONTROL_VOLUMES:
+        logger.debug('Building control volumes')
+        CONTROL_VOLUMES[key] = ControlVolumes(linear_data, key)
+        while len(CONTROL_VOLUMES) > MAX_CONTROL_VOLUMES:
+            CONTROL_VOLUMES.popitem(last=False)
 
-    locator = vtk.vtkCellLocator()
-    locator.SetDataSet(cv_data)
-    locator.BuildLocator()
+    return CONTROL_VOLUMES[key]
 
-    output = numpy.zeros((linear_data.GetNumberOfPoints(), dim))
-    volume = numpy.zeros(linear_data.GetNumberOfPoints())
+def locate_particles(bucket, cvs):
+    """ Find the node whose control volume contains each particle of a bucket.
 
+    The last lookup is kept, and reused while the bucket holds the same
+    particles at the same positions on the same mesh, so the coupling
+    routines called within one step share it.
 
-    for par in bucket.particles:
-        index = locator.FindCell(par.pos)
-        if index < 0:
-            continue
-        ele, l_id = divmod(index, linear_data.GetCell(0).GetNumberOfPoints())
+    Args:
+        bucket (ParticleBucket): The particles.
+        cvs (ControlVolumes): The control volume dual.
 
-        gid = linear_data.GetCell(ele).GetPointId(l_id)
+    Returns:
+        tuple: (particles, nodes), with node -1 for particles outside the mesh."""
 
+    particles = list(bucket)
+    pos = numpy.array([par.pos for par in particles], float).reshape((-1, 3))
 
-        if is2d:
-            volume[gid] += par.parameters.get_area()
-            output[gid, :] += par.parameters.get_area()*par.vel[:dim]
-        else:
-            volume[gid] += par.parameters.get_volume()
-            output[gid, :] += par.parameters.get_volume()*par.vel[:dim]
+    # the cached particles are referenced, so their ids cannot be reused
+    if (CV_LOOKUP.get('mesh') == cvs.key
+            and len(CV_LOOKUP['particles']) == len(particles)
+            and all(a is b for a, b in zip(CV_LOOKUP['particles'], particles))
+            and numpy.array_equal(CV_LOOKUP['pos'], pos)):
+        return particles, CV_LOOKUP['nodes']
 
-    for _ in range(linear_data.GetNumberOfPoints()):
-        if volume[_] > 0.0:
-            output[_, :] = output[_, :]/volume[_]
+    CV_LOOKUP['mesh'] = cvs.key
+    CV_LOOKUP['particles'] = particles
+    CV_LOOKUP['pos'] = pos
+    CV_LOOKUP['nodes'] = cvs.find_nodes(pos)
 
+    return particles, CV_LOOKUP['nodes']
 
-    return output
+def get_cv_properties(bucket, data):
+    """Calculate the particle volume fraction and solid velocity using control volumes.
 
-def barocentric_id(cell, pos):
-    """Return point id closest to spatial location."""
-    pnt0 = numpy.array(cell.GetPoints().GetPoint(0))
-    pnt1 = numpy.array(cell.GetPoints().GetPoint(1))
-    if cell.IsA('vtkLine'):
-        if sum((pos-pnt0)**2)/sum((pnt1-pnt0)**2) > 0.25:
-            return cell.GetPointIds().GetId(1)
-        #otherwise
-        return cell.GetPointIds().GetId(0)
-    else:
-        pnt2 = numpy.array(cell.GetPoints().GetPoint(2))
-        d11 = numpy.dot(pnt1-pnt0, pnt1-pnt0)
-        d12 = numpy.dot(pnt1-pnt0, pnt2-pnt0)
-        d22 = numpy.dot(pnt2-pnt0, pnt2-pnt0)
-        re1 = numpy.dot(pos-pnt0, pnt1-pnt0)
-        re2 = numpy.dot(pos-pnt0, pnt2-pnt0)
-        det = d11 * d22 - d12**2
-        res = numpy.empty(3, float)
-        res[0] = (d22*re1-d12*re2)/det
-        res[1] = (d11*re2-d12*re1)/det
-        res[2] = 1.0 - res[0] - res[1]
-
-        return cell.GetPointIds().GetId(res.argmax())
+    Both come from a single pass depositing the particles.
 
+    Args:
+        bucket (ParticleBucket): The particles.
+        data (vtkDataObject): Fluidity data containing the P1 mesh.
 
-def get_wear_rate_source(bucket, alpha, delta_t):
-    """Calculate wear_rate on the boundary surface"""
+    Returns:
+        tuple: (volume fraction, solid velocity) arrays at the mesh nodes."""
+
+    cvs = get_control_volumes(data)
+    particles, nodes = locate_particles(bucket, cvs)
 
-    linear_data = bucket.system.boundary.bnd
+    inside = nodes >= 0
+    particles = [par for par, _ in zip(particles, inside) if _]
+    nodes = nodes[inside]
 
-    wear = numpy.zeros((linear_data.GetNumberOfPoints()))
-    volume = numpy.zeros(linear_data.GetNumberOfPoints())
+    vel = numpy.array([par.vel for par in particles], float).reshape((-1, 3))
+    size = numpy.array([cvs.particle_measure(par.parameters) for par in particles],
+                       float)
 
-    for _ in range(linear_data.GetNumberOfCells()):
+    solid = SolidInteractions.deposit(nodes, size, len(cvs))
+    momentum = SolidInteractions.deposit(nodes, size[:, None]*vel[:, :cvs.dim],
+                                         len(cvs))
 
-        cell = linear_data.GetCell(_)
-        pnt_ids = cell.GetPointIds()
-        cv_mass = IO.get_measure(cell)/cell.GetNumberOfPoints()
+    return solid/cvs.volume, SolidInteractions.mean_value(momentum, solid, 0.0)
 
-        for dummy_1 in range(pnt_ids.GetNumberOfIds()):
-            volume[pnt_ids.GetId(dummy_1)] += cv_mass
+def get_momentum_source(bucket, data, delta_t):
+    """Calculate the drag reaction of the particles on the fluid using control volumes.
 
-    for col in bucket.collisions():
-        if col.time < bucket.time-bucket.delta_t:
-            continue
+    The drag impulse each particle has recorded since the last call is
+    deposited into the control volume the particle is now in, then cleared.
+    Impulses left on particles removed from the bucket (dead or stuck) go
+    to the control volume nearest their last position. Particle masses
+    are taken in the measure of the mesh, so per unit depth in 2D, as for
+    the volume fraction.
 
-        cell = linear_data.GetCell(col.cell)
+    Args:
+        bucket (ParticleBucket): The particles.
+        data (vtkDataObject): Fluidity data containing the P1 mesh.
+        delta_t (float): Time over which the impulses were gathered,
+        normally the fluid timestep.
 
-        gid = barocentric_id(cell, col.pos)
+    Returns:
+        ndarray: (nodes, dim) momentum source, as a force per unit volume."""
 
-        wear[gid] += col.get_wear()/delta_t
+    cvs = get_control_volumes(data)
+    particles, nodes = locate_particles(bucket, cvs)
+
+    inside = nodes >= 0
+    particles = [par for par, _ in zip(particles, inside) if _]
+    nodes = nodes[inside]
+
+    removed = [par for par in bucket.dead_particles+bucket.stuck_particles
+               if numpy.any(par.drag_impulse)]
+    if removed:
+        pos = numpy.array([par.pos for par in removed], float).reshape((-1, 3))
+        particles = particles+removed
+        nodes = numpy.concatenate((nodes, cvs.nearest_nodes(pos)))
+
+    impulse = numpy.array([par.drag_impulse for par in particles], float).reshape((-1, 3))
+    scale = numpy.array([mass_scale(cvs, par.parameters) for par in particles], float)
+    for par in particles:
+        par.drag_impulse = numpy.zeros(3)
+
+    force = SolidInteractions.deposit(nodes,
+                                      -(scale[:, None]*impulse[:, :cvs.dim])/delta_t,
+                                      len(cvs))
+
+    return force/cvs.volume[:, None]
+
+def mass_scale(cvs, parameters):
+    """ Ratio of the particle mass in the measure of the mesh to its true mass."""
+
+    mass = parameters.get_mass()
+    if not mass:
+        return 0.0
+    #otherwise
+    return parameters.rho*cvs.particle_measure(parameters)/mass
+
+def get_coupling_fields(bucket, data, delta_t):
+    """Calculate all the fields fed back to Fluidity for two-way coupling.
+
+    Args:
+        bucket (ParticleBucket): The particles.
+        data (vtkDataObject): Fluidity data containing the P1 mesh.
+        delta_t (float): The fluid timestep.
+
+    Returns:
+        dict: Nodal arrays for SolidVolumeFraction, SolidVelocity and
+        MomentumSource."""
+
+    fraction, velocity = get_cv_properties(bucket, data)
+
+    return {'SolidVolumeFraction': fraction,
+            'SolidVelocity': velocity,
+            'MomentumSource': get_momentum_source(bucket, data, delta_t)}
+
+def get_cv_fraction(bucket, data):
+    """Calculate the particle volume fraction using control volumes"""
+
+    return get_cv_properties(bucket, data)[0]
+
+
+def get_solid_velocity(bucket, data, volfrac):
+    """Calculate the solid velocity using control volumes"""
+
+    del volfrac
+
+    return get_cv_properties(bucket, data)[1]
+
+def get_wear_rate_source(bucket, alpha, delta_t):
+    """Calculate wear_rate on the boundary surface
 
-    wear /= volume
+    Uses the wear accumulated on the boundary during the last bucket timestep."""
 
+    del alpha
 
-    return wear
+    return bucket.system.boundary.wear.rate(bucket.time-bucket.delta_t,
+                                            bucket.time, delta_t)
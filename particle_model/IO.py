@@ -3,9 +3,17 @@ the file system. Mostly vtk."""
 
 import os
 import os.path
+import sys
+import re
 import glob
 import copy
 import inspect
+import threading
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from particle_model.Debug import profile, logger
 from particle_model import Collision
@@ -55,12 +63,113 @@ WRITER = {vtk.VTK_UNSTRUCTURED_GRID:(vtk.vtkXMLPUnstructuredGridWriter
                          if Parallel.is_parallel()
                          else vtk.vtkDelimitedTextWriter)}
 
+# number of processes gathering parallel polydata output, 0 for one piece per process
+AGGREGATE_WRITERS = 0
+
+def set_output_aggregation(writers):
+    """ Gather parallel polydata output onto a few writer processes.
+
+    Each writer writes a single piece for its share of the processes,
+    so a dump creates writers+1 files rather than one per process.
+
+    Args:
+        writers (int): Number of writer processes, or 0 to disable."""
+    global AGGREGATE_WRITERS
+    AGGREGATE_WRITERS = writers
+
+# settings for the VTK XML writers, None keeps the VTK default
+WRITER_OPTIONS = {'data_mode': None,
+                  'encode': None,
+                  'compressor': None,
+                  'block_size': None,
+                  'level': None}
+
+COMPRESSORS = {'zlib': 'vtkZLibDataCompressor',
+               'lz4': 'vtkLZ4DataCompressor',
+               'lzma': 'vtkLZMADataCompressor',
+               'none': None}
+
+def set_writer_options(**kwargs):
+    """ Set the default options for the VTK XML writers.
+
+    Args:
+        data_mode (str): 'appended', 'binary' or 'ascii'.
+        encode (bool): Base64 encode appended data.
+        compressor (str): 'zlib', 'lz4', 'lzma' or 'none'.
+        block_size (int): Size in bytes of the compressed blocks.
+        level (int): Compression level, from 1 (fastest) to 9 (smallest)."""
+
+    for key in kwargs:
+        if key not in WRITER_OPTIONS:
+            raise ValueError('Unknown writer option %s'%key)
+    WRITER_OPTIONS.update(kwargs)
+
+def configure_writer(writer, options=None):
+    """ Apply output options to a VTK XML writer.
+
+    Args:
+        writer (vtkXMLWriter): The writer to configure.
+        options (dict): Options overriding those from set_writer_options."""
+
+    if not writer.IsA('vtkXMLWriter'):
+        return writer
+
+    opts = dict(WRITER_OPTIONS)
+    opts.update(options or {})
+
+    if opts['data_mode']:
+        getattr(writer, 'SetDataModeTo%s'%opts['data_mode'].capitalize())()
+    if opts['encode'] is not None:
+        writer.SetEncodeAppendedData(bool(opts['encode']))
+
+    if opts['compressor']:
+        name = opts['compressor'].lower()
+        if name not in COMPRESSORS:
+            raise ValueError('Unknown compressor %s'%opts['compressor'])
+        compressor_type = getattr(vtk, COMPRESSORS[name] or '', None)
+        if compressor_type:
+            compressor = compressor_type()
+            if opts['level'] and hasattr(compressor, 'SetCompressionLevel'):
+                compressor.SetCompressionLevel(opts['level'])
+            writer.SetCompressor(compressor)
+        else:
+            if COMPRESSORS[name]:
+                logger.warning('%s compression not available, writing uncompressed data',
+                               name)
+            writer.SetCompressor(None)
+    if opts['block_size']:
+        writer.SetBlockSize(opts['block_size'])
+
+    return writer
+
+# whether the polydata level writers append to a .pvd collection by default
+PVD_INDEX = False
+
+def set_pvd_index(enabled):
+    """ Turn on or off appending polydata dumps to a .pvd collection.
+
+    This sets the default for writers not given pvd_index explicitly.
+
+    Args:
+        enabled (bool): Whether to maintain a .pvd file as dumps are written."""
+    global PVD_INDEX
+    PVD_INDEX = enabled
+
+def pvd_name(basename):
+    """ Get the .pvd collection file name for a file series basename."""
+    root, ext = os.path.splitext(basename)
+    if ext in ('.vtp', '.pvtp'):
+        return root+'.pvd'
+    #otherwise
+    return basename+'.pvd'
+
 class PolyData(object):
     """ Class storing a living vtkPolyData construction"""
 
-    def __init__(self, filename, fields=None):
+    def __init__(self, filename, fields=None, writer_options=None):
         """ Initialize the PolyData instance"""
 
+        self.writer_options = writer_options
 
         if filename.rsplit('.', 1)[-1] in ('pvtp', 'vtp'):
             self.filename = filename
@@ -115,6 +224,7 @@ class PolyData(object):
             self.poly_data.InsertNextCell(vtk.VTK_LINE, cell_id)
 
         writer = WRITER[vtk.VTK_POLY_DATA]()
+        configure_writer(writer, self.writer_options)
         writer.SetFileName(self.filename)
         if Parallel.is_parallel():
             writer.SetNumberOfPieces(Parallel.get_size())
@@ -145,16 +255,20 @@ class BoundaryData(object):
             filename (str): Name of the file containing the
             vtkUnstructuredGrid denoting the boundary of the domain."""
 
-        outlet_ids = outlet_ids or []
-        inlets = inlets or []
-        mapped_ids = mapped_ids or []
-
         self.reader = vtk.vtkXMLUnstructuredGridReader()
         self.bndl = vtk.vtkCellLocator()
         self.geom_filter = vtk.vtkGeometryFilter()
-        self.outlet_ids = outlet_ids
-        self.inlets = inlets
-        self.mapped_ids = mapped_ids
+        self.bnd = None
+        self.surface_ids = None
+        self.points = numpy.zeros((0, 3))
+        self.cell_point_ids = numpy.zeros((0, 0), int)
+        self.normals = numpy.zeros((0, 3))
+        self.areas = numpy.zeros(0)
+        self.corners = numpy.zeros(0, int)
+        self.wear = Collision.WearAccumulator()
+        self._outlet_ids = outlet_ids or []
+        self._inlets = inlets or []
+        self._mapped_ids = mapped_ids or []
         self.dist = dist
 
         open_ids = [] + self.outlet_ids
@@ -180,6 +294,39 @@ class BoundaryData(object):
             self.bndl.SetDataSet(self.geom_filter.GetOutput())
             self.bndl.BuildLocator()
 
+            self.update_face_data()
+
+    @property
+    def outlet_ids(self):
+        """Surface ids through which particles leave the domain."""
+        return self._outlet_ids
+
+    @outlet_ids.setter
+    def outlet_ids(self, outlet_ids):
+        self._outlet_ids = outlet_ids or []
+        self.update_id_lookups()
+
+    @property
+    def inlets(self):
+        """Inlet objects inserting particles through the boundary."""
+        return self._inlets
+
+    @inlets.setter
+    def inlets(self, inlets):
+        self._inlets = inlets or []
+        self.update_id_lookups()
+
+    @property
+    def mapped_ids(self):
+        """Surface ids (or dictionary of surface id to mapping function) of
+        periodic/mapped boundaries."""
+        return self._mapped_ids
+
+    @mapped_ids.setter
+    def mapped_ids(self, mapped_ids):
+        self._mapped_ids = mapped_ids or []
+        self.update_id_lookups()
+
     def update(self, boundary):
         """ Update the boundary data from a new object."""
 
@@ -191,8 +338,7 @@ class BoundaryData(object):
         self.bndl.SetDataSet(self.bnd)
         self.bndl.BuildLocator()
 
-        self.bndl.SetDataSet(self.bnd)
-        self.bndl.BuildLocator()
+        self.update_face_data()
 
     def update_boundary_file(self, infile, open_ids=None):
         """ Update the boundary data from the file."""
@@ -224,6 +370,82 @@ class BoundaryData(object):
         self.bndl.SetDataSet(self.geom_filter.GetOutput())
         self.bndl.BuildLocator()
 
+        self.update_face_data()
+
+    def update_face_data(self):
+        """Precompute the unit normals, measures and surface ids of the
+        boundary faces as numpy arrays.
+
+        Line normals are taken in the x-y plane, so are only meaningful for
+        two dimensional problems. The orientation of the normals is arbitrary."""
+
+        if self.bnd is None:
+            self.points = numpy.zeros((0, 3))
+            self.cell_point_ids = numpy.zeros((0, 0), int)
+            self.normals, self.areas = numpy.zeros((0, 3)), numpy.zeros(0)
+            self.corners = numpy.zeros(0, int)
+        else:
+            self.points = get_point_array(self.bnd)
+            self.cell_point_ids = get_cell_point_ids(self.bnd)
+            self.normals, self.areas = get_face_normals(self.bnd)
+            self.corners = get_corner_counts(self.bnd)
+
+        if self.bnd is not None and self.bnd.GetCellData().HasArray('SurfaceIds'):
+            self.surface_ids = numpy.asarray(
+                vtk_to_numpy(self.bnd.GetCellData().GetArray('SurfaceIds')),
+                dtype=int).ravel()
+        else:
+            self.surface_ids = None
+
+        self._face_owners = None
+        self._face_owner_key = None
+
+        self.update_id_lookups()
+        self.wear.reset(self)
+
+    def update_id_lookups(self):
+        """Rebuild the set and per face lookups of open boundary ids."""
+
+        self.outlet_set = set(self._outlet_ids)
+        self.mapped_set = set(self._mapped_ids)
+        self.inlet_set = set()
+        for inlet in self._inlets:
+            self.inlet_set.update(inlet.surface_ids)
+
+        if self.surface_ids is None:
+            nfaces = len(self.areas)
+            self.outlet_faces = numpy.zeros(nfaces, bool)
+            self.mapped_faces = numpy.zeros(nfaces, bool)
+            self.inlet_faces = numpy.zeros(nfaces, bool)
+        else:
+            self.outlet_faces = numpy.in1d(self.surface_ids,
+                                           list(self.outlet_set))
+            self.mapped_faces = numpy.in1d(self.surface_ids,
+                                           list(self.mapped_set))
+            self.inlet_faces = numpy.in1d(self.surface_ids,
+                                          list(self.inlet_set))
+
+    def get_face_centroids(self):
+        """Get the centroids of the boundary faces."""
+        ids = self.cell_point_ids
+        valid = ids >= 0
+        pts = self.points[numpy.where(valid, ids, 0)]*valid[:, :, None]
+        return pts.sum(axis=1)/numpy.maximum(valid.sum(axis=1), 1)[:, None]
+
+    def get_face_owners(self, block, locator=None):
+        """Get the rank owning the volume cell next to each boundary face.
+
+        Faces not adjacent to the local mesh in block get -1. The result is
+        cached until block is modified."""
+
+        key = (id(block), block.GetMTime(), len(self.areas))
+        if self._face_owner_key != key:
+            self._face_owners = Parallel.point_owner(block,
+                                                     self.get_face_centroids(),
+                                                     locator)
+            self._face_owner_key = key
+        return self._face_owners
+
     def rebuild_locator(self):
         """ Rebuild the locator information"""
         self.bndl.BuildLocator()
@@ -247,17 +469,190 @@ class BoundaryData(object):
         return False, None, None, -1, None
     def has_surface_ids(self):
         """Boolean test whether boundary stores surface ids."""
-        return self.bnd.GetCellData().HasArray('SurfaceIds')
+        return self.surface_ids is not None
 
     def get_surface_id(self, cell_index):
         """Get surface id of cell cell_index.
 
         Returns None if no surface id information available."""
 
-        if not self.has_surface_ids():
+        if self.surface_ids is None:
             return None
         #otherwise
-        return self.bnd.GetCellData().GetScalars('SurfaceIds').GetValue(cell_index)
+        return self.surface_ids[cell_index]
+
+    def get_normal(self, cell_index, direction=None):
+        """Get the (unoriented) unit normal of cell cell_index.
+
+        A line has no unique normal in 3D, so if direction is given the
+        normal of a line cell is taken in the plane of the line and
+        direction, e.g. that of an incoming particle."""
+
+        if direction is None or self.corners[cell_index] != 2:
+            return self.normals[cell_index]
+        #otherwise
+        ids = self.cell_point_ids[cell_index]
+        edge = self.points[ids[1]]-self.points[ids[0]]
+        normal = numpy.cross(edge, numpy.cross(direction, edge))
+        length = numpy.sqrt(numpy.dot(normal, normal))
+        if length > 1.0e-16*numpy.dot(edge, edge):
+            return normal/length
+        #otherwise
+        return self.normals[cell_index]
+
+    def nearest_node(self, cell_index, pos):
+        """Get the id of the point of cell cell_index nearest to pos."""
+
+        ids = self.cell_point_ids[cell_index]
+        ids = ids[ids >= 0]
+        pnt0 = self.points[ids[0]]
+        edge1 = self.points[ids[1]]-pnt0
+        rel = numpy.asarray(pos)-pnt0
+
+        if len(ids) == 2:
+            if numpy.dot(rel, rel)/numpy.dot(edge1, edge1) > 0.25:
+                return ids[1]
+            #otherwise
+            return ids[0]
+
+        edge2 = self.points[ids[2]]-pnt0
+        d11 = numpy.dot(edge1, edge1)
+        d12 = numpy.dot(edge1, edge2)
+        d22 = numpy.dot(edge2, edge2)
+        re1 = numpy.dot(rel, edge1)
+        re2 = numpy.dot(rel, edge2)
+        det = d11*d22-d12**2
+        res = numpy.empty(3, float)
+        res[1] = (d22*re1-d12*re2)/det
+        res[2] = (d11*re2-d12*re1)/det
+        res[0] = 1.0-res[1]-res[2]
+
+        return ids[res.argmax()]
+
+
+def get_point_array(grid):
+    """Return the point coordinates of a vtk dataset as an (npoints, 3) numpy array."""
+    if grid.GetNumberOfPoints() == 0:
+        return numpy.zeros((0, 3))
+    return numpy.asarray(vtk_to_numpy(grid.GetPoints().GetData()), dtype=float)
+
+def get_cell_point_ids(grid):
+    """Return the point ids of the cells of a vtkUnstructuredGrid or vtkPolyData.
+
+    The result is an (ncells, max_npts) integer array. Rows for cells with
+    fewer points than the largest cell are padded with -1."""
+
+    if grid.IsA('vtkPolyData'):
+        cell_arrays = (grid.GetVerts(), grid.GetLines(),
+                       grid.GetPolys(), grid.GetStrips())
+    else:
+        cell_arrays = (grid.GetCells(),)
+
+    npts = []
+    ids = []
+    for cells in cell_arrays:
+        if cells is None or cells.GetNumberOfCells() == 0:
+            continue
+        if hasattr(cells, 'GetConnectivityArray'):
+            npts.append(numpy.diff(vtk_to_numpy(cells.GetOffsetsArray())))
+            ids.append(vtk_to_numpy(cells.GetConnectivityArray()))
+        else:
+            legacy = vtk_to_numpy(cells.GetData())
+            starts = []
+            _ = 0
+            while _ < len(legacy):
+                starts.append(_)
+                _ += legacy[_]+1
+            keep = numpy.ones(len(legacy), bool)
+            keep[starts] = False
+            npts.append(legacy[starts])
+            ids.append(legacy[keep])
+
+    if not npts:
+        return numpy.zeros((0, 0), int)
+
+    npts = numpy.concatenate(npts).astype(int)
+    ids = numpy.concatenate(ids).astype(int)
+
+    out = -numpy.ones((len(npts), npts.max()), int)
+    rows = numpy.repeat(numpy.arange(len(npts)), npts)
+    cols = numpy.arange(len(ids)) - numpy.repeat(numpy.cumsum(npts)-npts, npts)
+    out[rows, cols] = ids
+
+    return out
+
+CORNER_COUNTS = {vtk.VTK_LINE: 2,
+                 vtk.VTK_POLY_LINE: 2,
+                 vtk.VTK_QUADRATIC_EDGE: 2,
+                 vtk.VTK_TRIANGLE: 3,
+                 vtk.VTK_QUADRATIC_TRIANGLE: 3,
+                 vtk.VTK_QUAD: 4,
+                 vtk.VTK_QUADRATIC_QUAD: 4,
+                 vtk.VTK_BIQUADRATIC_QUAD: 4}
+
+def get_corner_counts(grid):
+    """Get the number of leading corner points of each cell of a boundary
+    grid, which fix its linear shape.
+
+    Polygons use all their points. Other cell types are given zero."""
+
+    out = numpy.zeros(grid.GetNumberOfCells(), int)
+    for k in range(grid.GetNumberOfCells()):
+        cell_type = grid.GetCellType(k)
+        if cell_type == vtk.VTK_POLYGON:
+            out[k] = grid.GetCell(k).GetNumberOfPoints()
+        else:
+            out[k] = CORNER_COUNTS.get(cell_type, 0)
+    return out
+
+def get_face_normals(grid):
+    """Calculate unit normals and measures of the line, triangle, quad and
+    polygon cells of a boundary grid, or of their linear counterparts.
+
+    Line normals are taken in the x-y plane. Quad and polygon normals come
+    from Newell's method, so also suit slightly warped faces.
+
+    Returns (normals, areas) as numpy arrays. Cells of other types are given a
+    zero normal and measure."""
+
+    pts = get_point_array(grid)
+    ids = get_cell_point_ids(grid)
+
+    normals = numpy.zeros((len(ids), 3))
+    areas = numpy.zeros(len(ids))
+
+    if ids.size == 0:
+        return normals, areas
+
+    npts = get_corner_counts(grid)
+
+    lines = npts == 2
+    if lines.any():
+        edge = pts[ids[lines, 1]]-pts[ids[lines, 0]]
+        areas[lines] = numpy.sqrt(numpy.sum(edge**2, axis=1))
+        normals[lines, 0] = edge[:, 1]
+        normals[lines, 1] = -edge[:, 0]
+
+    triangles = npts == 3
+    if triangles.any():
+        cross = numpy.cross(pts[ids[triangles, 1]]-pts[ids[triangles, 0]],
+                            pts[ids[triangles, 2]]-pts[ids[triangles, 0]])
+        normals[triangles] = cross
+        areas[triangles] = 0.5*numpy.sqrt(numpy.sum(cross**2, axis=1))
+
+    for size in numpy.unique(npts[npts > 3]):
+        polygons = npts == size
+        corners = pts[ids[polygons, :size]]
+        cross = 0.5*numpy.sum(numpy.cross(corners,
+                                          numpy.roll(corners, -1, axis=1)), axis=1)
+        normals[polygons] = cross
+        areas[polygons] = numpy.sqrt(numpy.sum(cross**2, axis=1))
+
+    length = numpy.sqrt(numpy.sum(normals**2, axis=1))
+    nonzero = length > 1.0e-16
+    normals[nonzero] /= length[nonzero, None]
+
+    return normals, areas
 
 
 def clean_unstructured_grid(ugrid):
@@ -386,98 +781,155 @@ def write_bucket_to_points(bucket):
 
     return pnts
 
-def write_level_to_polydata(bucket, level, basename=None, checkpoint=False, dump_no=None, do_average=False, field_data=None,**kwargs):
-    """Output a time level of a particle bucket to a vtkPolyData (.vtp) files.
+class BucketSnapshot(object):
+    """ Copy of the particle data of a bucket at one time level, for output.
 
-    Each file contains one time level of the data, and are numbered sequentially.
-    Within each file, each particle is written to seperate pixel.
+    The data is copied into numpy arrays, so the bucket can continue to be
+    updated while the snapshot is written."""
 
-    Args:
-         bucket   (ParticleBucket):
-        level    (int):
-        basename (str): String used in the construction of the file series.
-        The formula is of the form basename_0.vtp, basename_1.vtp,..."""
+    def __init__(self, bucket, field_data=None):
+        """ Take the snapshot.
 
-    del kwargs
-    field_data = field_data or {}
+        Args:
+            bucket (ParticleBucket): The bucket to copy.
+            field_data (dict): Number of components of each particle field to copy."""
+
+        field_data = field_data or {}
+        npart = len(bucket)
+
+        self.time = bucket.time
+        self.pos = bucket.pos_as_array()
+        self.vel = bucket.vel_as_array()
+        self.ids = numpy.array([hash(par) for par in bucket], float)
+        exited = numpy.array([hasattr(par, "exited") for par in bucket], bool)
+        self.live = numpy.logical_and(bucket.system.in_system(self.pos, npart,
+                                                              bucket.time),
+                                      ~exited).astype(float)
+        self.fields = {}
+        for name, num_comps in field_data.items():
+            self.fields[name] = numpy.array([par.fields[name] for par in bucket],
+                                            float).reshape((npart, num_comps))
+
+    def __len__(self):
+        return self.pos.shape[0]
+
+def make_double_array(name, data, num_comps=1):
+    """ Make a named vtkDoubleArray from numpy data."""
+    data = numpy.asarray(data, float).reshape((-1, num_comps))
+    _ = numpy_support.numpy_to_vtk(data, deep=1, array_type=vtk.VTK_DOUBLE)
+    _.SetName(name)
+    return _
+
+def snapshot_to_polydata(snapshot):
+    """ Convert a BucketSnapshot to a vtkPolyData, with a vertex per particle."""
 
     poly_data = vtk.vtkPolyData()
     pnts = vtk.vtkPoints()
-    pnts.Allocate(len(bucket))
+    pnts.SetData(numpy_support.numpy_to_vtk(snapshot.pos, deep=1))
     poly_data.SetPoints(pnts)
-    poly_data.Allocate(len(bucket))
+    poly_data.SetVerts(vertex_cell_array(len(snapshot)))
 
     outtime = vtk.vtkDoubleArray()
     outtime.SetName('Time')
-    outtime.Allocate(1)
-
-    particle_id = vtk.vtkDoubleArray()
-    particle_id.SetName('ParticleID')
-    particle_id.Allocate(len(bucket))
+    outtime.InsertNextValue(snapshot.time)
 
-    live = vtk.vtkDoubleArray()
-    live.SetName('Live')
-    live.Allocate(len(bucket))
-
-    plive = bucket.system.in_system(bucket.pos(), len(bucket), bucket.time)
-
-    for _, par in zip(plive, bucket):
-        particle_id.InsertNextValue(hash(par))
-        if _ and not hasattr(par, "exited"):
-            live.InsertNextValue(1.0)
-        else:
-            live.InsertNextValue(0.0)
+    poly_data.GetFieldData().AddArray(outtime)
+    poly_data.GetPointData().AddArray(make_double_array('Particle Velocity',
+                                                        snapshot.vel, 3))
+    poly_data.GetPointData().AddArray(make_double_array('ParticleID', snapshot.ids))
+    poly_data.GetCellData().AddArray(make_double_array('Live', snapshot.live))
 
+    for name, data in snapshot.fields.items():
+        poly_data.GetPointData().AddArray(make_double_array(name, data,
+                                                            data.shape[1]))
 
-    velocity = vtk.vtkDoubleArray()
-    velocity.SetNumberOfComponents(3)
-    velocity.Allocate(len(bucket))
-    velocity.SetName('Particle Velocity')
+    return poly_data
 
-    for positions, vel in zip(bucket.pos(), bucket.vel()):
-        pixel = vtk.vtkPixel()
-        pixel.GetPointIds().InsertId(0,
-                                     poly_data.GetPoints().InsertNextPoint(positions[0],
-                                                                           positions[1],
-                                                                           positions[2]))
-        velocity.InsertNextTuple3(vel[0], vel[1], vel[2])
-        poly_data.InsertNextCell(pixel.GetCellType(), pixel.GetPointIds())
+def write_polydata_level(poly_data, level, basename, checkpoint=False, dump_no=None,
+                         writer_options=None, pvd_index=None):
+    """ Write a vtkPolyData as one time level of a file series.
 
-    outtime.InsertNextValue(bucket.time)
+    If pvd_index (by default the set_pvd_index setting) the file is also
+    added to the .pvd collection named by pvd_name."""
 
-    poly_data.GetFieldData().AddArray(outtime)
-    poly_data.GetPointData().AddArray(velocity)
-    poly_data.GetPointData().AddArray(particle_id)
-    poly_data.GetCellData().AddArray(live)
-
-    for name, num_comps in field_data.items():
-        _ = vtk.vtkDoubleArray()
-        _.SetName(name)
-        _.SetNumberOfComponents(num_comps)
-        _.Allocate(len(bucket))
-        for particle in bucket:
-            _.InsertNextValue(particle.fields[name])
-        poly_data.GetPointData().AddArray(_)
-        del _
-
-    if do_average:
-        gsp = calculate_averaged_properties_cpp(poly_data)
+    if pvd_index is None:
+        pvd_index = PVD_INDEX
 
     if Parallel.is_parallel():
         file_ext = 'pvtp'
     else:
         file_ext = 'vtp'
 
-
     if checkpoint: ##if checkpoint, write both level file as well as checkpoint file
-		write_to_file(poly_data, "%s_%d_checkpoint.%s"%(basename, dump_no, file_ext))
-		write_to_file(poly_data, "%s_%d.%s"%(basename, level, file_ext))
-    else:
-    	write_to_file(poly_data, "%s_%d.%s"%(basename, level, file_ext))         
+        write_to_file(poly_data, "%s_%d_checkpoint.%s"%(basename, dump_no, file_ext),
+                      writer_options)
+    write_to_file(poly_data, "%s_%d.%s"%(basename, level, file_ext), writer_options)
+
+    if pvd_index and Parallel.get_rank() == 0:
+        append_to_pvd(pvd_name(basename),
+                      poly_data.GetFieldData().GetArray('Time').GetValue(0),
+                      "%s_%d.%s"%(basename, level, file_ext), new=(level == 0))
+
+def write_snapshot_to_polydata(snapshot, level, basename, checkpoint=False, dump_no=None,
+                               writer_options=None, pvd_index=None):
+    """ Output a BucketSnapshot to a vtkPolyData (.vtp) file."""
+    write_polydata_level(snapshot_to_polydata(snapshot), level, basename,
+                         checkpoint, dump_no, writer_options, pvd_index)
+
+def write_level_to_polydata(bucket, level, basename=None, checkpoint=False, dump_no=None, do_average=False, field_data=None,
+                            writer_options=None, pvd_index=None, **kwargs):
+    """Output a time level of a particle bucket to a vtkPolyData (.vtp) files.
+
+    Each file contains one time level of the data, and are numbered sequentially.
+    Within each file, each particle is written to seperate vertex.
+
+    Args:
+         bucket   (ParticleBucket):
+        level    (int):
+        basename (str): String used in the construction of the file series.
+        The formula is of the form basename_0.vtp, basename_1.vtp,...
+        checkpoint (bool): Also write basename_<dump_no>_checkpoint files,
+        including a binary checkpoint of the full bucket state.
+        writer_options (dict): Options for configure_writer.
+        pvd_index (bool): Whether to add the file to a .pvd collection. By
+        default the set_pvd_index setting is used."""
+
+    del kwargs
+
+    if checkpoint and hasattr(bucket, 'write_checkpoint'):
+        bucket.write_checkpoint("%s_%d_checkpoint.npz"%(basename, dump_no))
+
+    poly_data = snapshot_to_polydata(BucketSnapshot(bucket, field_data))
+
+    if do_average:
+        gsp = calculate_averaged_properties_cpp(poly_data)
+
+    write_polydata_level(poly_data, level, basename, checkpoint, dump_no,
+                         writer_options, pvd_index)
 
     if do_average:
         return gsp
 
+def snapshot_to_table(snapshot):
+    """ Convert a BucketSnapshot to a vtkTable, with a row per particle."""
+
+    table = vtk.vtkTable()
+
+    for k, name in enumerate(('X', 'Y', 'Z')):
+        table.AddColumn(make_double_array(name, snapshot.pos[:, k]))
+    table.AddColumn(make_double_array('Particle Velocity', snapshot.vel, 3))
+    table.AddColumn(make_double_array('ParticleID', snapshot.ids))
+    table.AddColumn(make_double_array('Live', snapshot.live))
+
+    for name, data in snapshot.fields.items():
+        table.AddColumn(make_double_array(name, data, data.shape[1]))
+
+    return table
+
+def write_snapshot_to_csv(snapshot, level, basename):
+    """ Output a BucketSnapshot to a text (.csv) file."""
+    write_to_file(snapshot_to_table(snapshot), "%s_%d.%s"%(basename, level, 'csv'))
+
 def write_level_to_csv(bucket, level, basename=None, do_average=False,
                             field_data=None, **kwargs):
 
@@ -492,71 +944,114 @@ def write_level_to_csv(bucket, level, basename=None, do_average=False,
         basename (str): String used in the construction of the file series.
         The formula is of the form basename_0.vtp, basename_1.vtp,..."""
 
-    del kwargs
-    field_data = field_data or {}
+    del kwargs, do_average
+
+    write_snapshot_to_csv(BucketSnapshot(bucket, field_data), level, basename)
+
+class AsyncWriter(object):
+    """ Write particle output from a background thread.
+
+    Bucket data is snapshotted on the calling thread and queued for writing.
+    The queue is bounded, so a caller producing output faster than it can
+    be written blocks until there is room.
+
+    In parallel, output is written synchronously. The write path makes
+    collective calls on the world communicator, which must not overlap
+    with the collectives of the main thread.
+
+    Options for configure_writer may be given in writer_options, and
+    whether to keep a .pvd collection in pvd_index."""
+
+    def __init__(self, max_queue=2, writer_options=None, pvd_index=None):
+        self.writer_options = writer_options
+        self.pvd_index = pvd_index
+        self.error = None
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+        if not Parallel.is_parallel():
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        """ Writer thread main loop."""
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None:
+                    task[0](*task[1:])
+            except Exception as err:
+                self.error = err
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        """ Raise any error from the writer thread."""
+        if self.error is not None:
+            err, self.error = self.error, None
+            raise err
+
+    def submit(self, func, *args):
+        """ Queue a call to func(*args) on the writer thread."""
+        self._check()
+        if self.thread is None:
+            func(*args)
+        else:
+            self.queue.put((func,)+args)
 
-    table = vtk.vtkTable()
+    def write_level_to_polydata(self, bucket, level, basename=None,
+                                checkpoint=False, dump_no=None,
+                                do_average=False, field_data=None, **kwargs):
+        """ Queue a time level of a bucket for output as vtkPolyData.
 
-    outtime = vtk.vtkDoubleArray()
-    outtime.SetName('Time')
-    outtime.Allocate(1)
+        See IO.write_level_to_polydata. Any averaging is done immediately."""
 
-    particle_id = vtk.vtkDoubleArray()
-    particle_id.SetName('ParticleID')
-    particle_id.Allocate(len(bucket))
+        del kwargs
 
-    live = vtk.vtkDoubleArray()
-    live.SetName('Live')
-    live.Allocate(len(bucket))
+        if checkpoint and hasattr(bucket, 'write_checkpoint'):
+            bucket.write_checkpoint("%s_%d_checkpoint.npz"%(basename, dump_no))
 
-    plive = bucket.system.in_system(bucket.pos(), len(bucket), bucket.time)
+        snapshot = BucketSnapshot(bucket, field_data)
 
-    for _, par in zip(plive, bucket):
-        particle_id.InsertNextValue(hash(par))
-        if _ and not hasattr(par, "exited"):
-            live.InsertNextValue(1.0)
-        else:
-            live.InsertNextValue(0.0)
-
-    def make_array(name):
-        _ = vtk.vtkDoubleArray()
-        _.SetNumberOfComponents(1)
-        _.Allocate(len(bucket))
-        _.SetName(name)
-        return _
-
-    pos_x = make_array('X')
-    pos_y = make_array('Y')
-    pos_z = make_array('Z')
-
-    velocity = vtk.vtkDoubleArray()
-    velocity.SetNumberOfComponents(3)
-    velocity.Allocate(len(bucket))
-    velocity.SetName('Particle Velocity')
-
-    for positions, vel in zip(bucket.pos(), bucket.vel()):
-        pos_x.InsertNextTuple([positions[0]])
-        pos_y.InsertNextTuple([positions[1]])
-        pos_z.InsertNextTuple([positions[2]])
-        velocity.InsertNextTuple3(vel[0], vel[1], vel[2])
-
-    table.AddColumn(pos_x)
-    table.AddColumn(pos_y)
-    table.AddColumn(pos_z)
-    table.AddColumn(velocity)
-    table.AddColumn(particle_id)
-    table.AddColumn(live)
-
-    for name, num_comps in field_data.items():
-        _ = vtk.vtkDoubleArray()
-        _.SetName(name)
-        _.SetNumberOfComponents(num_comps)
-        _.Allocate(len(bucket))
-        for particle in bucket:
-            _.InsertNextValue(particle.fields[name])
-        table.AddColumn(_)
+        if do_average:
+            poly_data = snapshot_to_polydata(snapshot)
+            gsp = calculate_averaged_properties_cpp(poly_data)
+            self.submit(write_polydata_level, poly_data, level, basename,
+                        checkpoint, dump_no, self.writer_options, self.pvd_index)
+            return gsp
+        #otherwise
+        self.submit(write_snapshot_to_polydata, snapshot, level, basename,
+                    checkpoint, dump_no, self.writer_options, self.pvd_index)
+        return None
 
-    write_to_file(table, "%s_%d.%s"%(basename, level, 'csv'))
+    def write_level_to_csv(self, bucket, level, basename=None,
+                           field_data=None, **kwargs):
+        """ Queue a time level of a bucket for output as .csv."""
+        del kwargs
+        self.submit(write_snapshot_to_csv, BucketSnapshot(bucket, field_data),
+                    level, basename)
+
+    def flush(self):
+        """ Wait for all queued output to be written."""
+        if self.thread is not None:
+            self.queue.join()
+        self._check()
+
+    def close(self):
+        """ Write all queued output and stop the writer thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self._check()
 
 def write_level_to_ugrid(bucket, level, basename, model, **kwargs):
     """ Output a time level of a bucket to a vtkXMLUnstructuredGrid (.vtu) file.
@@ -580,82 +1075,39 @@ def write_level_to_ugrid(bucket, level, basename, model, **kwargs):
 #        for k in range(cell.GetNumberOfPoints()):
 #            mass[dummy_id(k)] += measure/cell.GetNumberOfPoints()
 
-    locator = vtk.vtkPointLocator()
-    locator.SetDataSet(ugrid)
-    locator.BuildLocator()
-
-    volume = numpy.zeros(ugrid.GetNumberOfPoints())
-    temperature = numpy.zeros(ugrid.GetNumberOfPoints())
-    solid_pressure = numpy.zeros(ugrid.GetNumberOfPoints())
-    velocity = numpy.zeros((ugrid.GetNumberOfPoints(), 3))
+    npts = ugrid.GetNumberOfPoints()
 
     length = 0.1
     multiplier = 1.e3
+    norm = 0.5*length**2*(1.0-numpy.exp(-1.0**2))
 
-    for dummy_particle in bucket:
-        point_list = vtk.vtkIdList()
-        locator.FindPointsWithinRadius(length, dummy_particle.pos, point_list)
-
-        for _ in range(point_list.GetNumberOfIds()):
-            point_index = point_list.GetId(_)
-
-            rad2 = numpy.sum((numpy.array(ugrid.GetPoints().GetPoint(point_index))
-                              -dummy_particle.pos)**2)
-            rad2 /= length
-
-            volume[point_index] += (1.0/6.0*numpy.pi*dummy_particle.parameters.diameter**3
-                                    *numpy.exp(-rad2**2)*multiplier)
-            velocity[point_index, :] += (dummy_particle.vel*1.0/6.0*numpy.pi
-                                         *dummy_particle.parameters.diameter**3
-                                         *numpy.exp(-rad2**2)*multiplier)
-
-    volume /= 0.5*length**2*(1.0-numpy.exp(-1.0**2))
-    velocity /= 0.5*length**2*(1.0-numpy.exp(-1.0**2))
-
-    for dummy_particle in bucket:
-        point_list = vtk.vtkIdList()
-        locator.FindPointsWithinRadius(length, dummy_particle.pos, point_list)
-
-        rad2 = numpy.sum((numpy.array(ugrid.GetPoints().GetPoint(point_index))
-                          -dummy_particle.pos)**2)
-        rad2 /= length
+    pos, vel, _, diameter = get_particle_data(bucket)
+    beta = 1.0/6.0*numpy.pi*diameter**3*multiplier
 
-        for _ in range(point_list.GetNumberOfIds()):
-            point_index = point_list.GetId(_)
-            c = numpy.sum((dummy_particle.vel-velocity[point_index, :])**2)
+    node, part, rad2 = neighbour_pairs(get_point_array(ugrid), pos, length)
+    rad2 /= length
+    gamma = beta[part]*numpy.exp(-rad2**2)
 
-            temperature[point_index] += (c*1.0/6.0*numpy.pi
-                                         *dummy_particle.parameters.diameter**3
-                                         *numpy.exp(-rad2**2)*multiplier)
+    volume = deposit(node, gamma, npts)/norm
+    velocity = mean_value(deposit(node, gamma[:, None]*vel[part], npts)/norm,
+                          volume, 1.0e-20)
+    temperature = deposit(node, gamma*numpy.sum((vel[part]-velocity[node])**2, axis=1),
+                          npts)
 
-    for _ in range(ugrid.GetNumberOfPoints()):
+    solid_pressure = (bucket.parameters.rho*volume
+                      *radial_distribution_function(volume)*temperature)
 
-        solid_pressure[_] = (dummy_particle.parameters.rho*volume[_]
-                             *radial_distribution_function(volume[_])*temperature[_])
-
-    data = [vtk.vtkDoubleArray()]
-    data[0].SetName('SolidVolumeFraction')
-    data.append(vtk.vtkDoubleArray())
-    data[1].SetName('SolidVolumeVelocity')
-    data[1].SetNumberOfComponents(3)
-    data.append(vtk.vtkDoubleArray())
-    data[2].SetName('GranularTemperature')
-    data.append(vtk.vtkDoubleArray())
-    data[3].SetName('SolidPressure')
-
-    for _ in range(ugrid.GetNumberOfPoints()):
-        data[0].InsertNextValue(volume[_])
-        if volume[_] > 1.0e-20:
-            data[1].InsertNextTuple3(*(velocity[_]/volume[_]))
-        else:
-            data[1].InsertNextTuple3(*(0*velocity[_]))
-        data[2].InsertNextValue(temperature[_])
-        data[3].InsertNextValue(solid_pressure[_])
-        ugrid.GetPointData().GetScalars('Time').SetValue(_, bucket.time)
-
-    for _ in data:
+    for _ in (make_double_array('SolidVolumeFraction', volume),
+              make_double_array('SolidVolumeVelocity', velocity, 3),
+              make_double_array('GranularTemperature', temperature),
+              make_double_array('SolidPressure', solid_pressure)):
         ugrid.GetPointData().AddArray(_)
 
+    time = ugrid.GetPointData().GetScalars('Time')
+    if time:
+        vtk_to_numpy(time)[:] = bucket.time
+        time.Modified()
+
     write_to_file(ugrid, "%s_out_%d.vtu"%(basename, level))
 
 def update_collision_polydata(bucket, base_name, **kwargs):
@@ -666,46 +1118,85 @@ def update_collision_polydata(bucket, base_name, **kwargs):
     else:
         fext = 'vtp'
 
-    collision_list_to_polydata(bucket.collisions(), base_name+'_collisions.'+fext)
+    collision_list_to_polydata(bucket.collisions(), base_name+'_collisions.'+fext,
+                               boundary=bucket.system.boundary)
+
+def vertex_cell_array(npts):
+    """ Build a vtkCellArray with one VTK_VERTEX cell per point."""
+    id_type = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+    verts = vtk.vtkCellArray()
+    if hasattr(verts, 'GetOffsetsArray'):
+        verts.SetData(numpy_support.numpy_to_vtkIdTypeArray(numpy.arange(npts+1, dtype=id_type),
+                                                            deep=1),
+                      numpy_support.numpy_to_vtkIdTypeArray(numpy.arange(npts, dtype=id_type),
+                                                            deep=1))
+        return verts
+    #otherwise
+    cells = numpy.empty((npts, 2), id_type)
+    cells[:, 0] = 1
+    cells[:, 1] = numpy.arange(npts)
+    verts.SetCells(npts, numpy_support.numpy_to_vtkIdTypeArray(cells.ravel(),
+                                                                deep=1))
+    return verts
+
+def line_cell_array(counts):
+    """ Build a vtkCellArray of VTK_POLY_LINE cells over consecutive points.
+
+    Args:
+        counts (ndarray): Number of points in each cell."""
+    id_type = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+    counts = numpy.asarray(counts, id_type)
+    offsets = numpy.zeros(counts.size+1, id_type)
+    numpy.cumsum(counts, out=offsets[1:])
+    lines = vtk.vtkCellArray()
+    if hasattr(lines, 'GetOffsetsArray'):
+        lines.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=1),
+                      numpy_support.numpy_to_vtkIdTypeArray(numpy.arange(offsets[-1],
+                                                                         dtype=id_type),
+                                                            deep=1))
+        return lines
+    #otherwise
+    cells = numpy.empty(offsets[-1]+counts.size, id_type)
+    starts = offsets[:-1]+numpy.arange(counts.size)
+    cells[starts] = counts
+    mask = numpy.ones(cells.size, bool)
+    mask[starts] = False
+    cells[mask] = numpy.arange(offsets[-1])
+    lines.SetCells(counts.size, numpy_support.numpy_to_vtkIdTypeArray(cells, deep=1))
+    return lines
 
 def collision_list_to_polydata(col_list, outfile,
-                               model=Collision.mclaury_mass_coeff, **kwargs):
+                               model=Collision.mclaury_mass_coeff, boundary=None,
+                               **kwargs):
     """Convert collision data to a single vtkPolyData (.vtp) files.
 
-    Each particle is written to seperate cell.
+    Each collision is written to a seperate vertex cell. The wear model
+    is evaluated once over the whole collection.
 
     Args:
+        col_list (CollisionLog): Collisions, or any iterable of CollisionInfo.
         outfile (str):  Filename of the output PolyDataFile. The extension .vtp
-        is NOT added automatically."""
+        is NOT added automatically.
+        boundary (BoundaryData): Boundary hit, giving the wear material and
+        the surface ids for a MaterialTable."""
+
+    log = Collision.as_collision_log(col_list)
+    ncol = len(log)
 
     poly_data = vtk.vtkPolyData()
     pnts = vtk.vtkPoints()
-    pnts.Allocate(0)
+    pnts.SetData(numpy_support.numpy_to_vtk(log.pos.copy(), deep=1))
     poly_data.SetPoints(pnts)
-    poly_data.Allocate(len(col_list))
-
-    time = vtk.vtkDoubleArray()
-    time.SetName('Time')
-    wear = vtk.vtkDoubleArray()
-    wear.SetName('Wear')
-    normal = vtk.vtkDoubleArray()
-    normal.SetNumberOfComponents(3)
-    normal.SetName('Normal')
 
-    for col in col_list:
-        pixel = vtk.vtkPixel()
-        pixel.GetPointIds().InsertId(0,
-                                     poly_data.GetPoints().InsertNextPoint(col.pos[0],
-                                                                           col.pos[1],
-                                                                           col.pos[2]))
-        time.InsertNextValue(col.time)
-        wear.InsertNextValue(model(col, **kwargs))
-        normal.InsertNextTuple3(*col.normal)
-        poly_data.InsertNextCell(pixel.GetCellType(), pixel.GetPointIds())
+    poly_data.SetVerts(vertex_cell_array(ncol))
 
-    poly_data.GetPointData().AddArray(time)
-    poly_data.GetPointData().AddArray(wear)
-    poly_data.GetPointData().AddArray(normal)
+    for name, data in (('Time', log.time),
+                       ('Wear', numpy.broadcast_to(log.get_wear(model, boundary,
+                                                                **kwargs), (ncol,))),
+                       ('Normal', log.normal)):
+        arr = numpy_support.numpy_to_vtk(numpy.array(data, float), deep=1)
+        arr.SetName(name)
+        poly_data.GetPointData().AddArray(arr)
 
     write_to_file(poly_data, outfile)
 
@@ -750,10 +1241,22 @@ def test_in_cell(cell, position):
         logger.warn('outside cell by %s'%out)
     return out == 0
 
-def write_to_file(vtk_data, outfile):
-    """ Wrapper around the various VTK writer routines"""
+def write_to_file(vtk_data, outfile, writer_options=None):
+    """ Wrapper around the various VTK writer routines
+
+    Args:
+        vtk_data (vtkDataObject): The data to write.
+        outfile (str): The file name.
+        writer_options (dict): Options for configure_writer."""
+
+    if (AGGREGATE_WRITERS and Parallel.is_parallel()
+            and vtk_data.IsA('vtkPolyData')
+            and write_aggregated_polydata(vtk_data, outfile, AGGREGATE_WRITERS,
+                                          writer_options)):
+        return
 
     writer = WRITER[vtk_data.GetDataObjectType()]()
+    configure_writer(writer, writer_options)
     writer.SetFileName(outfile)
     if Parallel.is_parallel():
         writer.SetNumberOfPieces(Parallel.get_size())
@@ -774,6 +1277,145 @@ def write_to_file(vtk_data, outfile):
     if Parallel.is_parallel():
         make_subdirectory(outfile)
 
+def xml_type_name(dtype):
+    """ Get the VTK XML type name for a numpy dtype."""
+    name = numpy.dtype(dtype).name
+    if name.startswith('u'):
+        return 'UInt'+name[4:]
+    #otherwise
+    return name.capitalize()
+
+def write_aggregated_polydata(poly_data, outfile, writers=1, writer_options=None):
+    """ Write parallel point polydata from a few writer processes.
+
+    Processes are split into groups, each of which gathers its points,
+    point data and cell data onto one process which writes a single .vtp
+    piece into the subdirectory used by make_subdirectory. Process 0
+    writes the .pvtp summary. Cell data is only supported with one cell
+    per point, as for particle output. Arrays missing on some processes,
+    for instance ones with no particles, are filled with NaN (or zero).
+
+    Returns False, having written nothing, if the data is not suitable.
+    Raises ValueError on every process if an array has a different number
+    of components on different processes."""
+
+    comm = Parallel.get_world_comm()
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    npts = poly_data.GetNumberOfPoints()
+    ncells = poly_data.GetNumberOfCells()
+    if comm.allreduce(int(ncells in (0, npts))) != size:
+        return False
+
+    local = []
+    for association in ('Point', 'Cell'):
+        arrays = getattr(poly_data, 'Get%sData'%association)()
+        for k in range(arrays.GetNumberOfArrays()):
+            arr = arrays.GetArray(k)
+            if arr is None:
+                continue
+            value = vtk_to_numpy(arr).reshape((arr.GetNumberOfTuples(),
+                                               arr.GetNumberOfComponents()))
+            local.append((association, arr.GetName(), value))
+
+    # every process must take part in the same gathers, so agree the
+    # arrays to write from the union of the arrays present anywhere
+    schema = OrderedDict()
+    for proc, arrays in enumerate(comm.allgather([(association, name,
+                                                   value.shape[1], value.dtype.str)
+                                                  for association, name, value in local])):
+        for association, name, ncomp, dtype in arrays:
+            ncomp_0, dtype_0 = schema.get((association, name), (ncomp, dtype))
+            if ncomp != ncomp_0:
+                raise ValueError('%s data array %s has %d components on process %d, not %d'
+                                 %(association, name, ncomp, proc, ncomp_0))
+            schema[(association, name)] = (ncomp,
+                                           numpy.result_type(dtype, dtype_0).str)
+
+    writers = max(1, min(writers, size))
+    group = rank*writers//size
+    sub = comm.Split(group, rank)
+
+    base_name = outfile.rsplit('.', 1)[0]
+    piece_name = '%s_%d.vtp'%(os.path.basename(base_name), group)
+
+    if npts:
+        pts = vtk_to_numpy(poly_data.GetPoints().GetData())
+    else:
+        pts = numpy.zeros((0, 3))
+    pts = Parallel.gather_rows(numpy.asarray(pts, float), sub)
+
+    local = dict(((association, name), value) for association, name, value in local)
+    data = []
+    for (association, name), (ncomp, dtype) in schema.items():
+        dtype = numpy.dtype(dtype)
+        if (association, name) in local:
+            value = numpy.asarray(local[(association, name)], dtype)
+        else:
+            # fill arrays missing here, with NaN where possible
+            value = numpy.zeros((npts if association == 'Point' else ncells, ncomp),
+                                dtype)
+            if dtype.kind in 'fc':
+                value[...] = numpy.nan
+        data.append((association, name, ncomp,
+                     Parallel.gather_rows(value, sub), dtype))
+
+    if sub.Get_rank() == 0:
+        out = vtk.vtkPolyData()
+        out_pts = vtk.vtkPoints()
+        out_pts.SetData(numpy_support.numpy_to_vtk(pts, deep=1))
+        out.SetPoints(out_pts)
+        out.SetVerts(vertex_cell_array(pts.shape[0]))
+        out.GetFieldData().ShallowCopy(poly_data.GetFieldData())
+        for association, name, ncomp, value, _ in data:
+            arr = numpy_support.numpy_to_vtk(value.reshape((-1, ncomp)), deep=1)
+            arr.SetName(name)
+            getattr(out, 'Get%sData'%association)().AddArray(arr)
+
+        if not os.path.isdir(base_name):
+            try:
+                os.makedirs(base_name)
+            except OSError:
+                pass
+
+        writer = vtk.vtkXMLPolyDataWriter()
+        configure_writer(writer, writer_options)
+        writer.SetFileName(os.path.join(base_name, piece_name))
+        if vtk.vtkVersion.GetVTKMajorVersion() < 6:
+            writer.SetInput(out)
+        else:
+            writer.SetInputData(out)
+        writer.Write()
+
+    if rank == 0:
+        text = ['<?xml version="1.0"?>',
+                '<VTKFile type="PPolyData" version="0.1" byte_order="%s">'
+                %('LittleEndian' if sys.byteorder == 'little' else 'BigEndian'),
+                '  <PPolyData GhostLevel="0">']
+        for association in ('Point', 'Cell'):
+            text.append('    <P%sData>'%association)
+            for assoc, name, ncomp, _, dtype in data:
+                if assoc == association:
+                    text.append('      <PDataArray type="%s" Name="%s" NumberOfComponents="%d"/>'
+                                %(xml_type_name(dtype), name, ncomp))
+            text.append('    </P%sData>'%association)
+        text += ['    <PPoints>',
+                 '      <PDataArray type="Float64" NumberOfComponents="3"/>',
+                 '    </PPoints>']
+        for _ in range(writers):
+            text.append('    <Piece Source="%s/%s_%d.vtp"/>'
+                        %(os.path.basename(base_name),
+                          os.path.basename(base_name), _))
+        text += ['  </PPolyData>', '</VTKFile>', '']
+        with open(outfile, 'w') as summary_file:
+            summary_file.write('\n'.join(text))
+
+    sub.Free()
+    Parallel.barrier()
+
+    return True
+
 def make_subdirectory(fname):
     """Create directory to store parallel data."""
     Parallel.barrier()
@@ -1071,14 +1713,16 @@ def make_boundary_from_msh(mesh, outfile=None):
 
     return ugrid_bnd
 
-def interpolate_collision_data(col_list, ugrid, method='nearest'):
+def interpolate_collision_data(col_list, ugrid, method='nearest', boundary=None):
     """ Interpolate the wear data from col_list onto the surface described
-    in the vtkUnstructuredGrid ugrid """
+    in the vtkUnstructuredGrid ugrid. The wear material and surface ids
+    are taken from boundary, if given."""
 
     out_pts = numpy.array([ugrid.GetPoint(i) for i in range(ugrid.GetNumberOfPoints())])
 
-    data_pts = numpy.array([c.pos for c in col_list])
-    wear_pts = numpy.array([c.get_wear() for c in col_list])
+    log = Collision.as_collision_log(col_list)
+    data_pts = log.pos
+    wear_pts = log.get_wear(boundary=boundary)
 
     wear_on_grid = griddata(data_pts, wear_pts, out_pts, method=method)
 #    rbfi = Rbf(data_pts[:,0], data_pts[:, 1], data_pts[:, 2], wear_pts,
@@ -1278,199 +1922,320 @@ def get_boundary_from_fluidity_mesh(positions):
 
     return ugrid
 
-def move_boundary_through_normal(ugrid, distance, Ids=[]):
-    """Pull the boundary in by 'distance', to test for intersection."""
-
-    r = numpy.zeros((ugrid.GetNumberOfPoints(), 3))
-    area = numpy.zeros(ugrid.GetNumberOfPoints())
-    n = numpy.zeros((ugrid.GetNumberOfCells(), 3))
-    local_area = numpy.zeros(ugrid.GetNumberOfCells())
-
-
-
-    if ugrid.GetCell(0).GetClassName() == 'vtkLine':
-    
-
-        for i in range(ugrid.GetNumberOfCells()):
+def get_face_adjacency(ids):
+    """Find pairs of line or triangle cells sharing a point or an edge.
 
-            cell = ugrid.GetCell(i)
+    Returns arrays (face_0, face_1, same) where same is True when the two
+    faces traverse their shared point/edge in the same direction, i.e. when
+    their normals are inconsistently oriented."""
 
-            x = numpy.array(cell.GetPoints().GetPoint(1))
-            p = x - numpy.array(cell.GetPoints().GetPoint(0))
-
-            local_area = numpy.sqrt(p.dot(p))
-            p = p/local_area
-
-            n[i, 0] = p[1]
-            n[i, 1] = -p[0]
-            
-            if abs(n[i, 0]) > 0.0:
-                if x[0] > 0.11:
-                    n[i, 0] = 1.0
-                else:
-                    n[i, 0] = -1.0
-            else:
-                if x[1] > 0.0:
-                    n[i, 1] = 1.0
-                else:
-                    n[i, 1] = -1.0
-                
+    nfaces, npts = ids.shape
 
+    if npts == 2:
+        keys = ids.reshape(-1, 1)
+        direction = numpy.tile((-1, 1), nfaces)
     else:
+        start = ids.reshape(-1)
+        end = numpy.roll(ids, -1, axis=1).reshape(-1)
+        keys = numpy.column_stack((numpy.minimum(start, end),
+                                   numpy.maximum(start, end)))
+        direction = numpy.where(start < end, 1, -1)
+    faces = numpy.repeat(numpy.arange(nfaces), npts)
+
+    order = numpy.lexsort(keys.T[::-1])
+    keys, direction, faces = keys[order], direction[order], faces[order]
+
+    shared = numpy.all(keys[1:] == keys[:-1], axis=1)
+    face_0 = faces[:-1][shared]
+    face_1 = faces[1:][shared]
+    same = direction[:-1][shared] == direction[1:][shared]
+
+    return face_0, face_1, same
+
+def _count_ray_crossings(origin, direction, pts, ids, exclude):
+    """Count crossings of the ray origin+t*direction, t>0, with the line or
+    triangle cells of a boundary."""
+
+    keep = numpy.ones(len(ids), bool)
+    keep[exclude] = False
+    ids = ids[keep]
+
+    if ids.shape[1] == 2:
+        pnt0 = pts[ids[:, 0], :2]
+        edge = pts[ids[:, 1], :2]-pnt0
+        rel = pnt0-origin[:2]
+        denom = direction[0]*edge[:, 1]-direction[1]*edge[:, 0]
+        valid = abs(denom) > 1.0e-300
+        denom[~valid] = 1.0
+        t_val = (rel[:, 0]*edge[:, 1]-rel[:, 1]*edge[:, 0])/denom
+        u_val = (rel[:, 0]*direction[1]-rel[:, 1]*direction[0])/denom
+        hits = valid & (t_val > 0.0) & (u_val >= 0.0) & (u_val < 1.0)
+    else:
+        pnt0 = pts[ids[:, 0]]
+        edge1 = pts[ids[:, 1]]-pnt0
+        edge2 = pts[ids[:, 2]]-pnt0
+        pvec = numpy.cross(direction, edge2)
+        det = numpy.sum(edge1*pvec, axis=1)
+        valid = abs(det) > 1.0e-300
+        det[~valid] = 1.0
+        tvec = origin-pnt0
+        u_val = numpy.sum(tvec*pvec, axis=1)/det
+        qvec = numpy.cross(tvec, edge1)
+        v_val = numpy.dot(qvec, direction)/det
+        t_val = numpy.sum(edge2*qvec, axis=1)/det
+        hits = (valid & (t_val > 0.0) & (u_val >= 0.0) & (v_val >= 0.0)
+                & (u_val+v_val < 1.0))
+
+    return numpy.count_nonzero(hits)
+
+def orient_face_normals(pts, ids, normals):
+    """Orient the normals of a closed line (2D) or triangle (3D) boundary
+    to point out of the enclosed domain.
+
+    Normals are first made consistent across each connected piece of the
+    boundary, then each piece is flipped if a ray cast along the normal of
+    one of its faces crosses the boundary an odd number of times."""
+
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components, breadth_first_order
+
+    nfaces = len(ids)
+    normals = normals.copy()
+
+    if nfaces == 0 or ids.shape[1] not in (2, 3):
+        return normals
+
+    face_0, face_1, same = get_face_adjacency(ids)
+    pairs, index = numpy.unique(numpy.sort(numpy.column_stack((face_0, face_1)),
+                                           axis=1),
+                                axis=0, return_index=True)
+    relation = numpy.where(same[index], 2, 1)
+    adjacency = coo_matrix((numpy.concatenate((relation, relation)),
+                            (numpy.concatenate((pairs[:, 0], pairs[:, 1])),
+                             numpy.concatenate((pairs[:, 1], pairs[:, 0])))),
+                           shape=(nfaces, nfaces)).tocsr()
+
+    ncomp, labels = connected_components(adjacency, directed=False)
+
+    parent = numpy.arange(nfaces)
+    sign = numpy.ones(nfaces, int)
+    roots = numpy.empty(ncomp, int)
+    for comp in range(ncomp):
+        root = numpy.flatnonzero(labels == comp)[0]
+        roots[comp] = root
+        order, pred = breadth_first_order(adjacency, root, directed=False)
+        children = order[1:]
+        parent[children] = pred[children]
+        rel = numpy.asarray(adjacency[pred[children], children]).ravel()
+        sign[children] = numpy.where(rel == 2, -1, 1)
+
+    # pointer jumping to accumulate the sign flips along each tree path
+    while numpy.any(parent[parent] != parent):
+        sign = sign*sign[parent]
+        parent = parent[parent]
+
+    normals *= sign[:, None]
+
+    tilt = numpy.array((1.0e-7, 2.1e-7, 1.3e-7))
+    for comp, root in enumerate(roots):
+        origin = pts[ids[root]].mean(axis=0)
+        direction = normals[root]+tilt
+        if ids.shape[1] == 2:
+            direction[2] = 0.0
+        if _count_ray_crossings(origin, direction, pts, ids, root) % 2:
+            normals[labels == comp] *= -1.0
+
+    return normals
+
+def move_boundary_through_normal(ugrid, distance, Ids=None, iterations=10):
+    """Pull the boundary in by 'distance', to test for intersection.
+
+    Returns a copy of the line (2D) or triangle (3D) boundary ugrid with each
+    point moved inwards so that the faces lie 'distance' from the original
+    surface. Faces with surface ids in Ids (e.g. inlets and outlets) are not
+    used to move their points."""
+
+    Ids = Ids or []
+
+    pts = get_point_array(ugrid)
+    ids = get_cell_point_ids(ugrid)
+
+    out = ugrid.NewInstance()
+    out.DeepCopy(ugrid)
+
+    if len(ids) == 0 or ids.shape[1] not in (2, 3):
+        return out
+
+    normals = orient_face_normals(pts, ids, get_face_normals(ugrid)[0])
 
-        gf = vtk.vtkGeometryFilter()
-        if vtk.vtkVersion.GetVTKMajorVersion() < 6:
-            gf.SetInput(ugrid)
-        else:
-            gf.SetInputData(ugrid)
-        gf.Update()
-
-        pd = gf.GetOutput()
-
-        pn = vtk.vtkPolyDataNormals()
-        if vtk.vtkVersion.GetVTKMajorVersion() < 6:
-            pn.SetInput(pd)
-        else:
-            pn.SetInputData(pd)
-        pn.ComputeCellNormalsOn()
-        pn.AutoOrientNormalsOn()
-        pn.Update()
-        norms = pn.GetOutput().GetCellData().GetNormals()
-
-        N = 10
+    cell_data = ugrid.GetCellData()
+    if cell_data.HasArray('SurfaceIds'):
+        surface_ids = vtk_to_numpy(cell_data.GetArray('SurfaceIds')).ravel()
+    elif cell_data.HasArray('PhysicalIds'):
+        surface_ids = vtk_to_numpy(cell_data.GetArray('PhysicalIds')).ravel()
+    else:
+        surface_ids = numpy.zeros(len(ids), int)
 
-        for k in range(N):
+    wall = ~numpy.in1d(surface_ids, Ids)
+    ids = ids[wall]
+    normals = normals[wall]
+    flat_ids = ids.ravel()
+    npts = ids.shape[1]
 
-            r0 = numpy.zeros((ugrid.GetNumberOfPoints(), 3))
+    disp = numpy.zeros((len(pts), 3))
 
-            physical_ids = ugrid.GetCellData().GetScalars("PhysicalIds")
+    for k in range(iterations):
 
-            for i in range(ugrid.GetNumberOfCells()):
+        moved = pts-k/float(max(iterations-1, 1))*distance*disp
+        if npts == 2:
+            local_area = numpy.sqrt(numpy.sum((moved[ids[:, 1]]
+                                               -moved[ids[:, 0]])**2, axis=1))
+        else:
+            local_area = 0.5*numpy.sqrt(numpy.sum(
+                numpy.cross(moved[ids[:, 1]]-moved[ids[:, 0]],
+                            moved[ids[:, 2]]-moved[ids[:, 0]])**2, axis=1))
 
-                if physical_ids.GetValue(i) in Ids:
-                    continue
+        weighted = numpy.repeat(local_area[:, None]*normals, npts, axis=0)
 
-                cell = ugrid.GetCell(i)
-                n[i, :] = norms.GetTuple(i)
+        r_0 = numpy.zeros((len(pts), 3))
+        for dim in range(3):
+            r_0[:, dim] = numpy.bincount(flat_ids, weighted[:, dim],
+                                         minlength=len(pts))
 
-                p0 = (numpy.array(cell.GetPoints().GetPoint(0))-
-                      k/float(N-1)*distance*r[cell.GetPointId(0), :])
-                p1 = (numpy.array(cell.GetPoints().GetPoint(1))-
-                      k/float(N-1)*distance*r[cell.GetPointId(1), :])
-                p2 = (numpy.array(cell.GetPoints().GetPoint(2))-
-                      k/float(N-1)*distance*r[cell.GetPointId(2), :])
+        denom = numpy.sum(numpy.repeat(normals, npts, axis=0)*r_0[flat_ids],
+                          axis=1)
+        valid = abs(denom) > 1.0e-300
+        denom[~valid] = 1.0
+        weighted[~valid] = 0.0
 
-                local_area[i] = cell.TriangleArea(p0, p1, p2)
+        for dim in range(3):
+            disp[:, dim] = numpy.bincount(flat_ids, weighted[:, dim]/denom,
+                                          minlength=len(pts))
 
-                for j in range(cell.GetNumberOfPoints()):
+    out.GetPoints().SetData(numpy_support.numpy_to_vtk(pts-distance*disp,
+                                                       deep=1))
 
-                    pid = cell.GetPointId(j)
-                    r0[pid, :] += local_area[i] * n[i, :]
-                    area[pid] += local_area[i]
+    return out
 
-            r[:, :] = 0.0
+def make_trajectories(outfile, base_name, extension='vtp', **kwargs):
+    """ Process a time series of polydata files into a single trajectory file.
 
-            for i in range(ugrid.GetNumberOfCells()):
+    See Trajectories.make_trajectories for the keyword arguments."""
+    from particle_model import Trajectories
+    Trajectories.make_trajectories(outfile, base_name, extension, **kwargs)
 
-                if physical_ids.GetValue(i) in Ids:
-                    continue
+def dump_files(base_name, extension='vtp'):
+    """ Get the dump files of a series, in order."""
 
-                cell = ugrid.GetCell(i)
+    pattern = re.compile(re.escape(os.path.basename(base_name))+r'_(\d+)\.'
+                         +re.escape(extension)+'$')
+    files = []
+    for name in glob.glob(base_name+'_[0-9]*.'+extension):
+        match = pattern.match(os.path.basename(name))
+        if match:
+            files.append((int(match.group(1)), name))
 
-                for j in range(cell.GetNumberOfPoints()):
+    return [name for _, name in sorted(files)]
 
-                    pid = cell.GetPointId(j)
+PVD_HEADER = ('<?xml version="1.0"?>\n'
+              '<VTKFile type="Collection" version="0.1" byte_order="LittleEndian">\n'
+              '  <Collection>\n')
+PVD_FOOTER = '  </Collection>\n</VTKFile>\n'
 
-                    r[pid, :] += local_area[i] * n[i,:] / n[i,:].dot(r0[pid,:])
+def pvd_dataset(pvd_name, time, filename):
+    """ Get the .pvd collection entry for a file."""
+    return '    <DataSet timestep="%r" file="%s"/>\n'%(
+        float(time), os.path.relpath(filename, os.path.dirname(os.path.abspath(pvd_name))))
 
-        for i in range(ugrid.GetNumberOfPoints()):
+def write_pvd(pvd_name, datasets):
+    """ Write a .pvd collection file.
 
-            x = numpy.empty(3)
-            ugrid.GetPoints().GetPoint(i, x)
-            ugrid.GetPoints().SetPoint(i, x-distance*r[i, :])
+    Args:
+        pvd_name (str): The file name.
+        datasets (list): (time, filename) pairs."""
 
-    return ugrid
+    with open(pvd_name, 'w') as pvd_file:
+        pvd_file.write(PVD_HEADER)
+        for time, filename in datasets:
+            pvd_file.write(pvd_dataset(pvd_name, time, filename))
+        pvd_file.write(PVD_FOOTER)
 
-def make_trajectories(outfile, base_name, extension='vtp'):
-    """ Process a time series of polydata files into a single trajectory file."""
-    files = glob.glob(base_name+'_[0-9]*.'+extension)
+def append_to_pvd(pvd_name, time, filename, new=False):
+    """ Add a dataset to the end of a .pvd collection, without rereading it.
 
-    def num(val):
-        """Get file number."""
-        return int(val.rsplit('_', 1)[1].split('.', 1)[0])
+    Args:
+        pvd_name (str): The collection file, created if it does not exist.
+        time (float): The timestep of the dataset.
+        filename (str): The dataset file.
+        new (bool): Start a new collection."""
+
+    if new or not os.path.isfile(pvd_name):
+        write_pvd(pvd_name, [(time, filename)])
+        return
+
+    with open(pvd_name, 'rb+') as pvd_file:
+        pvd_file.seek(0, os.SEEK_END)
+        pvd_file.seek(max(0, pvd_file.tell()-256))
+        tail_start = pvd_file.tell()
+        pos = pvd_file.read().rfind(b'  </Collection>')
+        if pos >= 0:
+            pvd_file.seek(tail_start+pos)
+            pvd_file.write((pvd_dataset(pvd_name, time, filename)
+                            +PVD_FOOTER).encode('utf-8'))
+            pvd_file.truncate()
+            return
+
+    #otherwise the file was not written by us, so regenerate it
+    from xml.etree import ElementTree
+    datasets = [(float(_.get('timestep')),
+                 os.path.join(os.path.dirname(pvd_name), _.get('file')))
+                for _ in ElementTree.parse(pvd_name).getroot().iter('DataSet')]
+    write_pvd(pvd_name, datasets+[(time, filename)])
+
+TIME_READERS = {'vtp': vtk.vtkXMLPolyDataReader,
+                'vtu': vtk.vtkXMLUnstructuredGridReader,
+                'pvtp': vtk.vtkXMLPPolyDataReader,
+                'pvtu': vtk.vtkXMLPUnstructuredGridReader}
+
+def read_time(filename):
+    """ Get the Time value of a VTK XML file.
+
+    Where the reader supports time arrays, the Time field data is read with
+    the file information, without loading the points. Otherwise only the
+    field data and the Time point data array are loaded where the reader
+    allows it. The value is exact, unlike the rounded RangeMin attribute
+    in the XML header."""
+
+    reader = TIME_READERS.get(os.path.splitext(filename)[1][1:],
+                              vtk.vtkXMLGenericDataObjectReader)()
+    reader.SetFileName(filename)
 
-    files.sort(key=num)
-    reader = vtk.vtkXMLGenericDataObjectReader()
+    if hasattr(reader, 'SetActiveTimeDataArrayName'):
+        reader.SetActiveTimeDataArrayName('Time')
+        reader.UpdateInformation()
+        info = reader.GetOutputInformation(0)
+        key = vtk.vtkStreamingDemandDrivenPipeline.TIME_STEPS()
+        if info.Has(key):
+            return info.Get(key)[0]
+
+    if hasattr(reader, 'GetPointDataArraySelection'):
+        reader.UpdateInformation()
+        reader.GetPointDataArraySelection().DisableAllArrays()
+        reader.GetPointDataArraySelection().EnableArray('Time')
+        reader.GetCellDataArraySelection().DisableAllArrays()
+    reader.Update()
+    data = reader.GetOutput()
 
-    trajectories = vtk.vtkPolyData()
-    cell_ids = {}
-    pnts = vtk.vtkPoints()
-    fields = {}
-
-    for _ in files:
-        reader.SetFileName(_)
-        reader.Update()
-        data = reader.GetOutput()
-
-        for __ in range(data.GetNumberOfPoints()):
-            cell_ids.setdefault(data.GetPointData().GetArray("ParticleID").GetValue(__),
-                                vtk.vtkIdList()).InsertNextId(pnts.InsertNextPoint(data.GetPoint(__)))
-            for ___ in range(data.GetPointData().GetNumberOfArrays()):
-                vinput = data.GetPointData().GetArray(___)
-                name = vinput.GetName()
-                if name not in fields:
-                    arr = vtk.vtkDoubleArray()
-                    arr.SetName(name)
-                    arr.SetNumberOfComponents(vinput.GetNumberOfComponents())
-                    trajectories.GetPointData().AddArray(arr)
-                    fields[name] = arr
-                fields[name].InsertNextTuple(vinput.GetTuple(__))
-
-    trajectories.SetPoints(pnts)
-    trajectories.Allocate(len(cell_ids))
-    for _ in cell_ids.values():
-        trajectories.InsertNextCell(vtk.VTK_LINE, _)
-
-    write_to_file(trajectories, outfile)
+    if data.GetFieldData().HasArray("Time"):
+        return data.GetFieldData().GetArray("Time").GetValue(0)
+    #otherwise
+    return data.GetPointData().GetArray("Time").GetValue(0)
 
 def make_pvd(pvd_name, base_name, extension='vtp'):
     """ Write a barebones Paraview .pvd file from data."""
-    from lxml import etree as ET
-    vtkfile = ET.Element('VTKFile',
-                         attrib={'type':'Collection',
-                                 'version':'0.1',
-                                 'byte_order':'LittleEndian'})
-    collection = ET.Element('Collection')
-
-    files = glob.glob(base_name+'_[0-9]*.'+extension)
-
-    def num(pos):
-        """Get file number."""
-        return int(pos.rsplit('_', 1)[1].split('.', 1)[0])
-
-    files.sort(key=num)
-    reader = vtk.vtkXMLGenericDataObjectReader()
-
-    for _ in files:
-        reader.SetFileName(_)
-        reader.Update()
-        data = reader.GetOutput()
-
-        if data.GetFieldData().HasArray("Time"):
-            time = data.GetFieldData().GetArray("Time").GetValue(0)
-        elif data.GetPointData().HasArray("Time"):
-            time = data.GetPointData().GetArray("Time").GetValue(0)
-
-        collection.append(ET.Element('DataSet',
-                                     attrib={'timestep':str(time),
-                                             'file':str(_)})
-                         )
-               
-
-        vtkfile.append(collection)
-
-        with open(pvd_name, 'wb') as _:
-            ET.ElementTree(vtkfile).write(_, pretty_print=True)
+
+    write_pvd(pvd_name, [(read_time(_), _)
+                         for _ in dump_files(base_name, extension)])
 
 
 def get_real_x(cell, locx):
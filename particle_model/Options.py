@@ -45,11 +45,15 @@ class Inlet(object):
 
         return inlet_weight
 
-    def cum_weight(self, time, boundary, cache=None):
-        """Calculate inlet cumulative weight."""
+    def cum_weight(self, time, boundary, cache=None, cells=None):
+        """Calculate inlet cumulative weight.
+
+        If cells is given, only those boundary cells are considered."""
         inlet_weight = 0
         weights = []
-        for index in range(boundary.GetNumberOfCells()):
+        if cells is None:
+            cells = range(boundary.GetNumberOfCells())
+        for index in cells:
             if boundary.GetCellData().GetScalars('SurfaceIds').GetValue(index) in self.surface_ids:
                 cell = boundary.GetCell(index)
                 npts = cell.GetNumberOfPoints()
@@ -104,10 +108,13 @@ class Inlet(object):
 
         return pnt
 
-    def get_number_of_insertions(self, time, delta_t):
-        """ Return the result of a  poisson series on how many insertions occur."""
+    def get_number_of_insertions(self, time, delta_t, fraction=1.0):
+        """ Return the result of a  poisson series on how many insertions occur.
+
+        fraction scales the rate, so processes can each sample their share
+        of the inlet independently."""
         del time
-        return numpy.random.poisson(delta_t*self.insertion_rate)
+        return numpy.random.poisson(delta_t*self.insertion_rate*fraction)
 
 class OptionsReader(object):
     """ Handle processing the XML into python"""
@@ -160,6 +167,23 @@ class OptionsReader(object):
         #otherwise
         return None
 
+    def get_writer_options(self):
+        """ Return the VTK output options, as keywords for IO.set_writer_options."""
+
+        options = {}
+        for key, name in (('data_mode', 'vtk_output/data_mode'),
+                          ('compressor', 'vtk_output/compressor'),
+                          ('block_size', 'vtk_output/block_size'),
+                          ('level', 'vtk_output/compression_level')):
+            value = self.get_model_option(name)
+            if value is not None:
+                options[key] = value
+        options_base = '/embedded_models/particle_model/vtk_output'
+        if libspud.have_option(options_base):
+            options['encode'] = libspud.have_option(options_base+'/encode_appended_data')
+
+        return options
+
     def get_outlet_ids(self):
         """ interogate the model specific options """
         options_base = '/embedded_models/particle_model/outlet_ids/surface_ids'
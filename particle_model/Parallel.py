@@ -2,13 +2,20 @@
 
 import sys
 import itertools
+from collections import OrderedDict
 import numpy
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
 
 try:
     from mpi4py import MPI
 except ImportError:
     MPI = None
 
+# cell locators, keyed on the block they search
+LOCATORS = OrderedDict()
+MAX_LOCATORS = 4
+
 def is_parallel():
     """ Check if this is a parallel run."""
 
@@ -63,6 +70,36 @@ def is_root(root=0):
     return get_rank() == root
 
 
+def allreduce(value):
+    """ Sum a value across all processors."""
+
+    if MPI is None:
+        return value
+
+    comm = MPI.COMM_WORLD
+
+    return comm.allreduce(value)
+
+
+def gather_rows(data, comm=None, root=0):
+    """ Gather the rows of an array from all processors onto root.
+
+    Returns the concatenated rows on root and None elsewhere."""
+
+    comm = comm or MPI.COMM_WORLD
+    data = numpy.ascontiguousarray(data)
+
+    counts = comm.gather(data.size, root)
+
+    if comm.Get_rank() != root:
+        comm.Gatherv(data, None, root)
+        return None
+    #otherwise
+    out = numpy.empty(sum(counts), data.dtype)
+    comm.Gatherv(data, [out, counts], root)
+    return out.reshape((-1,)+data.shape[1:])
+
+
 def point_in_bound(pnt, bound):
     """Check whether a point is inside the bounds"""
     return all((pnt[0] > bound[0],
@@ -84,55 +121,226 @@ def gather_bounds(bounds):
 
     return all_bounds
 
-def distribute_particles(particle_list, system, time=0.0):
-    """ Handle exchanging particles across multiple processors """
-
-#    try:
-#        block = system.temporal_cache.block
-#    except:
-#        data = system.temporal_cache(time)
-#        block = data[0][1][-2]
-    bounds = system.temporal_cache.get_bounds(time)
+class ParticleExchange(object):
+    """ Non-blocking exchange of packed particles between processors.
+
+    The exchange starts when the object is created. Calling progress()
+    between pieces of local work posts the data transfer as soon as the
+    message sizes are known, and wait() completes it."""
+
+    def __init__(self, particle_list, destinations, system, species=None,
+                 comm=None):
+        """ Pack the particles and start the exchange.
+
+        Args:
+            particle_list (list): Particles to send.
+            destinations (ndarray): Destination rank for each particle.
+            system (System): System for the received particles.
+            species (list): PhysicalParticle of each particle species."""
+
+        from particle_model import Particles
+
+        self.comm = comm or MPI.COMM_WORLD
+        self.system = system
+        self.species = species
+
+        destinations = numpy.asarray(destinations, int)
+        order = numpy.argsort(destinations, kind='mergesort')
+        particle_list = [particle_list[k] for k in order]
+
+        self.field_sizes = Particles.get_field_sizes(particle_list)
+        for sizes in self.comm.allgather(self.field_sizes):
+            self.field_sizes.update(sizes)
+
+        self.send = Particles.pack_particles(particle_list, species,
+                                             self.field_sizes)
+        self.counts = numpy.bincount(destinations,
+                                     minlength=self.comm.Get_size()).astype('i')
+        self.recv_counts = numpy.empty_like(self.counts)
+        self.recv = None
+        self._requests = None
+        self._count_request = self.comm.Ialltoall(self.counts,
+                                                  self.recv_counts)
+
+    def _post(self):
+        """ Post the transfer of the packed particle data."""
+
+        send_displ = numpy.zeros_like(self.counts)
+        send_displ[1:] = numpy.cumsum(self.counts[:-1])
+        recv_displ = numpy.zeros_like(self.recv_counts)
+        recv_displ[1:] = numpy.cumsum(self.recv_counts[:-1])
+
+        self.recv = []
+        self._requests = []
+        for data in self.send:
+            width = data.shape[1]
+            out = numpy.empty((self.recv_counts.sum(), width), data.dtype)
+            self._requests.append(self.comm.Ialltoallv(
+                [data, (self.counts*width, send_displ*width)],
+                [out, (self.recv_counts*width, recv_displ*width)]))
+            self.recv.append(out)
+
+    def progress(self):
+        """ Advance the exchange without blocking."""
+        if self._requests is None and self._count_request.Test():
+            self._post()
+
+    def wait(self):
+        """ Complete the exchange and return the received particles."""
+
+        from particle_model import Particles
+
+        if self._requests is None:
+            self._count_request.Wait()
+            self._post()
+        MPI.Request.Waitall(self._requests)
+
+        return Particles.unpack_particles(self.recv[0], self.recv[1],
+                                          self.system, self.species,
+                                          self.field_sizes)
+
+def exchange_particles(particle_list, destinations, system, species):
+    """ Send particles to the given destination ranks as packed buffers.
+
+    Args:
+        particle_list (list): Particles to send.
+        destinations (ndarray): Destination rank for each particle.
+        system (System): System for the received particles.
+        species (list): PhysicalParticle of each particle species.
+
+    Returns the list of particles received from other processors."""
+
+    return ParticleExchange(particle_list, destinations,
+                            system, species).wait()
+
+def route_particles(particle_list, system, time=0.0):
+    """ Decide which processors particles should move to.
+
+    Particles in cells owned by another processor, including halo cells,
+    are sent to the owning processor only. Particles which have left the
+    local partition entirely are offered to the processors whose bounds
+    contain them.
+
+    Returns the list of particles to keep, the list of particles to send
+    and the destination rank of each particle sent."""
 
     comm = MPI.COMM_WORLD
     size = comm.Get_size()
     rank = comm.Get_rank()
 
-    if not is_parallel():
-        return set(particle_list)
+    data = system.temporal_cache(time)[0][0]
+
+    owners = point_owner(data[2], [par.pos for par in particle_list], data[3])
 
     all_bounds = numpy.empty([size, 6], dtype=float)
+    comm.Allgather(system.temporal_cache.get_bounds(time), all_bounds)
 
-    comm.Allgather(bounds, all_bounds)
+    output = []
+    plist = []
+    destinations = []
 
-    odata = []
-
-    for i in range(size):
-        if i == rank:
-            odata.append([])
-            continue
-        plist = []
-        for par in particle_list:
-            if not point_in_bound(par.pos, all_bounds[i]):
-                continue
-            par = par.copy()
+    for par, owner in zip(particle_list, owners):
+        if owner == rank:
+            output.append(par)
+        elif owner >= 0:
             plist.append(par)
-        odata.append(plist)
+            destinations.append(owner)
+        else:
+            for i in range(size):
+                if i != rank and point_in_bound(par.pos, all_bounds[i]):
+                    plist.append(par)
+                    destinations.append(i)
+
+    return output, plist, destinations
+
+def accept_particles(particle_list, system, time=0.0):
+    """ Select the received particles lying in cells owned on this process."""
+
+    data = system.temporal_cache(time)[0][0]
+    owned = point_owned(data[2], [par.pos for par in particle_list], data[3])
+
+    return list(itertools.compress(particle_list, owned))
+
+def distribute_particles(particle_list, system, time=0.0, species=None):
+    """ Handle exchanging particles across multiple processors """
+
+    if not is_parallel():
+        return list(particle_list)
+
+    output, plist, destinations = route_particles(particle_list, system, time)
 
-    data = comm.alltoall(sendobj=odata)
+    received = exchange_particles(plist, destinations, system, species)
+    output.extend(accept_particles(received, system, time))
 
-    output = set(particle_list)
-    for i in range(size):
-        if i == rank:
-            continue
+    return output
+
+def morton_keys(points, bounds, bits=10):
+    """ Get Morton (Z order) space filling curve keys for points.
+
+    Args:
+        points (ndarray): Point positions.
+        bounds (ndarray): Bounds of the domain (xmin, xmax, ymin, ymax, zmin, zmax).
+        bits (int): Number of bits of resolution per dimension."""
+
+    points = numpy.asarray(points, float).reshape((-1, 3))
+    lower = numpy.asarray(bounds, float)[::2]
+    extent = numpy.asarray(bounds, float)[1::2]-lower
+    extent[extent <= 0.0] = 1.0
+
+    cells = numpy.clip(((points-lower)/extent*(1 << bits)).astype(numpy.int64),
+                       0, (1 << bits)-1)
+
+    keys = numpy.zeros(points.shape[0], numpy.int64)
+    for bit in range(bits):
+        for axis in range(3):
+            keys |= ((cells[:, axis] >> bit) & 1) << (3*bit+axis)
+
+    return keys
+
+def balance_particles(particle_list, system, time=0.0, species=None,
+                      tolerance=1.1, bits=10, level=12):
+    """ Repartition particles between processors by particle count.
+
+    Particles are ordered along a Morton space filling curve over the
+    system bounds and the curve is cut into pieces holding similar numbers
+    of particles. This is only valid when every processor can evaluate the
+    fluid data over the whole domain, as in offline runs from serial files.
+
+    Args:
+        tolerance (float): Only rebalance when the largest particle count
+        exceeds the mean count by this factor.
+        bits (int): Resolution of the space filling curve per dimension.
+        level (int): Number of bits of the curve used to form the bins."""
+
+    if not is_parallel():
+        return list(particle_list)
+
+    comm = MPI.COMM_WORLD
+    size = comm.Get_size()
+    rank = comm.Get_rank()
+
+    counts = numpy.array(comm.allgather(len(particle_list)))
+    total = counts.sum()
+    if total == 0 or counts.max() <= tolerance*total/float(size):
+        return list(particle_list)
+
+    keys = morton_keys([par.pos for par in particle_list],
+                       system.temporal_cache.get_bounds(time), bits)
+    bins = keys >> max(3*bits-level, 0)
+
+    hist = numpy.bincount(bins, minlength=1 << min(level, 3*bits))
+    comm.Allreduce(MPI.IN_PLACE, hist)
 
-        for par in data[i]:
-            par.system = system
-            output.add(par)
+    bin_rank = numpy.minimum((numpy.cumsum(hist)-hist)*size//total, size-1)
+    destinations = bin_rank[bins]
 
-    live = system.particle_in_system(output, time, rank)
-    output = list(itertools.compress(output,
-                                     live))
+    output = [par for par, dest in zip(particle_list, destinations)
+              if dest == rank]
+    plist = [par for par, dest in zip(particle_list, destinations)
+             if dest != rank]
+
+    output.extend(exchange_particles(plist, destinations[destinations != rank],
+                                     system, species))
 
     return output
 
@@ -171,34 +379,98 @@ class ParticleId(object):
     @staticmethod
     def update_counter(val):
         """Increase counter to val+1."""
-        ParticleId._counter = itertools.count(val+1).next
+        ParticleId._counter = itertools.count(val+1)
 
 
-def cell_owned(block, ele):
-    """ Check if element/cell owned on this process."""
-    if not is_parallel():
-        return True
-    if not block.IsA("vtkMultiblockDataSet"):
-        return True
-    if not block.GetBlock(0).GetCellData().HasArray("ElementOwner"):
-        return True
-    return  block.GetBlock(0).GetCellData().GetScalar("ElementOwner").GetValue(ele) == get_rank()+1
+def get_owner_array(block):
+    """ Get the ElementOwner data of a block, or None if not present."""
+    if block.IsA("vtkMultiBlockDataSet"):
+        block = block.GetBlock(0)
+    return block.GetCellData().GetArray("ElementOwner")
 
+def cell_owner(block, ele):
+    """ Get the rank of the process owning an element/cell.
 
-def point_owned(block, points):
-    """ Check if points lie in owned space on this process."""
-    out = numpy.empty(points.shape[0], bool)
-    for k, _ in enumerate(points):
-        ele = find_cell(block, _)
-        if ele > -1:
-            out[k] = cell_owned(block, ele)
-        else:
-            out[k] = False
+    Returns -1 for a negative cell id. Without ElementOwner data every
+    cell in the local block is taken to be owned locally."""
+    if ele < 0:
+        return -1
+    if not is_parallel():
+        return get_rank()
+    owner = get_owner_array(block)
+    if owner is None:
+        return get_rank()
+    #otherwise
+    return int(owner.GetTuple1(ele))-1
 
+def cell_owned(block, ele):
+    """ Check if element/cell owned on this process."""
+    return cell_owner(block, ele) == get_rank()
+
+
+def point_owner(block, points, locator=None):
+    """ Get the rank owning the cell containing each point, or -1."""
+    if block.IsA("vtkMultiBlockDataSet"):
+        block = block.GetBlock(0)
+    ele = numpy.atleast_1d(find_cell(block, points, locator))
+    out = numpy.full(ele.shape, -1, int)
+    found = ele > -1
+    owner = get_owner_array(block)
+    if not is_parallel() or owner is None:
+        out[found] = get_rank()
+    else:
+        out[found] = vtk_to_numpy(owner)[ele[found]]-1
     return out
 
-def find_cell(block, point):
-    """ Find which cell a point in a block is in."""
-    del block, point
-    raise NotImplementedError
-    return -1
+def point_owned(block, points, locator=None):
+    """ Check if points lie in owned space on this process."""
+    return point_owner(block, points, locator) == get_rank()
+
+def get_locator(block, locator=None):
+    """ Get a cell locator for a block.
+
+    Locators are cached until the block is modified. An existing locator
+    for the block, such as one held by a temporal cache, may be passed in
+    to seed the cache. It is ignored if it was built on another dataset."""
+    key = id(block)
+    mtime = block.GetMTime()
+    if key in LOCATORS and LOCATORS[key][1] == mtime:
+        return LOCATORS[key][2]
+    if locator is None or locator.GetDataSet() is not block:
+        locator = vtk.vtkCellLocator()
+        locator.SetDataSet(block)
+        locator.BuildLocator()
+    LOCATORS[key] = (block, mtime, locator)
+    while len(LOCATORS) > MAX_LOCATORS:
+        LOCATORS.popitem(last=False)
+    return locator
+
+def find_cell(block, points, locator=None):
+    """ Find which cells of a block contain a point or array of points.
+
+    Returns the cell index, or -1 where a point is not in the block."""
+    if block.IsA("vtkMultiBlockDataSet"):
+        block = block.GetBlock(0)
+    points = numpy.asarray(points, float)
+    if not points.size:
+        return numpy.empty(0, int)
+    single = points.ndim == 1
+    points = numpy.atleast_2d(points)
+
+    out = numpy.full(points.shape[0], -1, int)
+
+    locator = get_locator(block, locator)
+
+    bounds = numpy.array(block.GetBounds())
+    tol = 1.0e-8*max(bounds[1::2]-bounds[::2])
+    ndim = min(points.shape[1], 3)
+    inside = numpy.all((points[:, :ndim] >= bounds[:2*ndim:2]-tol)
+                       & (points[:, :ndim] <= bounds[1:2*ndim:2]+tol), axis=1)
+
+    for k in numpy.flatnonzero(inside):
+        out[k] = locator.FindCell(points[k])
+
+    if single:
+        return out[0]
+    #otherwise
+    return out
@@ -0,0 +1,216 @@
+""" Module dealing with direct particle-particle (DEM) collisions.
+
+Candidate pairs come from a uniform spatial hash, so the cost of a
+collision stage grows linearly with the number of particles."""
+
+import itertools
+
+import numpy
+
+from particle_model.Debug import logger
+from particle_model import SolidInteractions
+
+OFFSETS = numpy.array(list(itertools.product((-1, 0, 1), repeat=3)), int)
+
+class SpatialHash(object):
+    """ Uniform grid binning of particle positions.
+
+    The particles are held sorted by grid cell. Between updates most
+    particles stay in their cell, so the previous ordering is re-sorted
+    with a stable sort, which is close to linear on nearly sorted keys."""
+
+    def __init__(self):
+        self.cell_size = None
+        self.coords = None
+        self.order = None
+        self.keys = None
+        self.dims = None
+
+    def __len__(self):
+        if self.order is None:
+            return 0
+        #otherwise
+        return self.order.size
+
+    def update(self, pos, cell_size):
+        """ Rebin the particles.
+
+        Args:
+            pos (ndarray): (n, 3) particle positions.
+            cell_size (float): Width of the grid cells."""
+
+        pos = numpy.asarray(pos, float).reshape((-1, 3))
+        coords = numpy.floor(pos/cell_size).astype(numpy.int64)
+
+        if (self.coords is not None and self.coords.shape == coords.shape
+                and self.cell_size == cell_size):
+            if numpy.all(coords == self.coords):
+                return
+            order = self.order
+        else:
+            logger.debug('Rebuilding spatial hash')
+            order = numpy.arange(len(coords))
+
+        # pad by one cell, so neighbour keys never wrap round
+        low = coords.min(axis=0)-1
+        self.dims = coords.max(axis=0)-low+2
+        keys = self.key(coords-low)
+
+        order = order[numpy.argsort(keys[order], kind='mergesort')]
+
+        self.cell_size = cell_size
+        self.coords = coords
+        self.order = order
+        self.keys = keys[order]
+
+    def key(self, coords):
+        """ Get the linear key of integer cell coordinates."""
+        return coords[..., 0]+self.dims[0]*(coords[..., 1]+self.dims[1]*coords[..., 2])
+
+    def pairs(self):
+        """ List the pairs of particles in the same or neighbouring cells.
+
+        Returns:
+            tuple: (i, j) index arrays, each pair appearing once."""
+
+        if len(self) < 2:
+            return numpy.zeros(0, int), numpy.zeros(0, int)
+
+        cells, starts, counts = numpy.unique(self.keys, return_index=True,
+                                             return_counts=True)
+
+        # half of the neighbouring cells, plus the cell itself
+        shifts = self.key(OFFSETS)
+        shifts = shifts[shifts >= 0]
+
+        first = []
+        second = []
+        for shift in shifts:
+            index = numpy.searchsorted(cells, cells+shift)
+            index[index == len(cells)] = 0
+            found = numpy.flatnonzero(cells[index] == cells+shift)
+            i, j = cell_pairs(starts[found], counts[found],
+                              starts[index[found]], counts[index[found]])
+            if shift == 0:
+                keep = i < j
+                i, j = i[keep], j[keep]
+            first.append(i)
+            second.append(j)
+
+        return (self.order[numpy.concatenate(first)],
+                self.order[numpy.concatenate(second)])
+
+def cell_pairs(start_a, count_a, start_b, count_b):
+    """ Expand pairs of cells into every pair of their members.
+
+    Args:
+        start_a, count_a (ndarray): First member and size of the first cells.
+        start_b, count_b (ndarray): First member and size of the second cells.
+
+    Returns:
+        tuple: (i, j) arrays of member indices."""
+
+    size = count_a*count_b
+    pair = numpy.repeat(numpy.arange(size.size), size)
+    rank = numpy.arange(size.sum())-numpy.repeat(numpy.cumsum(size)-size, size)
+
+    return (start_a[pair]+rank//count_b[pair],
+            start_b[pair]+rank%count_b[pair])
+
+def find_contacts(pos, radius, i, j):
+    """ Filter candidate pairs down to the spheres which overlap.
+
+    Returns:
+        tuple: (i, j, normal), with normal the unit vector from i to j."""
+
+    delta = pos[j]-pos[i]
+    dist2 = numpy.sum(delta**2, axis=1)
+    touching = (dist2 < (radius[i]+radius[j])**2) & (dist2 > 0.0)
+
+    i, j, delta = i[touching], j[touching], delta[touching]
+
+    return i, j, delta/numpy.sqrt(dist2[touching])[:, None]
+
+class HardSphereCollisions(object):
+    """ Inelastic hard sphere collisions between the particles of a bucket.
+
+    Overlapping pairs which are approaching exchange an impulse along the
+    line of centres. All contacts are resolved at once, with optional
+    further sweeps for particles in several contacts. Particles on other
+    processors are not seen, so in parallel contacts across partition
+    boundaries are missed."""
+
+    def __init__(self, restitution=0.9, cell_size=None, iterations=1):
+        """ Set up the collision model.
+
+        Args:
+            restitution (float): Coefficient of restitution.
+            cell_size (float): Spatial hash cell width. Defaults to the
+            largest particle diameter.
+            iterations (int): Number of sweeps over the contacts."""
+
+        self.restitution = restitution
+        self.cell_size = cell_size
+        self.iterations = iterations
+        self.grid = SpatialHash()
+        self.count = 0
+
+    def __call__(self, bucket):
+        """ Apply the collision stage to a bucket.
+
+        Returns the number of pairs which collided."""
+
+        particles = bucket.particles
+        if len(particles) < 2:
+            return 0
+
+        pos = numpy.array([par.pos for par in particles], float).reshape((-1, 3))
+        vel = numpy.array([par.vel for par in particles], float).reshape((-1, 3))
+        radius = 0.5*numpy.array([par.parameters.diameter for par in particles], float)
+        mass = numpy.array([par.parameters.get_mass() for par in particles], float)
+
+        if not radius.max() > 0.0:
+            return 0
+
+        self.grid.update(pos, self.cell_size or 2.0*radius.max())
+        i, j, normal = find_contacts(pos, radius, *self.grid.pairs())
+
+        if not i.size:
+            return 0
+
+        new_vel, hit = self.resolve(vel, mass, i, j, normal)
+        i, j = i[hit], j[hit]
+
+        for k in numpy.unique(numpy.concatenate((i, j))):
+            particles[k].vel = new_vel[k]
+            # the velocity history no longer applies
+            particles[k]._old = []
+
+        self.count += i.size
+        logger.debug('%d particle-particle collisions', i.size)
+
+        return i.size
+
+    def resolve(self, vel, mass, i, j, normal):
+        """ Calculate the velocities after the impulses of a set of contacts.
+
+        Returns:
+            tuple: (velocities, mask of the contacts which exchanged an impulse)"""
+
+        vel = vel.copy()
+        hit = numpy.zeros(i.size, bool)
+        inverse_mass = 1.0/(1.0/mass[i]+1.0/mass[j])
+
+        for _ in range(self.iterations):
+            speed = numpy.sum((vel[j]-vel[i])*normal, axis=1)
+            approaching = speed < 0.0
+            if not numpy.any(approaching):
+                break
+            hit |= approaching
+            impulse = numpy.where(approaching,
+                                  -(1.0+self.restitution)*speed*inverse_mass, 0.0)
+            impulse = impulse[:, None]*normal
+            vel -= SolidInteractions.deposit(i, impulse/mass[i, None], len(vel))
+            vel += SolidInteractions.deposit(j, impulse/mass[j, None], len(vel))
+
+        return vel, hit
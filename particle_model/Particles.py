@@ -1,7 +1,7 @@
 """ Baseline module for the package. Contains the main classes, particle and particle_bucket. """
 
 # standard imports
-import itertools
+import os.path
 import copy
 
 import numpy
@@ -21,6 +21,16 @@ from particle_model import vtk_extras
 LEVEL = 0
 ZERO = numpy.zeros(3)
 
+# packed particle layout: pos, vel, time, delta_t, diameter, rho, drag_impulse
+STATE_WIDTH = 13
+# history levels are (velocity, force, time)
+HISTORY_LAYOUT = (3, 3, 1)
+MAX_HISTORY = 2
+# particles advanced between checks on pending parallel communication
+PROGRESS_INTERVAL = 64
+# version number of the binary checkpoint format
+CHECKPOINT_VERSION = 2
+
 class Particle(ParticleBase.ParticleBase):
     """Class representing a single Lagrangian particle with mass"""
 
@@ -30,12 +40,14 @@ class Particle(ParticleBase.ParticleBase):
 
         super(Particle, self).__init__(*data, **kwargs)
 
-        self.collisions = []
+        self.collision_log = None
         self.parameters = parameters
         self.pure_lagrangian = self.parameters.pure_lagrangian()
         self.system = system
         self.solid_pressure_gradient = numpy.zeros(3)
         self.volume = self.parameters.get_volume()
+        self.drag_impulse = numpy.zeros(3)
+        self.drag_acceleration = ZERO
 
         self.pos_callbacks = kwargs.get('pos_callbacks', [])
         self.vel_callbacks = kwargs.get('vel_callbacks', [])
@@ -49,6 +61,14 @@ class Particle(ParticleBase.ParticleBase):
                                                           self.parameters,
                                                           self.system)
 
+    @property
+    def collisions(self):
+        """ List the wall collisions recorded for this particle."""
+        if self.collision_log is None:
+            return []
+        #otherwise
+        return self.collision_log.for_particle(hash(self))
+
     def copy(self):
         """ Create a (mixed) copy of the particle."""
         par = Particle((self.pos, self.vel, self.time, self.delta_t),
@@ -73,7 +93,15 @@ class Particle(ParticleBase.ParticleBase):
             self.pos = col.pos+1.0e-10*col.info.normal
             self.time += col.delta_t
             col.info.time = self.time
-            self.collisions += [col.info]
+            if self.collision_log is None:
+                self.collision_log = Collision.CollisionLog()
+            self.collision_log.append(col.info, hash(self),
+                                      self.parameters.material_name)
+            boundary = self.system.boundary
+            boundary.wear.add(boundary.nearest_node(col.info.cell, col.pos),
+                              col.info.get_wear(boundary.wear.material,
+                                                boundary.get_surface_id(col.info.cell)),
+                              self.time)
             self._old = []
             self.update(self.delta_t-col.delta_t, method)
         except Collision.OutletException as col:
@@ -137,6 +165,8 @@ class Particle(ParticleBase.ParticleBase):
             grad_p = numpy.zeros(3)
             drag_force = 0.0
 
+        self.drag_acceleration = drag_force/self.parameters.rho
+
 #        try:
         return (-1.0*grad_p / self.parameters.rho
                 + drag_force/ self.parameters.rho
@@ -261,7 +291,7 @@ class Particle(ParticleBase.ParticleBase):
         if intersect and cell_index >= 0:
             surface_id = self.system.boundary.get_surface_id(cell_index)
             if surface_id is not None:
-                if surface_id in self.system.boundary.mapped_ids:
+                if self.system.boundary.mapped_faces[cell_index]:
                     pos_o, vel_o = self.system.boundary.mapped_ids[surface_id](pos_i, vel_0)
 
                     pos_f = pos_o+(1.0-t_val)*delta_t*vel_o
@@ -278,7 +308,7 @@ class Particle(ParticleBase.ParticleBase):
                     par_col.time = self.time + t_val * delta_t
 
                     return pos_f, vel_i
-                elif surface_id in self.system.boundary.outlet_ids: 
+                elif self.system.boundary.outlet_faces[cell_index]:
                     raise Collision.OutletException(pos_1, vel_0)
                 else:
                     # This is a "reflecting" boundary.
@@ -316,12 +346,11 @@ class Particle(ParticleBase.ParticleBase):
         intersect, pos_i, t_val, cell_index, pcoords = self.system.boundary.test_intersection(pos_0, pos_1)
 
         if intersect and cell_index >= 0:
-            surface_id = self.system.boundary.get_surface_id(cell_index)
-            if surface_id is not None:
-                if surface_id in self.system.boundary.outlet_ids:
-                    raise Collision.OutletException(pos_1, vel_1)
-                elif surface_id in self.system.boundary.mapped_ids:
-                    raise Collision.MappedBoundaryException(self.system.boundary.mapped_ids[surface_id])
+            boundary = self.system.boundary
+            if boundary.outlet_faces[cell_index]:
+                raise Collision.OutletException(pos_1, vel_1)
+            elif boundary.mapped_faces[cell_index]:
+                raise Collision.MappedBoundaryException(boundary.mapped_ids[boundary.get_surface_id(cell_index)])
             #otherwise
             raise Collision.CollisionException(self, pos_i, cell_index,
                                                t_val*delta_t)
@@ -338,7 +367,212 @@ class Particle(ParticleBase.ParticleBase):
         c_d, fvel = self.drag_coefficient(pos, vel_1, time)
         if fvel is None:
             return vel_1/(1.0+delta_t*c_d)
-        return (vel_1+delta_t*c_d*fvel)/(1.0+delta_t*c_d)
+        vel = (vel_1+delta_t*c_d*fvel)/(1.0+delta_t*c_d)
+        self.add_drag_impulse(c_d, fvel, vel, delta_t)
+        return vel
+
+    def add_explicit_drag(self, drag, delta_t):
+        """ Record the momentum given to the particle by explicit drag.
+
+        Args:
+            drag (ndarray): Drag acceleration, averaged over the step.
+            delta_t (float): Length of the step."""
+
+        self.drag_impulse = (self.drag_impulse
+                             +self.parameters.get_mass()*delta_t*drag)
+
+    def add_drag_impulse(self, c_d, fluid_velocity, velocity, delta_t):
+        """ Record the momentum given to the particle by implicit drag.
+
+        Args:
+            c_d (float): Drag coefficient, per unit particle mass.
+            fluid_velocity (ndarray): Fluid velocity.
+            velocity (ndarray): Particle velocity at the end of the step.
+            delta_t (float): Length of the step."""
+
+        if fluid_velocity is None:
+            return
+        self.drag_impulse = (self.drag_impulse
+                             +self.parameters.get_mass()*delta_t*c_d*(fluid_velocity-velocity))
+
+def get_field_sizes(particle_list):
+    """ Get the number of values stored in each particle field."""
+    sizes = {}
+    for par in particle_list:
+        for name, value in par.fields.items():
+            sizes[name] = max(sizes.get(name, 0), numpy.size(value))
+    return sizes
+
+def _species_index(parameters, species):
+    """ Find the species of a particle from its material name."""
+    for k, _ in enumerate(species):
+        if _.material_name == parameters.material_name:
+            return k
+    #otherwise
+    return 0
+
+def pack_particles(particle_list, species=None, field_sizes=None):
+    """ Pack particle state into contiguous arrays for communication.
+
+    Args:
+        particle_list (list): Particles to pack.
+        species (list): PhysicalParticle of each particle species.
+        field_sizes (dict): Number of values in each field to pack.
+
+    Returns a float array with one row per particle holding position,
+    velocity, time, timestep, diameter, density, drag impulse, history
+    and fields, and
+    an integer array holding the particle id, species index and number of
+    history levels."""
+
+    species = species or []
+    field_sizes = field_sizes or {}
+    names = sorted(field_sizes)
+    history_width = sum(HISTORY_LAYOUT)
+    width = (STATE_WIDTH+MAX_HISTORY*history_width
+             +sum(field_sizes[name] for name in names))
+
+    fdata = numpy.full((len(particle_list), width), numpy.nan)
+    idata = numpy.zeros((len(particle_list), 3), numpy.int64)
+
+    for k, par in enumerate(particle_list):
+        row = fdata[k]
+        row[0:3] = par.pos
+        row[3:6] = par.vel
+        row[6:10] = (par.time, par.delta_t,
+                     par.parameters.diameter, par.parameters.rho)
+        row[10:STATE_WIDTH] = par.drag_impulse
+        idata[k, 0] = hash(par)
+        idata[k, 1] = _species_index(par.parameters, species)
+        idata[k, 2] = min(len(par._old), MAX_HISTORY)
+        col = STATE_WIDTH
+        for level in par._old[:MAX_HISTORY]:
+            row[col:col+history_width] = numpy.hstack([numpy.ravel(_)
+                                                       for _ in level])
+            col += history_width
+        col = STATE_WIDTH+MAX_HISTORY*history_width
+        for name in names:
+            if name in par.fields:
+                value = numpy.ravel(par.fields[name])
+                row[col:col+value.size] = value
+            col += field_sizes[name]
+
+    return fdata, idata
+
+def unpack_particles(fdata, idata, system, species=None, field_sizes=None):
+    """ Rebuild particles from arrays made by pack_particles."""
+
+    species = species or [ParticleBase.PhysicalParticle()]
+    field_sizes = field_sizes or {}
+    names = sorted(field_sizes)
+    history_width = sum(HISTORY_LAYOUT)
+
+    out = []
+    for row, (phash, index, nold) in zip(fdata, idata):
+        parameters = species[index]
+        if (parameters.diameter != row[8]
+                or parameters.rho != row[9]):
+            parameters = copy.copy(parameters)
+            parameters.diameter = row[8]
+            parameters.rho = row[9]
+        par = Particle((row[0:3].copy(), row[3:6].copy(), row[6], row[7]),
+                       parameters=parameters, system=system,
+                       phash=int(phash))
+        par.drag_impulse = row[10:STATE_WIDTH].copy()
+        col = STATE_WIDTH
+        for _ in range(nold):
+            level = row[col:col+history_width]
+            par._old.append((level[0:3].copy(), level[3:6].copy(),
+                             level[6]))
+            col += history_width
+        col = STATE_WIDTH+MAX_HISTORY*history_width
+        for name in names:
+            value = row[col:col+field_sizes[name]]
+            col += field_sizes[name]
+            if numpy.isnan(value).all():
+                continue
+            par.fields[name] = value[0] if value.size == 1 else value.copy()
+        out.append(par)
+
+    return out
+
+def checkpoint_filename(filename):
+    """ Get the name of this process's checkpoint file.
+
+    In parallel each process writes its own file, numbered by rank."""
+    if Parallel.is_parallel():
+        base, ext = os.path.splitext(filename)
+        return '%s_%d%s'%(base, Parallel.get_rank(), ext)
+    #otherwise
+    return filename
+
+def read_checkpoint(filename, system=System.System(),
+                    parameters=ParticleBase.PhysicalParticle(), **kwargs):
+    """ Restart a particle bucket from a binary checkpoint file.
+
+    Args:
+        filename (str): File written by ParticleBucket.write_checkpoint.
+        system (System): The system containing the particles.
+        parameters (PhysicalParticle): Particle species of the bucket.
+
+    Any other keyword arguments are passed to ParticleBucket. In parallel
+    the same number of processes must be used as wrote the checkpoint."""
+
+    global LEVEL
+
+    with open(checkpoint_filename(filename), 'rb') as infile:
+        data = dict(numpy.load(infile).items())
+
+    if int(data['version']) == 1:
+        # version 1 checkpoints predate the packed drag impulse
+        for group in ('particles', 'dead_particles', 'stuck_particles'):
+            data[group+'_fdata'] = numpy.insert(data[group+'_fdata'], [10]*3,
+                                                0.0, axis=1)
+    elif int(data['version']) != CHECKPOINT_VERSION:
+        raise ValueError('Unsupported checkpoint version %d'%data['version'])
+
+    names = [str(_) for _ in data['field_names']]
+    field_sizes = dict(zip(names, (int(_) for _ in data['field_sizes'])))
+
+    if hasattr(system.temporal_cache, 'window') and data['cache_window'].size:
+        system.temporal_cache.range(*data['cache_window'])
+
+    bucket = ParticleBucket(numpy.zeros((0, 3)), numpy.zeros((0, 3)),
+                            float(data['time']), float(data['delta_t']),
+                            parameters=parameters, system=system, **kwargs)
+
+    for group in ('particles', 'dead_particles', 'stuck_particles'):
+        particles = unpack_particles(data[group+'_fdata'], data[group+'_idata'],
+                                     system, [parameters], field_sizes)
+        for par, exited in zip(particles, data[group+'_exited']):
+            par.collision_log = bucket.collision_log
+            if exited:
+                par.exited = True
+        setattr(bucket, group, particles)
+
+    bucket.set_solid_pressure_gradient(data['solid_pressure_gradient'])
+
+    bucket.collision_log.extend(dict((name, data['collision_'+name])
+                                     for name, _, _ in Collision.CollisionLog.COLUMNS),
+                                [str(_) for _ in data['collision_species_names']])
+    if system.boundary and 'wear_total' in data:
+        wear = system.boundary.wear
+        wear.bin_width = float(data['wear_bin_width']) or None
+        wear.max_bins = int(data['wear_max_bins']) or None
+        if len(wear.total) == len(data['wear_total']):
+            wear.set_state({'total': data['wear_total'],
+                            'keys': data['wear_keys'],
+                            'bins': data['wear_bins']})
+        else:
+            logger.warning('Boundary mesh differs from checkpoint, wear data discarded')
+
+    state = numpy.random.get_state()
+    numpy.random.set_state((state[0], data['random_keys'], int(data['random_pos']),
+                            int(data['random_gauss'][0]), float(data['random_gauss'][1])))
+    Parallel.ParticleId.update_counter(int(data['next_id'])-1)
+    LEVEL = int(data['level'])
+
+    return bucket
 
 class ParticleBucket(object):
     """Class for a container for multiple Lagrangian particles."""
@@ -346,12 +580,21 @@ class ParticleBucket(object):
     def __init__(self, X, V, time=0, delta_t=1.0e-3,
                  parameters=ParticleBase.PhysicalParticle(),
                  system=System.System(),
-                 field_data=None, online=True, **kwargs):
+                 field_data=None, online=True, load_balance=False,
+                 owned_insertion=False, particle_collisions=None, **kwargs):
         """Initialize the bucket
 
         Args:
             X (float): Initial particle positions.
             V (float): Initial velocities
+            load_balance (bool): In parallel, share particles evenly between
+            processors rather than by mesh partition. Requires every
+            processor to hold the whole mesh, as in offline runs.
+            owned_insertion (bool): In parallel, have each processor insert
+            particles only through the inlet faces it owns.
+            particle_collisions (callable): Optional particle-particle
+            collision stage, such as a ParticleCollisions.HardSphereCollisions,
+            applied to the bucket after each step.
         """
 
         logger.info("Initializing ParticleBucket")
@@ -369,11 +612,13 @@ class ParticleBucket(object):
         self.dead_particles = []
         self.stuck_particles = []
         self.parameters = parameters
+        self.collision_log = Collision.CollisionLog()
         for _, (dummy_pos, dummy_vel) in enumerate(zip(X, V)):
             par = Particle((dummy_pos, dummy_vel, time, delta_t),
                            system=self.system,
                            parameters=parameters.randomize(),
                            **kwargs)
+            par.collision_log = self.collision_log
             if par.pure_lagrangian:
                 par.vel = par.picker(par.pos, time)[0]
             for name, value in field_data.items():
@@ -387,6 +632,13 @@ class ParticleBucket(object):
         self.time = time
         self.delta_t = delta_t
         self._online = online
+        self.load_balance = load_balance
+        self.owned_insertion = owned_insertion
+        self.particle_collisions = particle_collisions
+        # later changes of timestep are handled by the wear windows
+        # being prorated, so the first delta_t is only a default
+        if self.system.boundary and self.system.boundary.wear.bin_width is None:
+            self.system.boundary.wear.bin_width = delta_t
         self.solid_pressure_gradient = numpy.zeros((len(self.particles), 3))
         for particle, gsp in zip(self, self.solid_pressure_gradient):
             particle.solid_pressure_gradient = gsp
@@ -435,20 +687,50 @@ class ParticleBucket(object):
 
     @profile
     def update(self, delta_t=None, *args, **kwargs):
-        """ Update all the particles in the bucket to the next time level."""
+        """ Update all the particles in the bucket to the next time level.
+
+        In parallel, particles owned elsewhere are sent with a non-blocking
+        exchange while the remaining particles are advanced."""
 
         logger.info("In ParticleBucket.Update: %d particles", len(self.particles))
 
-        # redistribute particles to partitions in case of parallel adaptivity
-        if Parallel.is_parallel():
-            self.redistribute()
         # reset the particle timestep
         if delta_t is not None:
             self.delta_t = delta_t
         self.system.temporal_cache.range(self.time, self.time + self.delta_t)
-        live = self.system.in_system(self.pos(), len(self), self.time)
+        # redistribute particles to partitions in case of parallel adaptivity
+        exchange = self.start_redistribute()
+        _ = self._step_particles(list(self.particles), exchange,
+                                 *args, **kwargs)
+        if exchange:
+            received = self.finish_redistribute(exchange)
+            self.particles.extend(received)
+            _ += self._step_particles(received, None, *args, **kwargs)
+        removed = set(id(part) for part in _)
+        self.particles = [part for part in self.particles
+                          if id(part) not in removed]
+        if self.particle_collisions is not None:
+            self.particle_collisions(self)
+        exchange = self.start_redistribute()
+        self.insert_particles(*args, **kwargs)
+        if exchange:
+            self.particles.extend(self.finish_redistribute(exchange))
+        self.time += self.delta_t
+        for part in self:
+            part.time = self.time
+
+    def _step_particles(self, particles, exchange, *args, **kwargs):
+        """ Advance a list of particles, returning those which have left.
+
+        Any pending particle exchange is progressed as the work is done."""
+
+        live = self.system.in_system([part.pos for part in particles],
+                                     len(particles), self.time)
         _ = []
-        for k, part in enumerate(self):
+        for k, part in enumerate(particles):
+            if exchange and not k % PROGRESS_INTERVAL:
+                exchange.progress()
+            part.collision_log = self.collision_log
             if live[k] and not hasattr(part, "exited"):
                 try: 
                 #if particle updates fails e.g. max recursion depth reached
@@ -460,43 +742,81 @@ class ParticleBucket(object):
             else:
                 self.dead_particles.append(part)
                 _.append(part)
-        for part in _:
-            self.particles.remove(part)
-        self.redistribute()
-        self.insert_particles(*args, **kwargs)
-        self.time += self.delta_t
-        for part in self:
-            part.time = self.time
+        return _
 
     def redistribute(self):
         """ In parallel, redistrbute particles to their owner process."""
-        if self._online and Parallel.is_parallel():
-            logger.debug("%d particles before redistribution", len(self.particles))
+        if not Parallel.is_parallel():
+            return
+        logger.debug("%d particles before redistribution", len(self.particles))
+        if self.load_balance:
+            self.particles = Parallel.balance_particles(self.particles,
+                                                        self.system,
+                                                        self.time,
+                                                        species=[self.parameters])
+        elif self._online:
             self.particles = Parallel.distribute_particles(self.particles,
-                                                           self.system)
-
-            logger.debug("%d particles after redistribution", len(self))
+                                                           self.system,
+                                                           self.time,
+                                                           species=[self.parameters])
+        for par in self.particles:
+            par.collision_log = self.collision_log
+
+        logger.debug("%d particles after redistribution", len(self))
+
+    def start_redistribute(self):
+        """ Start sending particles owned elsewhere to their owner process.
+
+        Returns a Parallel.ParticleExchange to be completed by
+        finish_redistribute, or None if there is nothing to complete."""
+        if not Parallel.is_parallel():
+            return None
+        if self.load_balance or not self._online:
+            self.redistribute()
+            return None
+        #otherwise
+        self.particles, plist, destinations = Parallel.route_particles(self.particles,
+                                                                       self.system,
+                                                                       self.time)
+        return Parallel.ParticleExchange(plist, destinations, self.system,
+                                         [self.parameters])
+
+    def finish_redistribute(self, exchange):
+        """ Complete a particle exchange, returning the particles now owned here."""
+        received = Parallel.accept_particles(exchange.wait(), self.system,
+                                             self.time)
+        for par in received:
+            par.collision_log = self.collision_log
+        return received
 
     def insert_particles(self, *args, **kwargs):
         """Deal with particle insertion"""
 
         for inlet in self.system.boundary.inlets:
-            if Parallel.is_parallel():
+            if Parallel.is_parallel() and self.owned_insertion:
+                # each process samples its share of the poisson series
+                # over the inlet faces it owns
+                data = self.system.temporal_cache(self.time)[0][0]
+                owners = self.system.boundary.get_face_owners(data[2], data[3])
+                weights = inlet.cum_weight(self.time+0.5*self.delta_t,
+                                           self.system.boundary.bnd,
+                                           self.system.temporal_cache,
+                                           numpy.flatnonzero(owners == Parallel.get_rank()))
+                local_weight = weights[-1][-1] if weights else 0.0
+                total_weight = Parallel.allreduce(local_weight)
+                if total_weight <= 0.0:
+                    continue
                 n_par = inlet.get_number_of_insertions(self.time,
-                                                       self.delta_t)
-#                if Parallel.get_rank() == 0:
-#                    n_par_0 = inlet.get_number_of_insertions(self.time,
-#                                                           self.delta_t)
-#                    for i in range(n_par_0):
-#                        prob = numpy.random.random()
+                                                       self.delta_t,
+                                                       local_weight/total_weight)
             else:
                 n_par = inlet.get_number_of_insertions(self.time,
                                                        self.delta_t)
-            if n_par == 0:
-                continue
-            weights = inlet.cum_weight(self.time+0.5*self.delta_t,
-                                       self.system.boundary.bnd,
-                                       self.system.temporal_cache)
+                if n_par == 0:
+                    continue
+                weights = inlet.cum_weight(self.time+0.5*self.delta_t,
+                                           self.system.boundary.bnd,
+                                           self.system.temporal_cache)
             if weights:
                 for i in range(n_par):
                     prob = numpy.random.random()
@@ -526,13 +846,72 @@ class ParticleBucket(object):
                                    **inlet.kwargs)
 
                     par.delta_t = self.delta_t
+                    par.collision_log = self.collision_log
 
                     par.fields["InsertionTime"] = time
                     self.particles.append(par)
 
+    def write_checkpoint(self, filename):
+        """ Write the complete state of the bucket to a binary checkpoint file.
+
+        The file holds the live, dead and stuck particles with their ids,
+        timestepping history, fields and physical parameters, the collision
+        log, the boundary wear, the temporal cache window, the random number
+        generator state and the particle id counter, so that a bucket
+        restarted with read_checkpoint continues bitwise identically."""
+
+        groups = ('particles', 'dead_particles', 'stuck_particles')
+        field_sizes = get_field_sizes(self.particles+self.dead_particles
+                                      +self.stuck_particles)
+        names = sorted(field_sizes)
+
+        data = {'version': CHECKPOINT_VERSION,
+                'time': self.time,
+                'delta_t': self.delta_t,
+                'level': LEVEL,
+                'field_names': numpy.array(names, dtype=str),
+                'field_sizes': numpy.array([field_sizes[_] for _ in names], int),
+                'solid_pressure_gradient': numpy.asarray(self.solid_pressure_gradient,
+                                                         float).reshape((-1, 3))}
+
+        for group in groups:
+            particles = getattr(self, group)
+            data[group+'_fdata'], data[group+'_idata'] = pack_particles(particles,
+                                                                        [self.parameters],
+                                                                        field_sizes)
+            data[group+'_exited'] = numpy.array([hasattr(par, 'exited')
+                                                 for par in particles], bool)
+
+        for name, _, _ in Collision.CollisionLog.COLUMNS:
+            data['collision_'+name] = getattr(self.collision_log, name)
+        data['collision_species_names'] = numpy.array(self.collision_log.species_names,
+                                                      dtype=str)
+
+        if self.system.boundary:
+            wear = self.system.boundary.wear
+            for key, value in wear.get_state().items():
+                data['wear_'+key] = value
+            data['wear_bin_width'] = wear.bin_width or 0.0
+            data['wear_max_bins'] = wear.max_bins or 0
+
+        data['cache_window'] = numpy.array(getattr(self.system.temporal_cache,
+                                                   'window', ()), float)
+
+        state = numpy.random.get_state()
+        data['random_keys'] = state[1]
+        data['random_pos'] = state[2]
+        data['random_gauss'] = numpy.array(state[3:5], float)
+
+        next_id = Parallel.ParticleId.newid()
+        Parallel.ParticleId.update_counter(next_id-1)
+        data['next_id'] = next_id
+
+        with open(checkpoint_filename(filename), 'wb') as outfile:
+            numpy.savez(outfile, **data)
+
     def collisions(self):
-        """Collect all collisions felt by particles in the bucket"""
-        return [i for i in itertools.chain(*[p.collisions for p in self.particles+self.dead_particles])]
+        """Columnar log of all collisions felt by particles in the bucket"""
+        return self.collision_log
 
     def set_solid_pressure_gradient(self, solid_pressure_gradient):
         self.solid_pressure_gradient = solid_pressure_gradient
@@ -541,9 +920,15 @@ class ParticleBucket(object):
 
     def run(self, time, delta_t=None, write=False, *args, **kwargs):
         """Drive particles forward until a given time."""
-        while time-self.time > 1.0e-6*(delta_t or self.delta_t):
-            self.update(delta_t, *args, **kwargs)
-            if write:
-                global LEVEL
-                IO.write_level_to_polydata(bucket=self, level=LEVEL, basename="dump.vtp")
-                LEVEL += 1
+        global LEVEL
+        writer = IO.AsyncWriter(pvd_index=True) if write else None
+        try:
+            while time-self.time > 1.0e-6*(delta_t or self.delta_t):
+                self.update(delta_t, *args, **kwargs)
+                if writer:
+                    writer.write_level_to_polydata(bucket=self, level=LEVEL,
+                                                   basename="dump.vtp")
+                    LEVEL += 1
+        finally:
+            if writer:
+                writer.close()
@@ -2,9 +2,10 @@
  temperature."""
 
 import numpy
+from scipy.spatial import cKDTree
 
 from particle_model import vtkParticlesPython
-from particle_model.Debug import logger
+from particle_model import Parallel
 
 import vtk
 from vtk.util import numpy_support
@@ -37,135 +38,188 @@ def distance2(pnt1, pnt2):
     """Get square of distance between two points."""
     return vtk.vtkMath().Distance2BetweenPoints(pnt1, pnt2)
 
+def neighbour_pairs(points, centres, radius):
+    """ Find every pair of a point and a centre closer than radius.
+
+    Args:
+        points (ndarray): (n, 3) array of points.
+        centres (ndarray): (m, 3) array of kernel centres.
+        radius (float): The kernel radius.
+
+    Returns:
+        ndarray: Index of the point in each pair.
+        ndarray: Index of the centre in each pair.
+        ndarray: Squared distance between the pair."""
+
+    points = numpy.asarray(points, float).reshape((-1, 3))
+    centres = numpy.asarray(centres, float).reshape((-1, 3))
+
+    if not (len(points) and len(centres)):
+        return numpy.zeros(0, int), numpy.zeros(0, int), numpy.zeros(0)
+
+    try:
+        pairs = cKDTree(points).sparse_distance_matrix(cKDTree(centres), radius,
+                                                       output_type='ndarray')
+        return pairs['i'], pairs['j'], pairs['v']**2
+    except TypeError:
+        # older scipy, without output_type
+        lists = cKDTree(points).query_ball_point(centres, radius)
+        counts = numpy.array([len(_) for _ in lists], int)
+        point = numpy.concatenate([numpy.asarray(_, int) for _ in lists]+[numpy.zeros(0, int)])
+        centre = numpy.repeat(numpy.arange(len(centres)), counts)
+        return point, centre, numpy.sum((points[point]-centres[centre])**2, axis=1)
+
+def deposit(index, weights, size):
+    """ Sum weights into bins given by index.
+
+    Args:
+        index (ndarray): Bin of each weight.
+        weights (ndarray): (n,) or (n, k) array of weights.
+        size (int): Number of bins.
+
+    Returns:
+        ndarray: (size,) or (size, k) array of sums."""
+
+    weights = numpy.asarray(weights, float)
+    if weights.ndim == 1:
+        return numpy.bincount(index, weights, minlength=size)
+    #otherwise
+    out = numpy.zeros((size, weights.shape[1]))
+    for _ in range(weights.shape[1]):
+        out[:, _] = numpy.bincount(index, weights[:, _], minlength=size)
+    return out
+
+def mean_value(total, weight, tol=1.0e-12):
+    """ Divide deposited totals by weights, where the weight is non-negligible."""
+    total = numpy.asarray(total, float)
+    out = numpy.zeros(total.shape)
+    mask = weight > tol
+    out[mask] = (total[mask].T/weight[mask]).T
+    return out
+
+def double_array(name, data):
+    """ Make a named vtkDoubleArray from an (n,) or (n, k) numpy array."""
+    data = numpy.ascontiguousarray(data, float)
+    _ = numpy_support.numpy_to_vtk(data.reshape((data.shape[0],
+                                                 int(numpy.prod(data.shape[1:])))), deep=1,
+                                   array_type=vtk.VTK_DOUBLE)
+    _.SetName(name)
+    return _
+
+def get_particle_data(bucket):
+    """ Get the positions, velocities, volumes and diameters of a bucket's particles."""
+    particles = list(bucket)
+    pos = numpy.array([par.pos for par in particles], float).reshape((-1, 3))
+    vel = numpy.array([par.vel for par in particles], float).reshape((-1, 3))
+    volume = numpy.array([par.volume for par in particles], float)
+    diameter = numpy.array([par.parameters.diameter for par in particles], float)
+    return pos, vel, volume, diameter
+
+GT_FILTER = None
+
+def get_granular_temperature_filter():
+    """Return the shared C++ granular temperature filter.
+
+    The filter keeps its point locator between calls, so one instance is
+    reused for the whole run."""
+
+    global GT_FILTER
+
+    if GT_FILTER is None:
+        GT_FILTER = vtkParticlesPython.vtkGranularTemperature()
+
+    return GT_FILTER
+
 def calculate_averaged_properties_cpp(poly_data):
-    """Calculate volume averaged values using C++."""
+    """Calculate volume averaged values using C++.
+
+    The averaged fields are written into the point data of poly_data."""
 
-    gt_filter = vtkParticlesPython.vtkGranularTemperature()
-    if vtk.vtkVersion.GetVTKMajorVersion() < 6:
-        gt_filter.SetInput(poly_data)
+    gt_filter = get_granular_temperature_filter()
+
+    if hasattr(gt_filter, 'Compute'):
+        gt_filter.Compute(poly_data)
     else:
-        gt_filter.SetInputData(poly_data)
-    gt_filter.Update()
-    poly_data.DeepCopy(gt_filter.GetOutput())
+        #older builds of the extension only run as a pipeline filter
+        if vtk.vtkVersion.GetVTKMajorVersion() < 6:
+            gt_filter.SetInput(poly_data)
+        else:
+            gt_filter.SetInputData(poly_data)
+        gt_filter.Update()
+        poly_data.DeepCopy(gt_filter.GetOutput())
 
-    return numpy_support.vtk_to_numpy(poly_data.GetPointData().GetVectors("SolidPressureGradient"))
+    return numpy_support.vtk_to_numpy(poly_data.GetPointData().GetArray("SolidPressureGradient"))
 
-def calculate_averaged_properties(poly_data, bucket):
+def calculate_averaged_properties(poly_data, bucket, pairs=None):
 
-    """ Calculate a volume fraction estimate at the level of the particles."""
+    """ Calculate a volume fraction estimate at the level of the particles.
 
-    locator = vtk.vtkPointLocator()
-    locator.SetDataSet(poly_data)
-    locator.BuildLocator()
+    Args:
+        poly_data (vtkPolyData): Particle positions, in bucket order.
+        bucket (ParticleBucket): The particles.
+        pairs (tuple): Neighbour list from neighbour_pairs, computed if not given.
+    """
 
     LENGTH = 0.03
     MODIFIER = 3e3
 
-    volume = numpy.zeros(poly_data.GetNumberOfPoints())
-    temperature = numpy.zeros(poly_data.GetNumberOfPoints())
-    solid_pressure = numpy.zeros(poly_data.GetNumberOfPoints())
-    velocity = numpy.zeros((poly_data.GetNumberOfPoints(), 3))
-    solid_pressure_gradient = numpy.zeros((poly_data.GetNumberOfPoints(), 3))
-
-    for particle in bucket:
-        point_list = vtk.vtkIdList()
-        locator.FindPointsWithinRadius(LENGTH, particle.pos, point_list)
-
-        beta = 1.0/6.0*numpy.pi*particle.parameters.diameter**3
-
-        for _ in range(point_list.GetNumberOfIds()):
-            point_index = point_list.GetId(_)
-
-            particle2 = bucket.particles[point_index]
-
-            rad2 = distance2(particle2.pos, particle.pos)
-            rad2 /= LENGTH**2
-
-            gamma = beta*numpy.exp(-rad2)*MODIFIER
-
-            volume[point_index] += gamma
-
-            velocity[point_index, :] += particle.vel*gamma
-
-    volume /= 0.5*LENGTH**2*(1.0-numpy.exp(-1.0**2))
-    velocity /= 0.5*LENGTH**2*(1.0-numpy.exp(-1.0**2))
-
-    for i in range(3):
-        velocity[:, i] /= volume
-
-    for k, particle in enumerate(bucket):
-        point_list = vtk.vtkIdList()
-        locator.FindPointsWithinRadius(LENGTH, particle.pos, point_list)
-
-        beta = 1.0/6.0*numpy.pi*particle.parameters.diameter**3
-
-        for _ in range(point_list.GetNumberOfIds()):
-            point_index = point_list.GetId(_)
-
-            rad2 = distance2(poly_data.GetPoints().GetPoint(point_index), particle.pos)
-            rad2 /= LENGTH**2
-
-            gamma = beta*numpy.exp(-rad2)*MODIFIER
-
-            c = distance2(particle.vel, velocity[k, :])
-
-            temperature[point_index] += c*gamma
-
-
-    for particle in bucket:
-        point_list = vtk.vtkIdList()
-        locator.FindPointsWithinRadius(LENGTH, particle.pos, point_list)
-
-        beta = 1.0/6.0*numpy.pi*particle.parameters.diameter**3
-
-        for _ in range(point_list.GetNumberOfIds()):
-            point_index = point_list.GetId(_)
-
-            rad2 = distance2(poly_data.GetPoints().GetPoint(point_index), particle.pos)
-            rad2 /= LENGTH **2
-
-            gamma = beta*numpy.exp(-rad2)*MODIFIER
-
-            c = distance2(particle.vel, velocity[point_index, :])
+    npts = poly_data.GetNumberOfPoints()
+    if npts:
+        points = numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData())
+    else:
+        points = numpy.zeros((0, 3))
+    pos, vel, _, diameter = get_particle_data(bucket)
 
-            val = (bucket.particles[point_index].pos-particle.pos)/LENGTH**2
+    # the neighbour list is shared by all three passes
+    if pairs is None:
+        pairs = neighbour_pairs(points, pos, LENGTH)
+    node, part, rad2 = pairs
+    rad2 = rad2/LENGTH**2
 
-            spg = ((radial_distribution_function(volume[point_index])
-                    +volume[point_index]*rdf_deriv(volume[point_index]))*temperature[point_index]
-                   +c*volume[point_index]*radial_distribution_function(volume[point_index]))
+    beta = 1.0/6.0*numpy.pi*diameter**3
+    gamma = beta[part]*numpy.exp(-rad2)*MODIFIER
 
-            solid_pressure_gradient[point_index, :] += (val*spg*gamma)
+    norm = 0.5*LENGTH**2*(1.0-numpy.exp(-1.0**2))
+    volume = deposit(node, gamma, npts)/norm
+    velocity = (deposit(node, gamma[:, None]*vel[part], npts).T/norm/volume).T
 
-    for _ in range(poly_data.GetNumberOfPoints()):
+    temperature = deposit(node, gamma*numpy.sum((vel[part]-velocity[part])**2, axis=1),
+                          npts)
 
-        solid_pressure[_] = (bucket.particles[0].parameters.rho*volume[_]
-                             *radial_distribution_function(volume[_])*temperature[_])
+    rdf = radial_distribution_function(volume)
+    spg = ((rdf+volume*rdf_deriv(volume))*temperature)[node]
+    spg += numpy.sum((vel[part]-velocity[node])**2, axis=1)*(volume*rdf)[node]
+    solid_pressure_gradient = deposit(node, ((points[node]-pos[part])/LENGTH**2)
+                                      *(spg*gamma)[:, None], npts)
 
-    data = [vtk.vtkDoubleArray()]
-    data[0].SetName('SolidVolumeFraction')
-    data.append(vtk.vtkDoubleArray())
-    data[1].SetName('SolidVolumeVelocity')
-    data[1].SetNumberOfComponents(3)
-    data.append(vtk.vtkDoubleArray())
-    data[2].SetName('GranularTemperature')
-    data.append(vtk.vtkDoubleArray())
-    data[3].SetName('SolidPressure')
-    data.append(vtk.vtkDoubleArray())
-    data[4].SetName('SolidPressureGradient')
-    data[4].SetNumberOfComponents(3)
+    solid_pressure = bucket.parameters.rho*volume*rdf*temperature
 
-    for _ in range(poly_data.GetNumberOfPoints()):
-        data[0].InsertNextValue(volume[_])
-        data[1].InsertNextTuple3(*velocity[_])
-        data[2].InsertNextValue(temperature[_])
-        data[3].InsertNextValue(solid_pressure[_])
-        data[4].InsertNextTuple3(*solid_pressure_gradient[_])
+    data = [double_array('SolidVolumeFraction', volume),
+            double_array('SolidVolumeVelocity', velocity),
+            double_array('GranularTemperature', temperature),
+            double_array('SolidPressure', solid_pressure),
+            double_array('SolidPressureGradient', solid_pressure_gradient)]
 
     for _ in data:
         poly_data.GetPointData().AddArray(_)
 
     return data[4]
 
+def cell_measures(grid):
+    """Get the measure (length, area or volume) of every cell of a grid."""
+
+    if hasattr(vtk, 'vtkCellSizeFilter'):
+        size_filter = vtk.vtkCellSizeFilter()
+        size_filter.ComputeVertexCountOff()
+        size_filter.SetInputData(grid)
+        size_filter.Update()
+        cell_data = size_filter.GetOutput().GetCellData()
+        return numpy.abs(sum(numpy_support.vtk_to_numpy(cell_data.GetArray(name))
+                             for name in ('Length', 'Area', 'Volume')))
+    #otherwise
+    return numpy.array([get_measure(grid.GetCell(_)) or 0.0
+                        for _ in range(grid.GetNumberOfCells())])
+
 def get_measure(cell):
     """Get the measure of a VTK cell."""
     if cell.GetCellType() == vtk.VTK_LINE:
@@ -183,99 +237,44 @@ def point_average(model, bucket):
     ugrid = vtk.vtkUnstructuredGrid()
     ugrid.DeepCopy(model)
 
-    locator = vtk.vtkPointLocator()
-    locator.SetDataSet(ugrid)
-    locator.BuildLocator()
-
     LENGTH = 0.05
 
-    volfrac = numpy.zeros(ugrid.GetNumberOfPoints())
-    volume = numpy.zeros(ugrid.GetNumberOfPoints())
-    cell_volume = numpy.zeros(ugrid.GetNumberOfPoints())
-    temperature = numpy.zeros(ugrid.GetNumberOfPoints())
-    solid_pressure = numpy.zeros(ugrid.GetNumberOfPoints())
-    velocity = numpy.zeros((ugrid.GetNumberOfPoints(), 3))
-
-    for _ in range(ugrid.GetNumberOfCells()):
-        cell = ugrid.GetCell(_)
-
-        loc_vol = get_measure(cell)/cell.GetNumberOfPoints()
+    npts = ugrid.GetNumberOfPoints()
+    points = numpy_support.vtk_to_numpy(ugrid.GetPoints().GetData())
+    pos, vel, part_volume, _ = get_particle_data(bucket)
 
-        for i in range(cell.GetNumberOfPoints()):
-            logger.info(cell.GetPointIds().GetId(i))
-            cell_volume[cell.GetPointIds().GetId(i)] += loc_vol
+    from particle_model.IO import get_cell_point_ids
+    ids = get_cell_point_ids(ugrid)
+    cell_npts = (ids >= 0).sum(axis=1)
+    cell_volume = numpy.bincount(ids[ids >= 0],
+                                 numpy.repeat(cell_measures(ugrid)/numpy.maximum(cell_npts, 1),
+                                              cell_npts),
+                                 minlength=npts)
 
-    for particle in bucket:
-        point_list = vtk.vtkIdList()
-        locator.FindPointsWithinRadius(LENGTH, particle.pos, point_list)
+    node, part, rad2 = neighbour_pairs(points, pos, LENGTH)
+    rad2 /= LENGTH**2
 
-        for _ in range(point_list.GetNumberOfIds()):
-            point_index = point_list.GetId(_)
-
-            rad2 = 0.0*distance2(ugrid.GetPoints().GetPoint(point_index), particle.pos)
-            rad2 /= LENGTH**2
-
-            gamma = particle.volume*numpy.exp(-rad2)
-
-            volume[point_index] += gamma
-            velocity[point_index, :] += particle.vel*gamma
-
-    for _ in range(ugrid.GetNumberOfPoints()):
-        if volume[_] > 1.0e-12:
-            velocity[_, :] /= volume[_]
+    # volume and momentum use a top hat kernel
+    volume = deposit(node, part_volume[part], npts)
+    velocity = mean_value(deposit(node, part_volume[part, None]*vel[part], npts),
+                          volume)
 
     volfrac = volume/cell_volume
 
-    for particle in bucket:
-        point_list = vtk.vtkIdList()
-        locator.FindPointsWithinRadius(LENGTH, particle.pos, point_list)
-
-        for _ in range(point_list.GetNumberOfIds()):
-            point_index = point_list.GetId(_)
-
-            rad2 = distance2(ugrid.GetPoints().GetPoint(point_index), particle.pos)
-            rad2 /= LENGTH**2
-
-            gamma = particle.volume*numpy.exp(-rad2)
+    gamma = part_volume[part]*numpy.exp(-rad2)
+    temperature = mean_value(deposit(node, gamma*numpy.sum((vel[part]-velocity[node])**2,
+                                                           axis=1), npts),
+                             volume)
 
-            c = distance2(particle.vel, velocity[point_index, :])
-
-            temperature[point_index] += c*gamma
-
-
-
-    for _ in range(ugrid.GetNumberOfPoints()):
-        if volume[_] > 1.0e-12:
-            temperature[_] /= volume[_]
-
-    solid_pressure = (bucket.particles[0].parameters.rho*volfrac
+    solid_pressure = (bucket.parameters.rho*volfrac
                       *radial_distribution_function(volfrac)*temperature)
 
-    data = [vtk.vtkDoubleArray()]
-    data[0].SetName('SolidVolumeFraction')
-    data.append(vtk.vtkDoubleArray())
-    data[1].SetName('SolidVolumeVelocity')
-    data[1].SetNumberOfComponents(3)
-    data.append(vtk.vtkDoubleArray())
-    data[2].SetName('GranularTemperature')
-    data.append(vtk.vtkDoubleArray())
-    data[3].SetName('SolidPressure')
-
-    for _ in range(ugrid.GetNumberOfPoints()):
-        data[0].InsertNextValue(cell_volume[_])
-        data[1].InsertNextTuple3(*(velocity[_]))
-        data[2].InsertNextValue(temperature[_])
-        data[3].InsertNextValue(solid_pressure[_])
-
-    pdata = vtk.vtkDoubleArray()
-    pdata.SetName('Time')
-
-    for _ in range(ugrid.GetNumberOfPoints()):
-        pdata.InsertNextValue(bucket.time)
-
-    for _ in data:
+    for _ in (double_array('SolidVolumeFraction', volfrac),
+              double_array('SolidVolumeVelocity', velocity),
+              double_array('GranularTemperature', temperature),
+              double_array('SolidPressure', solid_pressure),
+              double_array('Time', numpy.full(npts, bucket.time))):
         ugrid.GetPointData().AddArray(_)
-    ugrid.GetPointData().AddArray(pdata)
 
     return ugrid
 
@@ -289,53 +288,25 @@ def cell_average(model, bucket):
     locator.SetDataSet(ugrid)
     locator.BuildLocator()
 
-    volfrac = numpy.zeros(ugrid.GetNumberOfCells())
-    volume = numpy.zeros(ugrid.GetNumberOfCells())
-    temperature = numpy.zeros(ugrid.GetNumberOfCells())
-    velocity = numpy.zeros((ugrid.GetNumberOfCells(), 3))
-
-    for particle in bucket:
-        cell_id = locator.FindCell(particle.pos)
-        volume[cell_id] += particle.volume
-        velocity[cell_id, :] += particle.volume*particle.vel
-
-    for _ in range(ugrid.GetNumberOfCells()):
-        if volume[_] > 1.0e-12:
-            velocity[_, :] /= volume[_]
-        volfrac[_] = volume[_] / get_measure(ugrid.GetCell(_))
-
-    for particle in bucket:
-        cell_id = locator.FindCell(particle.pos)
-        temperature[cell_id] += particle.volume*distance2(particle.vel, velocity[cell_id, :])
-
-    for _ in range(ugrid.GetNumberOfCells()):
-        if volume[_] > 1.0e-12:
-            temperature[_] /= volume[_]
-
-    data = [vtk.vtkDoubleArray()]
-    data[0].SetName('SolidVolumeFraction')
-    data.append(vtk.vtkDoubleArray())
-    data[1].SetName('SolidVolumeVelocity')
-    data[1].SetNumberOfComponents(3)
-    data.append(vtk.vtkDoubleArray())
-    data[2].SetName('GranularTemperature')
-#    data.append(vtk.vtkDoubleArray())
-#    data[3].SetName('SolidPressure')
-
-    for _ in range(ugrid.GetNumberOfCells()):
-        data[0].InsertNextValue(volume[_])
-        data[1].InsertNextTuple3(*(velocity[_]))
-        data[2].InsertNextValue(temperature[_])
-#        data[3].InsertNextValue(solid_pressure[_])
-
-    pdata = vtk.vtkDoubleArray()
-    pdata.SetName('Time')
-
-    for _ in range(ugrid.GetNumberOfPoints()):
-        pdata.InsertNextValue(bucket.time)
+    ncells = ugrid.GetNumberOfCells()
+    pos, vel, part_volume, _ = get_particle_data(bucket)
 
-    for _ in data:
+    cell = Parallel.find_cell(ugrid, pos, locator)
+    found = cell >= 0
+    cell, vel, part_volume = cell[found], vel[found], part_volume[found]
+
+    volume = deposit(cell, part_volume, ncells)
+    velocity = mean_value(deposit(cell, part_volume[:, None]*vel, ncells), volume)
+    temperature = mean_value(deposit(cell, part_volume*numpy.sum((vel-velocity[cell])**2,
+                                                                 axis=1), ncells),
+                             volume)
+
+    for _ in (double_array('SolidVolumeFraction', volume),
+              double_array('SolidVolumeVelocity', velocity),
+              double_array('GranularTemperature', temperature)):
         ugrid.GetCellData().AddArray(_)
-    ugrid.GetPointData().AddArray(pdata)
+    ugrid.GetPointData().AddArray(double_array('Time',
+                                                    numpy.full(ugrid.GetNumberOfPoints(),
+                                                               bucket.time)))
 
     return ugrid
@@ -2,7 +2,6 @@
 
 from numpy import zeros, empty
 from numpy.linalg import norm
-import vtk
 
 from particle_model import TemporalCache
 from particle_model import Options
@@ -66,21 +65,11 @@ class System(object):
             out[:] = True
             return out
 
-        obj = self.temporal_cache(time)[0][0][2]
-        loc = self.temporal_cache(time)[0][0][3]
-
-        if (obj.IsA('vtkUnstructuredGrid') or 
-            obj.IsA('vtkStructuredGrid') or
-            obj.IsA('vtkRectilinearGrid')):
-            loc.SetDataSet(obj)
-        else:
-            loc.SetDataSet(obj.GetBlock(0))
-        loc.BuildLocator()
-
+        data = self.temporal_cache(time)[0][0]
 
-
-        for k, point in enumerate(points):
-            out[k] = loc.FindCell(point) > -1
+        # the locator held by the cache was built on the whole multiblock,
+        # so leave find_cell to use the one for the block it queries
+        out[:] = Parallel.find_cell(data[2], list(points)) > -1
 
         return out
 
@@ -89,25 +78,13 @@ class System(object):
 
         del rank
 
-        out = []
-
         if self.temporal_cache is None:
-            out[:] = True
-            return out
-
-        obj = self.temporal_cache(time)[0][0][2]
-        loc = vtk.vtkCellLocator()
+            return [True]*len(particle_list)
 
-        if obj.IsA('vtkUnstructuredGrid'):
-            loc.SetDataSet(obj)
-        else:
-            loc.SetDataSet(obj.GetBlock(0))
-        loc.BuildLocator()
+        data = self.temporal_cache(time)[0][0]
 
-        for par in particle_list:
-            out.append(loc.FindCell(par.pos) > -1)
-
-        return out
+        return list(Parallel.find_cell(data[2],
+                                       [par.pos for par in particle_list]) > -1)
 
     def update_boundary_from_mesh(self, mesh):
         """Update boundary object from mesh."""
@@ -130,6 +107,7 @@ def get_system_from_options(options_file=None, boundary_grid=None,
     """Derive particle system from options file."""
 
     reader = Options.OptionsReader(options_file)
+    IO.set_writer_options(**reader.get_writer_options())
 
     if boundary_grid is None:
 
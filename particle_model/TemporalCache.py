@@ -107,6 +107,7 @@ class TemporalCache(object):
         """
 
         self.data = []
+        self.window = (t_min, t_max)
         self.set_field_names(**kwargs)
         self.reset()
 
@@ -162,6 +163,7 @@ class TemporalCache(object):
         """ Specify a range of data to keep open."""
         if not self.data:
             raise ValueError
+        self.window = (t_min, t_max)
         if self.data[self.lower][0] > t_min:
             self.reset()
         while (self.lower < len(self.data)-2
@@ -40,6 +40,7 @@ def update_euler(self, delta_t=None):
         vel = self.vel+col.delta_t*kap[1]
         C, fvel = self.drag_coefficient(col.pos, vel, self.time+col.delta_t, nearest = True)
         col.vel = (self.vel+col.delta_t*(kap[1]+C*fvel))/(1.0+col.delta_t*C)
+        self.add_drag_impulse(C, fvel, col.vel, col.delta_t)
         raise col
         
     self.time += delta_t
@@ -80,6 +81,7 @@ def update_ab2(self, delta_t=None):
             vel = self.vel+col.delta_t*(1+beta)*kap[1]-beta*self.get_old(0, 1)
             C, fvel = self.drag_coefficient(col.pos, vel, self.time+col.delta_t, nearest=True)
             col.vel = (self.vel+col.delta_t*(kap[1]+C*fvel))/(1.0+col.delta_t*C)
+            self.add_drag_impulse(C, fvel, col.vel, col.delta_t)
             raise col
 
         self.time += delta_t
@@ -132,6 +134,7 @@ def update_ab3(self, delta_t=None):
             vel = self.vel+(col.delta_t-beta-gamma)*kap[1]+beta*self.get_old(0, 1)+gamma*self.get_old(0, 1)
             C, fvel = self.drag_coefficient(col.pos, vel, self.time+col.delta_t, nearest=True)
             col.vel = (self.vel+col.delta_t*(kap[1]+C*fvel))/(1.0+col.delta_t*C)
+            self.add_drag_impulse(C, fvel, col.vel, col.delta_t)
             raise col
 
         self.set_old(kap, 2)
@@ -191,6 +194,7 @@ def update_apc11(self, delta_t=None):
         vel = self.vel+col.delta_t*kap[1]
         C, fvel = self.drag_coefficient(col.pos, vel, self.time+col.delta_t, nearest = True)
         col.vel = (self.vel+col.delta_t*(kap[1]+C*fvel))/(1.0+col.delta_t*C)
+        self.add_drag_impulse(C, fvel, col.vel, col.delta_t)
         raise col
         
     self.time += delta_t
@@ -242,6 +246,7 @@ def update_apc22(self, delta_t=None):
             vel = self.vel+col.delta_t*(1+beta)*kap[1]-beta*self.get_old(0, 1)
             C, fvel = self.drag_coefficient(col.pos, vel, self.time+col.delta_t, nearest=True)
             col.vel = (self.vel+col.delta_t*(kap[1]+C*fvel))/(1.0+col.delta_t*C)
+            self.add_drag_impulse(C, fvel, col.vel, col.delta_t)
             raise col
 
         self.time += delta_t
@@ -296,6 +301,7 @@ def update_apc12(self, delta_t=None):
         vel = self.vel+col.delta_t*kap[1]
         C, fvel = self.drag_coefficient(col.pos, vel, self.time+col.delta_t, nearest = True)
         col.vel = (self.vel+col.delta_t*(kap[1]+C*fvel))/(1.0+col.delta_t*C)
+        self.add_drag_impulse(C, fvel, col.vel, col.delta_t)
         raise col
         
     self.time += delta_t
@@ -351,6 +357,7 @@ def update_apc23(self, delta_t=None):
             vel = self.vel+col.delta_t*(1+beta)*kap[1]-beta*self.get_old(0, 1)
             C, fvel = self.drag_coefficient(col.pos, vel, self.time+col.delta_t, nearest=True)
             col.vel = (self.vel+col.delta_t*(kap[1]+C*fvel))/(1.0+col.delta_t*C)
+            self.add_drag_impulse(C, fvel, col.vel, col.delta_t)
             raise col
 
         self.time += delta_t
@@ -376,6 +383,7 @@ def update_rk4(self, delta_t=None):
         kap1 = (self.vel, self.force(self.pos,
                                      self.vel,
                                      self.time))
+        drag = [self.drag_acceleration]
 
         pos = self.pos+0.5*delta_t*kap1[0]
         vel = self.vel+0.5*delta_t*kap1[1]
@@ -385,6 +393,7 @@ def update_rk4(self, delta_t=None):
 
         kap2 = (self.vel + 0.5*delta_t*kap1[1],
                 self.force(pos, vel, self.time + 0.5*delta_t))
+        drag.append(self.drag_acceleration)
 
         pos = self.pos+0.5*delta_t*kap2[0]
         vel = self.vel+0.5*delta_t*kap2[1]
@@ -395,6 +404,7 @@ def update_rk4(self, delta_t=None):
 
         kap3 = (self.vel+0.5*delta_t*kap2[1],
                 self.force(pos, vel, self.time+0.5*delta_t))
+        drag.append(self.drag_acceleration)
 
         pos = self.pos+0.5*delta_t*kap3[0]
         vel = self.vel+0.5*delta_t*kap3[1]
@@ -405,6 +415,7 @@ def update_rk4(self, delta_t=None):
 
         kap4 = (self.vel + delta_t * kap3[1],
                 self.force(pos, vel, self.time + delta_t))
+        drag.append(self.drag_acceleration)
 
         pos = self.pos+delta_t*(kap1[0]+2.0*kap2[0]+2.0*kap3[0]+kap4[0])/6.0
         vel = self.vel+delta_t*(kap1[1]+2.0*kap2[1]+2.0*kap3[1]+kap4[1])/6.0
@@ -414,6 +425,8 @@ def update_rk4(self, delta_t=None):
 
         self.pos = pos
         self.vel = vel
+        self.add_explicit_drag((drag[0]+2.0*drag[1]+2.0*drag[2]+drag[3])/6.0,
+                               delta_t)
 
     except Collision.CollisionException as col:
         col.vel = self.vel+col.delta_t*kap1[0]
@@ -433,6 +446,7 @@ def update_rk2(self, delta_t=None):
         kap1 = (self.vel, self.force(self.pos,
                                      self.vel,
                                      self.time))
+        drag = [self.drag_acceleration]
 
         pos = self.pos+0.5*delta_t*kap1[0]
         vel = self.vel+0.5*delta_t*kap1[1]
@@ -441,6 +455,7 @@ def update_rk2(self, delta_t=None):
                                   0.5*delta_t, drag=False)
 
         kap2 = (vel, self.force(pos, vel, self.time+0.5*delta_t))
+        drag.append(self.drag_acceleration)
 
         pos = self.pos+delta_t*kap2[0]
         vel = self.vel+delta_t*kap2[1]
@@ -450,6 +465,7 @@ def update_rk2(self, delta_t=None):
 
         self.pos = pos
         self.vel = vel
+        self.add_explicit_drag(drag[1], delta_t)
 
     except Collision.CollisionException as col:
         col.vel = self.vel+col.delta_t*kap1[0]
@@ -469,6 +485,7 @@ def update_rk3(self, delta_t=None):
         kap1 = (self.vel, self.force(self.pos,
                                      self.vel,
                                      self.time))
+        drag = [self.drag_acceleration]
 
         pos = self.pos+0.5*delta_t*kap1[0]
         vel = self.vel+0.5*delta_t*kap1[1]
@@ -478,6 +495,7 @@ def update_rk3(self, delta_t=None):
                                   0.5*delta_t, drag=False)
 
         kap2 = (vel, self.force(pos, vel, self.time+0.5*delta_t))
+        drag.append(self.drag_acceleration)
 
         pos = self.pos+delta_t*(2.0*kap2[0]-kap1[0])
         vel = self.vel+delta_t*(2.0*kap2[1]-kap1[1])
@@ -487,6 +505,7 @@ def update_rk3(self, delta_t=None):
                                   delta_t, drag=False)
 
         kap3 = (vel, self.force(pos, vel, self.time+delta_t))
+        drag.append(self.drag_acceleration)
 
         pos = self.pos+delta_t*(kap1[0]+4.0*kap2[0]+kap3[0])/6.0
         vel = self.vel+delta_t*(kap1[1]+4.0*kap2[1]+kap3[1])/6.0
@@ -494,6 +513,7 @@ def update_rk3(self, delta_t=None):
         self.pos, self.vel = self.check_collision_full(pos, self.pos,
                                                        vel, self.vel,
                                                        delta_t, drag=False)
+        self.add_explicit_drag((drag[0]+4.0*drag[1]+drag[2])/6.0, delta_t)
 
     except Collision.CollisionException as col:
         col.vel = self.vel+col.delta_t*kap1[0]
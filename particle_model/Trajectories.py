@@ -0,0 +1,500 @@
+""" Module containing an append-only columnar store for particle trajectories.
+
+Rows of (ParticleID, Time, Position, Velocity, fields) are buffered in memory
+and written to disk in chunks. Each chunk is a directory holding one .npy file
+per column, with its rows sorted by particle id, and an index.npz file giving
+the start and length of each particle's rows. The index is written last, so
+chunks without one are incomplete and ignored by readers."""
+
+import os
+import os.path
+import sys
+import glob
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+from vtk.util.numpy_support import vtk_to_numpy
+
+from particle_model.Debug import logger
+from particle_model import IO
+from particle_model import Parallel
+
+BASE_COLUMNS = (('ParticleID', 1), ('Time', 1), ('Position', 3), ('Velocity', 3))
+
+# number of memory mapped column files a reader keeps open
+MAX_OPEN_COLUMNS = 256
+
+def chunk_name(path, rank, number):
+    """ Get the directory name of a chunk of a trajectory store."""
+    return os.path.join(path, 'chunk_%d_%06d'%(rank, number))
+
+class TrajectoryWriter(object):
+    """ Append particle data to a columnar trajectory store on disk.
+
+    In parallel every process writes its own chunks into the same store."""
+
+    def __init__(self, path, chunk_size=65536):
+        """ Open a store for appending, creating it if necessary.
+
+        Args:
+            path (str): Directory containing the store.
+            chunk_size (int): Number of rows buffered before writing a chunk."""
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.rank = Parallel.get_rank()
+        self.columns = None
+        self.ncomps = None
+        self.buffer = []
+        self.buffered_rows = 0
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
+        self.chunk_no = len(glob.glob(os.path.join(path, 'chunk_%d_*'%self.rank)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, bucket, field_data=None):
+        """ Append the current time level of a particle bucket.
+
+        Args:
+            bucket (ParticleBucket): The bucket to record.
+            field_data (dict): Number of components of each particle field to record."""
+        self.append_snapshot(IO.BucketSnapshot(bucket, field_data))
+
+    def append_snapshot(self, snapshot):
+        """ Append the data from an IO.BucketSnapshot."""
+        columns = [('ParticleID', snapshot.ids),
+                   ('Time', numpy.full(len(snapshot), snapshot.time)),
+                   ('Position', snapshot.pos),
+                   ('Velocity', snapshot.vel)]
+        columns += sorted(snapshot.fields.items())
+        self.append_rows(columns)
+
+    def append_rows(self, columns):
+        """ Append rows of data.
+
+        Args:
+            columns (list): (name, data) pairs, starting with ParticleID and
+            Time. Every call must give the same columns. Calls without
+            any rows are ignored."""
+
+        if not len(columns[0][1]):
+            return
+
+        names = [name for name, _ in columns]
+        if self.columns is None:
+            self.columns = names
+        elif names != self.columns:
+            raise ValueError('Trajectory columns changed from %s to %s'
+                             %(self.columns, names))
+
+        data = [numpy.asarray(value, float).reshape((len(columns[0][1]), -1))
+                for _, value in columns]
+        if self.ncomps is None:
+            self.ncomps = [_.shape[1] for _ in data]
+        self.buffer.append(data)
+        self.buffered_rows += data[0].shape[0]
+
+        if self.buffered_rows >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered rows to a new chunk."""
+
+        if not self.buffered_rows:
+            return
+
+        data = [numpy.concatenate(_) for _ in zip(*self.buffer)]
+        self.buffer = []
+        self.buffered_rows = 0
+
+        order = numpy.argsort(data[0][:, 0], kind='mergesort')
+        ids, start, count = numpy.unique(data[0][order, 0], return_index=True,
+                                         return_counts=True)
+
+        name = chunk_name(self.path, self.rank, self.chunk_no)
+        os.mkdir(name)
+        for k, value in enumerate(data):
+            numpy.save(os.path.join(name, '%d.npy'%k), value[order, :])
+        numpy.savez(os.path.join(name, 'index.npz'), ids=ids, start=start,
+                    count=count, columns=numpy.array(self.columns))
+        self.chunk_no += 1
+
+    def close(self):
+        """ Write any buffered rows."""
+        self.flush()
+
+class TrajectoryReader(object):
+    """ Read particle trajectories from a columnar trajectory store."""
+
+    def __init__(self, path):
+        """ Load the per particle index of a store.
+
+        Args:
+            path (str): Directory containing the store."""
+
+        self.path = path
+        self.chunks = []
+        self.columns = None
+        self.arrays = {}
+
+        ids, chunk, start, count = [], [], [], []
+        for name in sorted(glob.glob(os.path.join(path, 'chunk_*'))):
+            if not os.path.isfile(os.path.join(name, 'index.npz')):
+                continue
+            index = numpy.load(os.path.join(name, 'index.npz'))
+            if self.columns is None:
+                self.columns = [str(_) for _ in index['columns']]
+            ids.append(index['ids'])
+            chunk.append(numpy.full(index['ids'].size, len(self.chunks), int))
+            start.append(index['start'])
+            count.append(index['count'])
+            self.chunks.append(name)
+
+        self.columns = self.columns or [_[0] for _ in BASE_COLUMNS]
+
+        if ids:
+            ids = numpy.concatenate(ids)
+            order = numpy.argsort(ids, kind='mergesort')
+            self.ids = ids[order]
+            self.chunk = numpy.concatenate(chunk)[order]
+            self.start = numpy.concatenate(start)[order]
+            self.count = numpy.concatenate(count)[order]
+        else:
+            self.ids = numpy.zeros(0)
+            self.chunk = numpy.zeros(0, int)
+            self.start = numpy.zeros(0, int)
+            self.count = numpy.zeros(0, int)
+
+    def __len__(self):
+        return self.particle_ids().size
+
+    def __iter__(self):
+        for particle_id in self.particle_ids():
+            yield particle_id, self.get(particle_id)
+
+    def particle_ids(self):
+        """ Return the ids of all the particles in the store."""
+        return numpy.unique(self.ids)
+
+    def _column(self, chunk, k):
+        """ Memory map a column of a chunk."""
+        key = (chunk, k)
+        if key not in self.arrays:
+            if len(self.arrays) >= MAX_OPEN_COLUMNS:
+                self.arrays.clear()
+            self.arrays[key] = numpy.load(os.path.join(self.chunks[chunk], '%d.npy'%k),
+                                          mmap_mode='r')
+        return self.arrays[key]
+
+    def get(self, particle_id):
+        """ Return the rows for one particle, in time order.
+
+        Returns:
+            dict: The data for each column, with a row per time level."""
+
+        lower = numpy.searchsorted(self.ids, particle_id, side='left')
+        upper = numpy.searchsorted(self.ids, particle_id, side='right')
+
+        data = {}
+        for k, name in enumerate(self.columns):
+            data[name] = [self._column(self.chunk[_], k)[self.start[_]:
+                                                         self.start[_]+self.count[_]]
+                          for _ in range(lower, upper)]
+            if data[name]:
+                data[name] = numpy.concatenate(data[name])
+            else:
+                data[name] = numpy.zeros((0, 1))
+
+        order = numpy.argsort(data['Time'][:, 0], kind='mergesort')
+        for name in self.columns:
+            data[name] = data[name][order]
+
+        return data
+
+    def read_all(self):
+        """ Return every row in the store, sorted by particle id then time.
+
+        Returns:
+            dict: The data for each column.
+            ndarray: The number of rows for each particle."""
+
+        data = {}
+        for k, name in enumerate(self.columns):
+            value = [numpy.load(os.path.join(_, '%d.npy'%k)) for _ in self.chunks]
+            data[name] = numpy.concatenate(value) if value else numpy.zeros((0, 1))
+
+        order = numpy.lexsort((data['Time'][:, 0], data['ParticleID'][:, 0]))
+        for name in self.columns:
+            data[name] = data[name][order]
+        counts = numpy.unique(data['ParticleID'][:, 0], return_counts=True)[1]
+
+        return data, counts
+
+    def iter_batches(self, batch_rows=1048576):
+        """ Iterate over the store in batches of whole particles.
+
+        Each batch covers a range of particle ids, with rows sorted by
+        particle id then time, and is read as one slice of each chunk.
+
+        Args:
+            batch_rows (int): Approximate number of rows in each batch.
+
+        Yields:
+            dict: The data for each column.
+            ndarray: The number of rows for each particle."""
+
+        uids, first = numpy.unique(self.ids, return_index=True)
+        rows = numpy.add.reduceat(self.count, first) if uids.size else numpy.zeros(0, int)
+        total = numpy.cumsum(rows)
+
+        lower = 0
+        while lower < uids.size:
+            upper = numpy.searchsorted(total, total[lower]-rows[lower]+batch_rows,
+                                       side='right')
+            upper = max(upper, lower+1)
+            entries = slice(first[lower], first[upper] if upper < uids.size
+                            else self.ids.size)
+
+            chunk = self.chunk[entries]
+            start = numpy.full(len(self.chunks), numpy.iinfo(int).max)
+            end = numpy.zeros(len(self.chunks), int)
+            numpy.minimum.at(start, chunk, self.start[entries])
+            numpy.maximum.at(end, chunk, self.start[entries]+self.count[entries])
+
+            data = {}
+            for k, name in enumerate(self.columns):
+                data[name] = numpy.concatenate([self._column(c, k)[start[c]:end[c]]
+                                                for c in numpy.unique(chunk)])
+            order = numpy.lexsort((data['Time'][:, 0], data['ParticleID'][:, 0]))
+            for name in self.columns:
+                data[name] = data[name][order]
+
+            yield data, rows[lower:upper]
+            lower = upper
+
+    def write_polydata(self, outfile, batch_rows=1048576):
+        """ Stream the store to a .vtp file with a poly line per particle.
+
+        The file is written directly in raw appended binary format, a batch
+        of particles at a time, so the store need not fit in memory.
+
+        Args:
+            outfile (str): The file name.
+            batch_rows (int): Approximate number of rows held in memory."""
+
+        npts = int(self.count.sum())
+        ncells = self.particle_ids().size
+
+        arrays = []
+        for k, name in enumerate(self.columns):
+            if self.chunks:
+                ncomp = self._column(0, k).shape[1]
+            else:
+                ncomp = dict(BASE_COLUMNS).get(name, 1)
+            arrays.append((name, ncomp))
+
+        blocks, offset = {}, 0
+        for name, ncomp in arrays+[('connectivity', 1), ('offsets', 1)]:
+            blocks[name] = offset
+            offset += 8+8*ncomp*(ncells if name == 'offsets' else npts)
+
+        def data_array(name, ncomp, dtype='Float64', label=None):
+            """ XML for an appended data array."""
+            return ('<DataArray type="%s" Name="%s" NumberOfComponents="%d"'
+                    ' format="appended" offset="%d"/>'%(dtype, label or name,
+                                                        ncomp, blocks[name]))
+
+        text = ['<?xml version="1.0"?>',
+                '<VTKFile type="PolyData" version="0.1" byte_order="%s" header_type="UInt64">'
+                %('LittleEndian' if sys.byteorder == 'little' else 'BigEndian'),
+                '  <PolyData>',
+                '    <Piece NumberOfPoints="%d" NumberOfVerts="0" NumberOfLines="%d"'
+                ' NumberOfStrips="0" NumberOfPolys="0">'%(npts, ncells),
+                '      <PointData>']
+        for name, ncomp in arrays:
+            if name != 'Position':
+                text.append('        '+data_array(name, ncomp))
+        text += ['      </PointData>',
+                 '      <Points>',
+                 '        '+data_array('Position', 3, label='Points'),
+                 '      </Points>',
+                 '      <Lines>',
+                 '        '+data_array('connectivity', 1, 'Int64'),
+                 '        '+data_array('offsets', 1, 'Int64'),
+                 '      </Lines>',
+                 '    </Piece>',
+                 '  </PolyData>',
+                 '  <AppendedData encoding="raw">',
+                 '   _']
+
+        with open(outfile, 'wb') as out:
+            out.write('\n'.join(text).encode('ascii'))
+            base = out.tell()
+
+            def write_block(name, value, row=0):
+                """ Write rows of a data block, with its size header."""
+                value = numpy.ascontiguousarray(value)
+                if row == 0:
+                    out.seek(base+blocks[name])
+                    nrows = ncells if name == 'offsets' else npts
+                    numpy.array([nrows*value.itemsize*value[:1].size],
+                                numpy.uint64).tofile(out)
+                out.seek(base+blocks[name]+8+row*value[:1].nbytes)
+                value.tofile(out)
+
+            row = 0
+            for data, _ in self.iter_batches(batch_rows):
+                for name, _ in arrays:
+                    write_block(name, data[name].astype(float), row)
+                nrows = data['Time'].shape[0]
+                write_block('connectivity', numpy.arange(row, row+nrows, dtype=numpy.int64),
+                            row)
+                row += nrows
+
+            counts = numpy.add.reduceat(self.count, numpy.unique(self.ids,
+                                                                 return_index=True)[1])
+            if npts == 0:
+                for name, _ in arrays+[('connectivity', 1)]:
+                    write_block(name, numpy.zeros(0))
+                counts = numpy.zeros(0, numpy.int64)
+            write_block('offsets', numpy.cumsum(counts).astype(numpy.int64))
+
+            out.seek(base+offset)
+            out.write('\n  </AppendedData>\n</VTKFile>\n'.encode('ascii'))
+
+    def to_polydata(self):
+        """ Convert the store to a vtkPolyData with a poly line per particle."""
+
+        data, counts = self.read_all()
+
+        poly_data = vtk.vtkPolyData()
+        pnts = vtk.vtkPoints()
+        if counts.size:
+            pnts.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(data['Position']),
+                                                    deep=1))
+        poly_data.SetPoints(pnts)
+        poly_data.SetLines(IO.line_cell_array(counts))
+
+        for name in self.columns:
+            if name == 'Position' or not counts.size:
+                continue
+            poly_data.GetPointData().AddArray(IO.make_double_array(name, data[name],
+                                                                   data[name].shape[1]))
+
+        return poly_data
+
+def read_dump(filename):
+    """ Read the particle data from a dump file as numpy arrays.
+
+    Returns:
+        list: (name, data) pairs for ParticleID, Time, Position and
+        the other point data arrays."""
+
+    reader = vtk.vtkXMLGenericDataObjectReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    data = reader.GetOutput()
+
+    npts = data.GetNumberOfPoints()
+    point_data = data.GetPointData()
+
+    def get_array(arr):
+        """ Get a point data array as an (npts, ncomp) array."""
+        return vtk_to_numpy(arr).reshape((npts, arr.GetNumberOfComponents()))
+
+    if point_data.HasArray('Time'):
+        time = get_array(point_data.GetArray('Time'))
+    else:
+        time = numpy.full((npts, 1), data.GetFieldData().GetArray('Time').GetValue(0))
+
+    columns = [('ParticleID', get_array(point_data.GetArray('ParticleID'))),
+               ('Time', time)]
+    if npts:
+        columns.append(('Position', vtk_to_numpy(data.GetPoints().GetData())))
+    else:
+        columns.append(('Position', numpy.zeros((0, 3))))
+
+    for k in range(point_data.GetNumberOfArrays()):
+        name = point_data.GetArrayName(k)
+        if name not in ('ParticleID', 'Time'):
+            columns.append((name, get_array(point_data.GetArray(k))))
+
+    return [(name, numpy.array(value, float)) for name, value in columns]
+
+def make_trajectories(outfile, base_name, extension='vtp', memory=2**28,
+                      processes=1, tmpdir=None):
+    """ Build a trajectory file from a time series of polydata dumps.
+
+    Rows are spilled to a temporary trajectory store whenever the data read
+    exceeds the memory budget, then streamed to the output sorted by particle.
+
+    Args:
+        outfile (str): Name of the .vtp file to write.
+        base_name (str): Base name of the dumps, base_name_0.vtp, ...
+        extension (str): File extension of the dumps.
+        memory (int): Approximate memory budget in bytes.
+        processes (int): Number of processes reading dumps.
+        tmpdir (str): Directory for the temporary store."""
+
+    files = IO.dump_files(base_name, extension)
+    store = tempfile.mkdtemp(dir=tmpdir)
+
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(read_dump, files)
+    else:
+        results = (read_dump(_) for _ in files)
+
+    try:
+        writer = TrajectoryWriter(store)
+        row_bytes = 8
+        warned = set()
+        for data in results:
+            # empty dumps, such as before any insertion, carry no schema
+            if not len(data[0][1]):
+                continue
+            if writer.columns is None:
+                row_bytes = sum(8*value.shape[1] for _, value in data)
+                writer.chunk_size = max(1, memory//row_bytes)
+            else:
+                data = dict(data)
+                npts = data['ParticleID'].shape[0]
+                dropped = set(data).difference(writer.columns, warned)
+                if dropped:
+                    logger.warning('Arrays %s are not in the first non-empty dump and are dropped',
+                                   ', '.join(sorted(dropped)))
+                    warned.update(dropped)
+                columns = []
+                for name, ncomp in zip(writer.columns, writer.ncomps):
+                    if name in data and data[name].shape[1] == ncomp:
+                        columns.append((name, data[name]))
+                        continue
+                    if name not in warned:
+                        logger.warning('Array %s is missing or reshaped in a dump, padding with NaN',
+                                       name)
+                        warned.add(name)
+                    columns.append((name, numpy.full((npts, ncomp), numpy.nan)))
+                data = columns
+            writer.append_rows(data)
+        writer.close()
+
+        TrajectoryReader(store).write_polydata(outfile, max(1, memory//row_bytes))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        shutil.rmtree(store)
@@ -0,0 +1,98 @@
+"""Unit tests for the Fluidity coupling routines"""
+
+import numpy
+import vtk
+
+from particle_model import Coupling
+from particle_model import Particles
+
+def square_mesh(num=4):
+    """ Build a triangulated unit square."""
+    ugrid = vtk.vtkUnstructuredGrid()
+    pts = vtk.vtkPoints()
+    for j in range(num+1):
+        for i in range(num+1):
+            pts.InsertNextPoint(float(i)/num, float(j)/num, 0.0)
+    ugrid.SetPoints(pts)
+    for j in range(num):
+        for i in range(num):
+            k = j*(num+1)+i
+            ugrid.InsertNextCell(vtk.VTK_TRIANGLE, 3, [k, k+1, k+num+2])
+            ugrid.InsertNextCell(vtk.VTK_TRIANGLE, 3, [k, k+num+2, k+num+1])
+    return ugrid
+
+def test_cv_properties():
+    """ Test the control volume fraction and solid velocity."""
+
+    mesh = square_mesh()
+
+    numpy.random.seed(1)
+    pos = numpy.random.random((50, 3))
+    pos[:, 2] = 0.0
+    vel = numpy.zeros((50, 3))
+    vel[:, 0] = 2.0
+
+    bucket = Particles.ParticleBucket(pos, vel)
+
+    cvs = Coupling.get_control_volumes(mesh)
+    assert numpy.isclose(cvs.volume.sum(), 1.0)
+    assert Coupling.get_control_volumes(square_mesh()) is cvs
+
+    fraction = Coupling.get_cv_fraction(bucket, mesh)
+    velocity = Coupling.get_solid_velocity(bucket, mesh, fraction)
+
+    area = sum(par.parameters.get_area() for par in bucket)
+    assert numpy.isclose(numpy.sum(fraction*cvs.volume), area)
+    assert velocity.shape == (25, 2)
+    assert numpy.allclose(velocity[fraction > 0], (2.0, 0.0))
+    assert numpy.all(velocity[fraction == 0] == 0.0)
+
+    # moving the particles without advancing time must not reuse the lookup
+    for par in bucket:
+        par.pos = numpy.array((0.01, 0.01, 0.0))
+    fraction = Coupling.get_cv_fraction(bucket, mesh)
+    assert numpy.count_nonzero(fraction) == 1
+    assert numpy.isclose(fraction[0]*cvs.volume[0], area)
+
+def test_momentum_source():
+    """ Test depositing the particle drag reaction onto the mesh."""
+
+    mesh = square_mesh()
+
+    pos = numpy.array(((0.1, 0.1, 0.0), (0.6, 0.3, 0.0), (0.9, 0.8, 0.0)))
+    vel = numpy.zeros((3, 3))
+
+    bucket = Particles.ParticleBucket(pos, vel)
+
+    for par in bucket:
+        par.add_drag_impulse(2.0, numpy.array((1.0, -1.0, 0.0)), par.vel, 0.5)
+
+    par = list(bucket)[0]
+    mass = par.parameters.get_mass()
+    assert numpy.allclose(par.drag_impulse, (mass, -mass, 0.0))
+
+    fields = Coupling.get_coupling_fields(bucket, mesh, 0.1)
+    cvs = Coupling.get_control_volumes(mesh)
+    source = fields['MomentumSource']
+
+    # in 2D the reaction is per unit depth, so uses the particle area
+    rho_area = par.parameters.rho*par.parameters.get_area()
+
+    assert source.shape == (25, 2)
+    assert numpy.allclose(numpy.sum(source*cvs.volume[:, None], axis=0),
+                          (-30.0*rho_area, 30.0*rho_area))
+    assert numpy.count_nonzero(source[:, 0]) == 3
+    assert all(numpy.all(par.drag_impulse == 0.0) for par in bucket)
+    assert numpy.all(Coupling.get_momentum_source(bucket, mesh, 0.1) == 0.0)
+
+    # the impulse of a particle which has left still reaches the fluid
+    par = bucket.particles.pop()
+    par.pos = numpy.array((1.05, 0.8, 0.0))
+    par.add_drag_impulse(2.0, numpy.array((1.0, 0.0, 0.0)), par.vel, 0.5)
+    bucket.dead_particles.append(par)
+
+    source = Coupling.get_momentum_source(bucket, mesh, 0.1)
+    assert numpy.allclose(numpy.sum(source*cvs.volume[:, None], axis=0),
+                          (-10.0*rho_area, 0.0))
+    assert numpy.count_nonzero(source[:, 0]) == 1
+    assert numpy.all(par.drag_impulse == 0.0)
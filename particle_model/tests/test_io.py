@@ -2,12 +2,15 @@
 
 import os
 import numpy
+import pytest
 import filecmp
 
 from particle_model import IO
 from particle_model import Particles
+from particle_model import Collision
 
 import vtk
+from vtk.util.numpy_support import vtk_to_numpy
 
 DATA_DIR = 'particle_model/tests/data'
 
@@ -92,3 +95,239 @@ def test_make_pvd(tmpdir):
     filepath = tmpdir.join('test.pvd').strpath
 
     assert os.path.isfile(filepath)
+
+def test_pvd_index(tmpdir):
+    """ Test the .pvd collection maintained by the polydata writers."""
+
+    pos = numpy.array(((0.1, 0.2, 0.0), (0.3, 0.4, 0.0)))
+    vel = numpy.zeros((2, 3))
+
+    bucket = Particles.ParticleBucket(pos, vel)
+    basename = tmpdir.join('test').strpath
+
+    for level in range(3):
+        bucket.time = 0.1*level
+        IO.write_level_to_polydata(bucket, level, basename, pvd_index=True)
+    bucket.time = 0.123456789012345
+    IO.write_level_to_polydata(bucket, 3, basename, pvd_index=True)
+
+    assert IO.read_time(basename+'_2.vtp') == 0.2
+
+    IO.make_pvd(tmpdir.join('rebuilt.pvd').strpath, basename)
+
+    with open(basename+'.pvd') as pvd_file:
+        text = pvd_file.read()
+    assert text.count('<DataSet') == 4
+    assert 'timestep="0.2" file="test_2.vtp"' in text
+    assert 'timestep="0.123456789012345" file="test_3.vtp"' in text
+    assert tmpdir.join('rebuilt.pvd').read() == text
+
+    # off by default, and named without the extension of the basename
+    IO.write_level_to_polydata(bucket, 0, tmpdir.join('other').strpath)
+    assert not tmpdir.join('other.pvd').check()
+    assert IO.pvd_name('dump.vtp') == 'dump.pvd'
+
+def test_write_level_to_polydata(tmpdir):
+    """ Test writing a bucket time level to a .vtp file."""
+
+    pos = numpy.array(((0.1, 0.2, 0.0), (0.3, 0.4, 0.0), (0.5, 0.6, 0.0)))
+    vel = numpy.array(((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)))
+
+    bucket = Particles.ParticleBucket(pos, vel)
+    for k, par in enumerate(bucket):
+        par.fields['InsertionTime'] = 0.5*k
+
+    IO.write_level_to_polydata(bucket, 0, tmpdir.join('test').strpath,
+                               field_data={'InsertionTime': 1})
+
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(tmpdir.join('test_0.vtp').strpath)
+    reader.Update()
+    poly_data = reader.GetOutput()
+
+    assert poly_data.GetNumberOfPoints() == 3
+    assert poly_data.GetNumberOfVerts() == 3
+    assert poly_data.GetPoint(1) == (0.3, 0.4, 0.0)
+    assert poly_data.GetPointData().GetArray('Particle Velocity').GetTuple3(2) == (0.0, 0.0, 1.0)
+    assert poly_data.GetPointData().GetArray('InsertionTime').GetValue(2) == 1.0
+    assert poly_data.GetPointData().GetArray('ParticleID').GetValue(0) == hash(list(bucket)[0])
+    assert poly_data.GetCellData().GetArray('Live').GetRange() == (1.0, 1.0)
+
+def test_async_writer(tmpdir):
+    """ Test writing snapshots of a bucket from a background thread."""
+
+    pos = numpy.array(((0.1, 0.2, 0.0), (0.3, 0.4, 0.0)))
+    vel = numpy.zeros((2, 3))
+
+    bucket = Particles.ParticleBucket(pos, vel)
+
+    with IO.AsyncWriter(max_queue=1) as writer:
+        for level in range(3):
+            writer.write_level_to_polydata(bucket, level,
+                                           tmpdir.join('test').strpath)
+            for par in bucket:
+                par.pos = par.pos+1.0
+
+    for level in range(3):
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(tmpdir.join('test_%d.vtp'%level).strpath)
+        reader.Update()
+        assert reader.GetOutput().GetPoint(0) == (0.1+level, 0.2+level, level)
+
+def test_compressed_output(tmpdir):
+    """ Test round tripping data written with each compressor."""
+
+    pos = numpy.array(((0.1, 0.2, 0.0), (0.3, 0.4, 0.0)))
+    vel = numpy.zeros((2, 3))
+
+    bucket = Particles.ParticleBucket(pos, vel)
+
+    for name in ('none', 'zlib', 'lz4', 'lzma'):
+        options = {'data_mode': 'appended', 'encode': False,
+                   'compressor': name, 'block_size': 1024}
+        IO.write_level_to_polydata(bucket, 0, tmpdir.join(name).strpath,
+                                   writer_options=options)
+
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(tmpdir.join('%s_0.vtp'%name).strpath)
+        reader.Update()
+        assert reader.GetOutput().GetPoint(1) == (0.3, 0.4, 0.0)
+
+    with pytest.raises(ValueError):
+        IO.configure_writer(vtk.vtkXMLPolyDataWriter(), {'compressor': 'gzip'})
+
+def test_neighbour_pairs():
+    """ Test the batched kernel neighbour search used for deposition."""
+
+    numpy.random.seed(2)
+    points = numpy.random.random((50, 3))
+    centres = numpy.random.random((20, 3))
+
+    node, part, rad2 = IO.neighbour_pairs(points, centres, 0.3)
+
+    dist2 = numpy.sum((points[:, None, :]-centres[None, :, :])**2, axis=2)
+    assert set(zip(node, part)) == set(zip(*numpy.nonzero(dist2 <= 0.09)))
+    assert numpy.allclose(rad2, dist2[node, part])
+
+    total = IO.deposit(node, numpy.ones((len(node), 3)), 50)
+    assert total.shape == (50, 3)
+    assert all(total[:, 0] == (dist2 <= 0.09).sum(axis=1))
+
+def test_calculate_averaged_properties():
+    """ Test the particle level averages from a shared neighbour list."""
+
+    pos = numpy.array(((0.1, 0.1, 0.0), (0.11, 0.1, 0.0), (0.5, 0.5, 0.0)))
+    vel = numpy.array(((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)))
+
+    bucket = Particles.ParticleBucket(pos, vel)
+    poly_data = IO.snapshot_to_polydata(IO.BucketSnapshot(bucket))
+
+    pairs = IO.neighbour_pairs(pos, pos, 0.03)
+    assert len(pairs[0]) == 5
+
+    IO.calculate_averaged_properties(poly_data, bucket, pairs)
+    velocity = vtk_to_numpy(poly_data.GetPointData().GetArray('SolidVolumeVelocity'))
+    temperature = vtk_to_numpy(poly_data.GetPointData().GetArray('GranularTemperature'))
+
+    assert numpy.allclose(velocity[0]+velocity[1], (1.0, 1.0, 0.0))
+    assert velocity[0][0] > 0.5
+    assert numpy.allclose(velocity[2], vel[2])
+    assert temperature[0] > 0.0 and temperature[2] == 0.0
+
+    # an empty bucket gives empty fields
+    bucket = Particles.ParticleBucket(numpy.zeros((0, 3)), numpy.zeros((0, 3)))
+    poly_data = IO.snapshot_to_polydata(IO.BucketSnapshot(bucket))
+    IO.calculate_averaged_properties(poly_data, bucket)
+    assert poly_data.GetPointData().GetArray('SolidPressure').GetNumberOfTuples() == 0
+
+def test_boundary_face_data():
+    """ Test the precomputed boundary face normals and surface id lookups."""
+
+    bnd = IO.make_structured_boundary((3, 3), (0.5, 0.5))
+    boundary = IO.BoundaryData(bnd=bnd, outlet_ids=[2])
+
+    assert all(boundary.areas == 1.0)
+    assert all(abs(abs(boundary.normals[1]) - numpy.array((1.0, 0.0, 0.0))) < 1.0e-12)
+    assert boundary.get_surface_id(3) == 4
+    assert list(boundary.outlet_faces) == [False, True, False, False]
+
+    boundary.outlet_ids = [1, 3]
+    assert list(boundary.outlet_faces) == [True, False, True, False]
+    assert boundary.outlet_set == set((1, 3))
+
+def test_boundary_quad_normals():
+    """ Test normals and collision angles on a boundary of quads."""
+
+    ugrid = vtk.vtkUnstructuredGrid()
+    pts = vtk.vtkPoints()
+    for k in range(8):
+        pts.InsertNextPoint(float(k%2), float(k//2%2), float(k//4))
+    ugrid.SetPoints(pts)
+    for quad in ((0, 1, 3, 2), (4, 5, 7, 6), (0, 1, 5, 4),
+                 (2, 3, 7, 6), (0, 2, 6, 4), (1, 3, 7, 5)):
+        ugrid.InsertNextCell(vtk.VTK_QUAD, 4, quad)
+
+    boundary = IO.BoundaryData(bnd=ugrid)
+
+    assert numpy.allclose(boundary.areas, 1.0)
+    assert numpy.allclose(abs(boundary.normals),
+                          numpy.repeat(numpy.eye(3)[::-1], 2, axis=0))
+
+    class Mock(object):
+        """ Just enough of a particle for collision_angle."""
+        pass
+    particle = Mock()
+    particle.system = Mock()
+    particle.system.boundary = boundary
+
+    theta, normal = Collision.collision_angle(particle,
+                                              numpy.array((0.5, 0.5, 0.8)),
+                                              numpy.array((0.5, 0.7, 1.0)), 1)
+    assert numpy.allclose(normal, (0.0, 0.0, -1.0))
+    assert abs(theta-numpy.pi/4.0) < 1.0e-12
+
+def test_boundary_line_normal_3d():
+    """ Test line normals follow the incoming direction off the x-y plane."""
+
+    ugrid = vtk.vtkUnstructuredGrid()
+    pts = vtk.vtkPoints()
+    pts.InsertNextPoint(0.0, 0.0, 0.0)
+    pts.InsertNextPoint(1.0, 0.0, 0.0)
+    ugrid.SetPoints(pts)
+    ugrid.InsertNextCell(vtk.VTK_LINE, 2, (0, 1))
+
+    boundary = IO.BoundaryData(bnd=ugrid)
+
+    assert numpy.allclose(abs(boundary.get_normal(0)), (0.0, 1.0, 0.0))
+    assert numpy.allclose(boundary.get_normal(0, numpy.array((0.3, 0.0, 1.0))),
+                          (0.0, 0.0, 1.0))
+
+def test_boundary_face_owners():
+    """ Test locating the boundary faces in the volume mesh."""
+
+    reader = vtk.vtkXMLUnstructuredGridReader()
+    reader.SetFileName(os.path.join(DATA_DIR, 'rightward_0.vtu'))
+    reader.Update()
+
+    boundary = IO.BoundaryData(os.path.join(DATA_DIR, 'rightward_boundary.vtu'))
+
+    assert all(abs(boundary.get_face_centroids()[1]
+                   - numpy.array((1.0, 0.5, 0.0))) < 1.0e-12)
+    assert all(boundary.get_face_owners(reader.GetOutput()) == 0)
+
+def test_move_boundary_through_normal():
+    """ Test offsetting a boundary inwards along its normals."""
+
+    bnd = IO.make_structured_boundary((3, 3), (0.5, 0.5))
+
+    moved = IO.move_boundary_through_normal(bnd, 0.1)
+
+    assert all(abs(IO.get_point_array(moved)
+                   - numpy.array(((0.1, 0.1, 0.0), (0.9, 0.1, 0.0),
+                                  (0.9, 0.9, 0.0), (0.1, 0.9, 0.0))) < 1.0e-6).ravel())
+    assert all(IO.get_point_array(bnd)[2] == (1.0, 1.0, 0.0))
+
+    moved = IO.move_boundary_through_normal(bnd, 0.1, Ids=[1, 2, 3])
+
+    assert all(abs(IO.get_point_array(moved)[:, 0]
+                   - numpy.array((0.1, 1.0, 1.0, 0.1))) < 1.0e-6)
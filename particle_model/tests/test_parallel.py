@@ -1,6 +1,8 @@
 """ Test parallel execution."""
 from particle_model import Parallel
 import pytest
+import numpy
+import vtk
 
 @pytest.mark.skipif(Parallel.get_size()>1,reason='Serial test')
 def test_serial():
@@ -12,3 +14,73 @@ def test_serial():
 def test_paralle():
 
     assert Parallel.is_parallel()
+
+
+@pytest.mark.skipif(Parallel.get_size()>1,reason='Serial test')
+def test_find_cell():
+    """ Test batch cell and ownership queries."""
+
+    reader = vtk.vtkXMLUnstructuredGridReader()
+    reader.SetFileName('particle_model/tests/data/rightward_0.vtu')
+    reader.Update()
+    ugrid = reader.GetOutput()
+
+    points = numpy.array(((0.25, 0.5, 0.), (0.75, 0.5, 0.), (1.5, 0.5, 0.)))
+
+    cells = Parallel.find_cell(ugrid, points)
+
+    assert all(cells[:2] > -1) and cells[2] == -1
+    assert Parallel.find_cell(ugrid, points[0]) == cells[0]
+    assert Parallel.get_locator(ugrid) is Parallel.get_locator(ugrid)
+    assert all(Parallel.point_owned(ugrid, points) == (True, True, False))
+
+    # a locator for another dataset must not be used for the block queried
+    mblock = vtk.vtkMultiBlockDataSet()
+    mblock.SetBlock(0, ugrid)
+    other = vtk.vtkCellLocator()
+    other.SetDataSet(vtk.vtkUnstructuredGrid())
+    other.BuildLocator()
+    Parallel.LOCATORS.clear()
+    assert all(Parallel.find_cell(mblock, points, other) == cells)
+
+def test_morton_keys():
+    """ Test space filling curve keys used in load balancing."""
+
+    bounds = numpy.array((0., 1., 0., 1., 0., 1.))
+    points = numpy.array(((0., 0., 0.), (0.75, 0., 0.),
+                          (0., 0.75, 0.), (0., 0., 0.75), (1., 1., 1.)))
+
+    keys = Parallel.morton_keys(points, bounds, bits=1)
+
+    assert list(keys) == [0, 1, 2, 4, 7]
+
+def test_aggregated_polydata_empty_rank(tmpdir):
+    """ Test aggregated output with no particles, or arrays, off rank 0."""
+
+    from particle_model import IO
+
+    comm = Parallel.get_world_comm()
+    outfile = comm.bcast(tmpdir.join('particles.pvtp').strpath)
+
+    poly_data = vtk.vtkPolyData()
+    pts = vtk.vtkPoints()
+    poly_data.SetPoints(pts)
+    if Parallel.get_rank() == 0:
+        for k in range(3):
+            pts.InsertNextPoint(float(k), 0.0, 0.0)
+        poly_data.SetVerts(IO.vertex_cell_array(3))
+        arr = vtk.vtkDoubleArray()
+        arr.SetName('Diameter')
+        for k in range(3):
+            arr.InsertNextValue(1.0)
+        poly_data.GetPointData().AddArray(arr)
+
+    assert IO.write_aggregated_polydata(poly_data, outfile)
+
+    if Parallel.get_rank() == 0:
+        reader = vtk.vtkXMLPPolyDataReader()
+        reader.SetFileName(outfile)
+        reader.Update()
+        out = reader.GetOutput()
+        assert out.GetNumberOfPoints() == 3
+        assert out.GetPointData().GetArray('Diameter').GetNumberOfTuples() == 3
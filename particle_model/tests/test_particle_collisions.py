@@ -0,0 +1,47 @@
+"""Unit tests for particle-particle collisions"""
+
+import numpy
+
+from particle_model import ParticleBase
+from particle_model import ParticleCollisions
+from particle_model import Particles
+
+def brute_force_pairs(pos, radius):
+    """ List every pair of points closer than radius."""
+    return set((i, j) for i in range(len(pos)) for j in range(i+1, len(pos))
+               if numpy.sum((pos[i]-pos[j])**2) < radius**2)
+
+def test_spatial_hash():
+    """ Test the spatial hash candidate pairs against a direct search."""
+
+    numpy.random.seed(1)
+    pos = numpy.random.random((300, 3))
+    grid = ParticleCollisions.SpatialHash()
+
+    for _ in range(3):
+        grid.update(pos, 0.1)
+        i, j, dummy = ParticleCollisions.find_contacts(pos, 0.05*numpy.ones(300),
+                                                       *grid.pairs())
+        pairs = set((min(a, b), max(a, b)) for a, b in zip(i, j))
+        assert len(pairs) == len(i)
+        assert pairs == brute_force_pairs(pos, 0.1)
+        pos = pos+0.02*(numpy.random.random((300, 3))-0.5)
+
+def test_hard_sphere_collision():
+    """ Test a head on collision between two equal particles."""
+
+    pos = numpy.array(((0.0, 0.0, 0.0), (0.9e-3, 0.0, 0.0), (0.5, 0.5, 0.0)))
+    vel = numpy.array(((1.0, 0.0, 0.0), (-1.0, 0.0, 0.0), (1.0, 0.0, 0.0)))
+
+    bucket = Particles.ParticleBucket(pos, vel,
+                                      parameters=ParticleBase.PhysicalParticle(diameter=1.0e-3))
+    model = ParticleCollisions.HardSphereCollisions(restitution=1.0)
+
+    assert model(bucket) == 1
+    particles = list(bucket)
+    assert numpy.allclose(particles[0].vel, (-1.0, 0.0, 0.0))
+    assert numpy.allclose(particles[1].vel, (1.0, 0.0, 0.0))
+    assert numpy.allclose(particles[2].vel, (1.0, 0.0, 0.0))
+
+    # now separating, so nothing more happens
+    assert model(bucket) == 0
@@ -9,6 +9,7 @@ from particle_model import System
 
 import vtk
 import numpy
+import pytest
 
 class dc(object):
     def __init__(self):
@@ -377,3 +378,166 @@ def test_coefficient_of_restitution():
     assert part.collisions[0].time == 0.05
     assert all(part.collisions[0].vel == numpy.array((1., 0., 0.)))
     assert part.collisions[0].angle == numpy.pi/2.0
+
+def test_wear_accumulation():
+    """Test wear is accumulated on the boundary as collisions happen."""
+
+    bnd = IO.BoundaryData('particle_model/tests/data/rightward_boundary.vtu')
+    bnd.wear.bin_width = 0.001
+    system = System.System(bnd, coeff=1.0, temporal_cache=temp_cache())
+
+    pos = numpy.array((0.9995, 0.5, 0.0))
+    vel = numpy.array((1.0, 0.0, 0.0))
+
+    part = Particles.Particle((pos, vel), delta_t=0.001, parameters=PAR0,
+                              system=system)
+    part.update(method="ForwardEuler")
+
+    wear = Collision.mclaury_mass_coeff(part.collisions[0])
+    node = bnd.nearest_node(part.collisions[0].cell, part.collisions[0].pos)
+
+    assert abs(bnd.wear.total.sum() - wear) < 1.0e-12
+    assert abs(bnd.wear.window_sum(0.0, 0.001)[node] - wear) < 1.0e-12
+    assert not bnd.wear.window_sum(0.001, 0.002).any()
+    assert abs(bnd.wear.rate(0.0, 0.001)[node]
+               - wear/0.001/bnd.wear.measure[node]) < 1.0e-8
+
+def test_wear_windows():
+    """Test wear binning at window edges and over unaligned windows."""
+
+    wear = Collision.WearAccumulator(bin_width=0.1)
+    wear.measure = numpy.ones(2)
+    wear.total = numpy.zeros(2)
+
+    # a collision at the end of a step belongs to that step
+    wear.add(0, 1.0, 0.2)
+    assert wear.window_sum(0.1, 0.2)[0] == 1.0
+    assert wear.window_sum(0.2, 0.3)[0] == 0.0
+
+    wear.add(1, 2.0, 0.25)
+    assert numpy.allclose(wear.window_sum(0.2, 0.25), (0.0, 1.0))
+    assert numpy.allclose(wear.window_sum(0.15, 0.35), (0.5, 2.0))
+    assert numpy.allclose(wear.rate(0.0, 0.4), (2.5, 5.0))
+
+def test_collision_log():
+    """Test the columnar collision log against per collision wear."""
+
+    log = Collision.CollisionLog(capacity=1)
+    for k in range(5):
+        angle = (k+1)*numpy.pi/12.0
+        info = Collision.CollisionInfo((k, 0., 0.), (k+1., 1., 0.), 0.1*k,
+                                       k, angle, (1., 0., 0.))
+        log.append(info, k%2, 'Sand')
+
+    assert len(log) == 5
+    assert log.pos.shape == (5, 3)
+    assert len(log.for_particle(1)) == 2
+    assert log.species_names == ['Sand']
+
+    wear = log.get_wear()
+    for k, col in enumerate(log):
+        assert abs(wear[k] - Collision.mclaury_mass_coeff(col)) < 1.0e-12
+
+def test_mclaury_material_table():
+    """Test vectorised wear with per surface id material parameters."""
+
+    angle = numpy.array((0.1, 0.5, 1.0, 1.5))
+    speed = numpy.array((1.0, 2.0, 3.0, 4.0))
+    table = Collision.MaterialTable({2: {'k': 2.0}})
+
+    wear = Collision.mclaury_wear(angle, speed)
+    table_wear = Collision.mclaury_wear(angle, speed,
+                                        table.lookup((1, 2, 2, 3)))
+
+    assert all(abs(table_wear-wear*numpy.array((1., 2., 2., 1.))) < 1.0e-12)
+
+def test_wear_material_table(tmpdir):
+    """Test a material table through live wear and collision output."""
+
+    bnd = IO.BoundaryData(bnd=IO.make_structured_boundary((3, 3), (0.5, 0.5)))
+    bnd.wear.material = Collision.MaterialTable({2: {'k': 2.0}})
+    system = System.System(bnd, coeff=1.0, temporal_cache=temp_cache())
+
+    pos = numpy.array((0.9995, 0.5, 0.0))
+    vel = numpy.array((1.0, 0.0, 0.0))
+
+    part = Particles.Particle((pos, vel), delta_t=0.001, parameters=PAR0,
+                              system=system)
+    part.update(method="ForwardEuler")
+
+    # the right hand wall has surface id 2
+    assert part.collisions[0].cell == 1
+    wear = 2.0*Collision.mclaury_mass_coeff(part.collisions[0])
+    assert abs(bnd.wear.total.sum() - wear) < 1.0e-12
+
+    outfile = tmpdir.join('collisions.vtp').strpath
+    IO.collision_list_to_polydata(part.collision_log, outfile, boundary=bnd)
+
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(outfile)
+    reader.Update()
+    out = reader.GetOutput().GetPointData().GetArray('Wear').GetValue(0)
+    assert abs(out - wear) < 1.0e-12
+
+    with pytest.raises(ValueError):
+        IO.collision_list_to_polydata(part.collision_log, outfile,
+                                      material=bnd.wear.material)
+
+def test_pack_particles():
+    """Test particle state survives packing for communication."""
+
+    par = Particles.Particle((numpy.array((0.25, 0.5, 0.)),
+                              numpy.array((1., 0., 0.)), 0.5, 0.1),
+                             parameters=PAR1)
+    par._old = [(numpy.ones(3), numpy.zeros(3), 0.4)]
+    par.fields['InsertionTime'] = 0.2
+    par.drag_impulse = numpy.array((1.0e-9, 0., -2.0e-9))
+
+    field_sizes = Particles.get_field_sizes([par])
+    fdata, idata = Particles.pack_particles([par], [PAR1], field_sizes)
+    out = Particles.unpack_particles(fdata, idata, None, [PAR1], field_sizes)[0]
+
+    assert hash(out) == hash(par)
+    assert all(out.pos == par.pos) and all(out.vel == par.vel)
+    assert out.time == par.time and out.delta_t == par.delta_t
+    assert all(out.get_old(0, 0) == numpy.ones(3))
+    assert out.get_old(0, 2) == 0.4
+    assert out.fields['InsertionTime'] == 0.2
+    assert all(out.drag_impulse == par.drag_impulse)
+    assert out.parameters is PAR1
+
+def test_checkpoint(tmpdir):
+    """Test restarting a bucket from a binary checkpoint."""
+
+    pos = numpy.array(((0.25, 0.5, 0.), (0.75, 0.5, 0.)))
+    vel = numpy.array(((1., 0., 0.), (0., 1., 0.)))
+
+    bucket = Particles.ParticleBucket(pos, vel, 0.5, 0.1, parameters=PAR1)
+    for k, par in enumerate(bucket):
+        par._old = [(numpy.ones(3), numpy.zeros(3), 0.4)]
+        par.fields['InsertionTime'] = 0.1*k
+        par.drag_impulse = numpy.full(3, 1.0e-9*k)
+    bucket.collision_log.append(Collision.CollisionInfo(pos[0], vel[0], 0.45, 3,
+                                                        0.5, numpy.array((0., 1., 0.))),
+                                hash(list(bucket)[0]), 'Sand')
+    numpy.random.seed(3)
+
+    filename = tmpdir.join('test.npz').strpath
+    bucket.write_checkpoint(filename)
+    expected = numpy.random.random()
+
+    numpy.random.seed(4)
+    out = Particles.read_checkpoint(filename, parameters=PAR1)
+
+    assert out.time == 0.5 and out.delta_t == 0.1
+    assert len(out) == 2
+    for par, new in zip(bucket, out):
+        assert hash(new) == hash(par)
+        assert all(new.pos == par.pos) and all(new.vel == par.vel)
+        assert all(new.get_old(0, 0) == numpy.ones(3))
+        assert new.fields['InsertionTime'] == par.fields['InsertionTime']
+        assert all(new.drag_impulse == par.drag_impulse)
+    assert len(out.collisions()) == 1
+    assert out.collisions().cell[0] == 3
+    assert list(out)[0].collisions[0].time == 0.45
+    assert numpy.random.random() == expected
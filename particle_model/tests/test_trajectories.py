@@ -0,0 +1,119 @@
+"""Unit tests for the trajectory store"""
+
+import numpy
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+from particle_model import IO
+from particle_model import Particles
+from particle_model import Trajectories
+
+def test_trajectory_store(tmpdir):
+    """ Test appending a bucket to a trajectory store and reading it back."""
+
+    pos = numpy.array(((0.1, 0.2, 0.0), (0.3, 0.4, 0.0)))
+    vel = numpy.zeros((2, 3))
+
+    bucket = Particles.ParticleBucket(pos, vel)
+    path = tmpdir.join('store').strpath
+
+    with Trajectories.TrajectoryWriter(path, chunk_size=3) as writer:
+        for level in range(4):
+            bucket.time = 0.5*level
+            writer.append(bucket)
+            for par in bucket:
+                par.pos = par.pos+1.0
+
+    reader = Trajectories.TrajectoryReader(path)
+
+    assert len(reader.chunks) == 2
+    assert len(reader) == 2
+
+    par = list(bucket)[1]
+    data = reader.get(hash(par))
+    assert all(data['Time'][:, 0] == (0.0, 0.5, 1.0, 1.5))
+    assert all(data['Position'][:, 1] == 0.4+numpy.arange(4))
+
+    poly_data = reader.to_polydata()
+    assert poly_data.GetNumberOfPoints() == 8
+    assert poly_data.GetNumberOfCells() == 2
+    assert poly_data.GetCell(0).GetNumberOfPoints() == 4
+
+def test_trajectory_store_empty_level(tmpdir):
+    """ Test appending an empty time level between two non-empty ones."""
+
+    path = tmpdir.join('store').strpath
+
+    with Trajectories.TrajectoryWriter(path) as writer:
+        for ids in ((1.0, 2.0), (), (1.0, 2.0)):
+            rows = len(ids)
+            writer.append_rows([('ParticleID', numpy.array(ids)),
+                                ('Time', numpy.full(rows, float(len(writer.buffer)))),
+                                ('Position', numpy.zeros((rows, 3))),
+                                ('Velocity', numpy.zeros((rows, 3)))])
+
+    reader = Trajectories.TrajectoryReader(path)
+
+    assert len(reader) == 2
+    assert all(reader.get(1.0)['Time'][:, 0] == (0.0, 1.0))
+
+def test_make_trajectories(tmpdir):
+    """ Test building trajectories from a series of dumps."""
+
+    pos = numpy.array(((0.1, 0.2, 0.0), (0.3, 0.4, 0.0), (0.5, 0.6, 0.0)))
+    vel = numpy.zeros((3, 3))
+
+    bucket = Particles.ParticleBucket(pos, vel)
+    basename = tmpdir.join('dump').strpath
+
+    for level in range(4):
+        bucket.time = 0.5*level
+        IO.write_level_to_polydata(bucket, level, basename)
+        for par in bucket:
+            par.pos = par.pos+1.0
+
+    for memory, processes in ((2**20, 1), (200, 2)):
+        outfile = tmpdir.join('trajectories_%d.vtp'%processes).strpath
+        Trajectories.make_trajectories(outfile, basename, memory=memory,
+                                       processes=processes)
+
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(outfile)
+        reader.Update()
+        poly_data = reader.GetOutput()
+
+        assert poly_data.GetNumberOfPoints() == 12
+        assert poly_data.GetNumberOfCells() == 3
+        time = vtk_to_numpy(poly_data.GetPointData().GetArray('Time'))
+        for k in range(3):
+            cell = poly_data.GetCell(k)
+            assert cell.GetNumberOfPoints() == 4
+            ids = [cell.GetPointId(_) for _ in range(4)]
+            assert list(time[ids]) == [0.0, 0.5, 1.0, 1.5]
+            assert numpy.allclose(numpy.diff([poly_data.GetPoint(_)[0] for _ in ids]), 1.0)
+
+def test_make_trajectories_empty_dump(tmpdir):
+    """ Test building trajectories when the first dump has no particles."""
+
+    basename = tmpdir.join('dump').strpath
+
+    bucket = Particles.ParticleBucket(numpy.zeros((0, 3)), numpy.zeros((0, 3)))
+    IO.write_level_to_polydata(bucket, 0, basename)
+
+    pos = numpy.array(((0.1, 0.2, 0.0), (0.3, 0.4, 0.0)))
+    bucket = Particles.ParticleBucket(pos, numpy.zeros((2, 3)))
+    for level in range(1, 3):
+        bucket.time = 0.5*level
+        IO.write_level_to_polydata(bucket, level, basename)
+
+    outfile = tmpdir.join('trajectories.vtp').strpath
+    Trajectories.make_trajectories(outfile, basename)
+
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(outfile)
+    reader.Update()
+    poly_data = reader.GetOutput()
+
+    assert poly_data.GetNumberOfPoints() == 4
+    assert poly_data.GetNumberOfCells() == 2
+    assert poly_data.GetPointData().HasArray('Particle Velocity')
@@ -14,11 +14,25 @@
 #include "vtkPointLocator.h"
 #include "vtkMath.h"
 #include "vtkDoubleArray.h"
+#include "vtkIdList.h"
 #include <iostream>
 #include <map>
 #include <set>
+#include <vector>
 #include <math.h> 
 
+#if VTK_MAJOR_VERSION >= 8
+// the static locator is thread safe to query once built
+#include "vtkStaticPointLocator.h"
+#include "vtkSMPTools.h"
+#include "vtkSMPThreadLocal.h"
+#include "vtkSMPThreadLocalObject.h"
+#define GT_USE_SMP
+typedef vtkStaticPointLocator vtkGranularTemperatureLocator;
+#else
+typedef vtkPointLocator vtkGranularTemperatureLocator;
+#endif
+
 #if VTK_MAJOR_VERSION <= 5
 vtkCxxRevisionMacro(vtkGranularTemperature, "$Revision: 0.0$");
 #endif
@@ -37,182 +51,234 @@ double radial_distribution(double volfrac){
 vtkGranularTemperature::vtkGranularTemperature(){
   this->SetNumberOfInputPorts(1);
   this->SetNumberOfOutputPorts(1);
+  this->Locator = NULL;
+  this->LocatorSize = 0;
+  this->LocatorTolerance = 0.1;
+};
+vtkGranularTemperature::~vtkGranularTemperature(){
+  if (this->Locator) {
+    this->Locator->Delete();
+  }
 };
-vtkGranularTemperature::~vtkGranularTemperature(){};
 
-int vtkGranularTemperature::RequestData(
-		      vtkInformation* vtkNotUsed(request),
-		      vtkInformationVector **inputVector,
-		      vtkInformationVector* outputVector )
-{
+namespace {
+
+  const double LENGTH = 0.03;
+  const double MODIFIER = 2.e3;
+  const double DIAMETER = 1e-3;
+  const double DENSITY = 2.5e3;
+
+  const char* OUTPUT_NAMES[5] = {"SolidVolumeFraction",
+				 "SolidVolumeVelocity",
+				 "GranularTemperature",
+				 "SolidPressure",
+				 "SolidPressureGradient"};
+  const int OUTPUT_COMPONENTS[5] = {1, 3, 1, 1, 3};
+
+  // Return a double array of the right shape in the point data,
+  // reusing one already there if possible.
+  vtkDoubleArray* GetOutputArray(vtkPointData* pd, const char* name,
+				 int components, vtkIdType n) {
+    vtkDoubleArray* array = vtkDoubleArray::SafeDownCast(pd->GetArray(name));
+    if (array && array->GetNumberOfComponents() == components
+	&& array->GetNumberOfTuples() == n) {
+      return array;
+    }
+    array = vtkDoubleArray::New();
+    array->SetName(name);
+    array->SetNumberOfComponents(components);
+    array->SetNumberOfTuples(n);
+    pd->AddArray(array);
+    array->Delete();
+    return array;
+  }
 
-#ifndef NDEBUG
-  this->DebugOn();
+  // Per particle gather over the neighbours inside LENGTH. Each particle
+  // only writes its own entries, so ranges can be run concurrently.
+  class GranularTemperatureFunctor
+  {
+  public:
+    vtkAbstractPointLocator* Locator;
+    vtkPoints* Points;
+    vtkDataArray* Velocity;
+    double* Volume;
+    double* SolidVelocity;
+    double* Temperature;
+    double* Pressure;
+    double* GradPres;
+#ifdef GT_USE_SMP
+    vtkSMPThreadLocalObject<vtkIdList> PointList;
+    vtkSMPThreadLocal<std::vector<double> > Weights;
 #endif
-  // output0 will be a copy of the high dimensional cells and 
-  // output1 will be the rest
-  vtkInformation* outInfo=outputVector->GetInformationObject(0);
-  vtkPolyData* output= vtkPolyData::SafeDownCast(outInfo->Get(vtkDataObject::DATA_OBJECT() ) );
-
-  vtkInformation *inInfo=inputVector[0]->GetInformationObject(0);
-  vtkPolyData* input= vtkPolyData::GetData(inputVector[0]);
 
-  vtkDebugMacro(<<"In Granular temperature code");
-
-  // first copy the input
+    void Initialize() {}
 
-  output->CopyStructure(input);
-  output->SetPoints(input->GetPoints());
-  output->DeepCopy(input);
+    void operator()(vtkIdType begin, vtkIdType end) {
+#ifdef GT_USE_SMP
+      vtkIdList* point_list = this->PointList.Local();
+      std::vector<double>& gamma = this->Weights.Local();
+#else
+      vtkSmartPointer<vtkIdList> point_list = vtkSmartPointer<vtkIdList>::New();
+      std::vector<double> gamma;
+#endif
+      double scale = 1.0/6.0*vtkMath::Pi()*pow(DIAMETER,3)*MODIFIER / (0.5 * LENGTH * LENGTH*(1.0-exp(-1.0)));
+      double x[3], y[3], v[3];
+
+      for (vtkIdType i=begin;i<end;i++) {
+	this->Points->GetPoint(i, x);
+	this->Locator->FindPointsWithinRadius(LENGTH, x, point_list);
+
+	vtkIdType n = point_list->GetNumberOfIds();
+	gamma.resize(n);
+
+	double volume = 0.0;
+	double vel[3] = {0,0,0};
+	double temperature = 0.0;
+	double grad_pres[3] = {0,0,0};
+
+	// solid volume fraction and solid velocity
+	for (vtkIdType j=0;j<n;j++) {
+	  vtkIdType id = point_list->GetId(j);
+	  this->Points->GetPoint(id, y);
+	  gamma[j] = scale*exp(-vtkMath::Distance2BetweenPoints(x, y) / LENGTH);
+	  volume += gamma[j];
+	  this->Velocity->GetTuple(id, v);
+	  for (int k=0;k<3;k++) {
+	    vel[k] += gamma[j]*v[k];
+	  }
+	}
+	vtkMath::MultiplyScalar(vel, 1.0/volume);
+
+	double rdf = radial_distribution(volume);
+
+	// granular temperature and the solid pressure gradient
+	for (vtkIdType j=0;j<n;j++) {
+	  vtkIdType id = point_list->GetId(j);
+	  this->Velocity->GetTuple(id, v);
+	  temperature += vtkMath::Distance2BetweenPoints(vel, v)*gamma[j];
+	  this->Points->GetPoint(id, y);
+	  for (int k=0;k<3;k++) {
+	    grad_pres[k] += (x[k]-y[k])*DENSITY*rdf*gamma[j];
+	  }
+	}
+	temperature = temperature/volume;
+
+	this->Volume[i] = volume;
+	this->Temperature[i] = temperature;
+	this->Pressure[i] = DENSITY*volume*rdf*temperature;
+	for (int k=0;k<3;k++) {
+	  this->SolidVelocity[3*i+k] = vel[k];
+	  this->GradPres[3*i+k] = grad_pres[k];
+	}
+      }
+    }
 
-  vtkDebugMacro(<<"Data copied");
+    void Reduce() {}
+  };
+}
 
-  vtkDebugMacro(<< output->GetNumberOfPoints());
+void vtkGranularTemperature::UpdateLocator(vtkPolyData* data)
+{
+  vtkIdType n = data->GetNumberOfPoints();
+  vtkGranularTemperatureLocator* locator =
+    vtkGranularTemperatureLocator::SafeDownCast(this->Locator);
+
+  if (locator && fabs(double(n - this->LocatorSize))
+      <= this->LocatorTolerance*this->LocatorSize) {
+    // keep the bin layout from the last full build
+    locator->AutomaticOff();
+  } else {
+    if (this->Locator) {
+      this->Locator->Delete();
+    }
+    locator = vtkGranularTemperatureLocator::New();
+    locator->AutomaticOn();
+    this->Locator = locator;
+    this->LocatorSize = n;
+    vtkDebugMacro(<<"New locator");
+  }
 
-  vtkPointLocator* locator = vtkPointLocator::New();
-  locator->SetDataSet(input);
+  // the particles will have moved, so the bins are always refilled
+  locator->SetDataSet(data);
+  locator->Modified();
   locator->BuildLocator();
+}
 
-  vtkDebugMacro(<<"Locator built");
-
-  double LENGTH = 0.03;
-  double MODIFIER = 2.e3;
-
-  vtkDoubleArray* volume = vtkDoubleArray::New();
-  vtkDoubleArray* velocity = vtkDoubleArray::New();
-  vtkDoubleArray* temperature = vtkDoubleArray::New();
-  vtkDoubleArray* pressure = vtkDoubleArray::New();
-  vtkDoubleArray* grad_pres = vtkDoubleArray::New();
-
-  volume->SetName("SolidVolumeFraction");
-  volume->Allocate(output->GetNumberOfPoints());
-  volume->SetNumberOfComponents(1);
-  volume->SetNumberOfTuples(output->GetNumberOfPoints());
-
-  velocity->SetName("SolidVolumeVelocity");
-  velocity->Allocate(3*output->GetNumberOfPoints());
-  velocity->SetNumberOfComponents(3);
-  velocity->SetNumberOfTuples(output->GetNumberOfPoints());
-
-  temperature->SetName("GranularTemperature");
-  temperature->Allocate(output->GetNumberOfPoints());
-  temperature->SetNumberOfComponents(1);
-  temperature->SetNumberOfTuples(output->GetNumberOfPoints());
-
-  pressure->SetName("SolidPressure");
-  pressure->Allocate(output->GetNumberOfPoints());
-  pressure->SetNumberOfComponents(1);
-  pressure->SetNumberOfTuples(output->GetNumberOfPoints());
-
-  grad_pres->SetName("SolidPressureGradient");
-  grad_pres->Allocate(3*output->GetNumberOfPoints());
-  grad_pres->SetNumberOfComponents(3);
-  grad_pres->SetNumberOfTuples(output->GetNumberOfPoints());
-
-  vtkDebugMacro(<< velocity->GetNumberOfTuples());
-
-  vtkDebugMacro(<<"Entering main loop");
-
-  for (vtkIdType i=0;i<output->GetNumberOfCells();i++) {
-    vtkCell* cell=output->GetCell(i);
-    vtkIdList* point_list = vtkIdList::New();
-
-    double diameter=1e-3;
-    double density=2.5e3;
-
-    locator->FindPointsWithinRadius(LENGTH,
-				    cell->GetPoints()->GetPoint(0),
-				    point_list);
-
-    volume->SetValue(i,0.0);
-    velocity->SetTuple3(i,0.0,0.0,0.0);
-    grad_pres->SetTuple3(i,0.0,0.0,0.0);
-    temperature->SetValue(i,0.0);
-    pressure->SetValue(i,0.0);
-    
-
-
-    for (vtkIdType j=0;j<point_list->GetNumberOfIds();j++) {
-
-      double rad2=vtkMath::Distance2BetweenPoints(output->GetPoints()->GetPoint(point_list->GetId(j)),
-						  output->GetPoints()->GetPoint(i));
-
-      rad2 = rad2 / LENGTH;
-
-      double gamma = 1.0/6.0*vtkMath::Pi()*pow(diameter,3)*exp(-rad2)*MODIFIER / (0.5 * LENGTH * LENGTH*(1.0-exp(-1.0)));   
-
-      // calculate the solid volume fraction:
-
-      volume->SetValue(i, volume->GetValue(i) + gamma );  
-
-      double lvel[3]={0,0,0};
+void vtkGranularTemperature::Compute(vtkPolyData* data)
+{
+  vtkIdType n = data->GetNumberOfPoints();
+  vtkPointData* pd = data->GetPointData();
 
-      vtkMath::Add(output->GetPointData()->GetVectors("Particle Velocity")->GetTuple(point_list->GetId(j)),lvel,lvel);
-      vtkMath::MultiplyScalar(lvel,gamma);
-      vtkMath::Add(velocity->GetTuple3(i),lvel,lvel);
+  vtkDoubleArray* outputs[5];
+  for (int k=0;k<5;k++) {
+    outputs[k] = GetOutputArray(pd, OUTPUT_NAMES[k], OUTPUT_COMPONENTS[k], n);
+  }
 
+  if (n == 0) {
+    return;
+  }
 
-    // calculate solid velocity:
-	velocity->SetTuple3(i, lvel[0], lvel[1],lvel[2] ); 
-	
+  vtkDataArray* velocity = pd->GetArray("Particle Velocity");
+  if (!velocity) {
+    vtkErrorMacro(<<"No Particle Velocity array");
+    return;
   }
-    double vel[3]={0,0,0};
-    vtkMath::Add(velocity->GetTuple3(i),vel,vel);
-    vtkMath::MultiplyScalar(vel,1.0/volume->GetValue(i));
-    velocity->SetTuple3(i, vel[0], vel[1],vel[2] );
 
+  this->UpdateLocator(data);
 
-      
-    for (vtkIdType j=0;j<point_list->GetNumberOfIds();j++) {
-      	
-      double rad2=vtkMath::Distance2BetweenPoints(output->GetPoints()->GetPoint(point_list->GetId(j)),
-						  output->GetPoints()->GetPoint(i));
+  vtkDebugMacro(<<"Locator built");
 
-      rad2 = rad2 / LENGTH;
+  GranularTemperatureFunctor functor;
+  functor.Locator = this->Locator;
+  functor.Points = data->GetPoints();
+  functor.Velocity = velocity;
+  functor.Volume = outputs[0]->GetPointer(0);
+  functor.SolidVelocity = outputs[1]->GetPointer(0);
+  functor.Temperature = outputs[2]->GetPointer(0);
+  functor.Pressure = outputs[3]->GetPointer(0);
+  functor.GradPres = outputs[4]->GetPointer(0);
+
+#ifdef GT_USE_SMP
+  vtkSMPTools::For(0, n, functor);
+#else
+  functor(0, n);
+#endif
 
-      double gamma = 1.0/6.0*vtkMath::Pi()*pow(diameter,3)*exp(-rad2)*MODIFIER / (0.5 * LENGTH * LENGTH*(1.0-exp(-1.0)));   
-      // Now form the granular temperature and its gradient:
-      temperature->SetValue(i,temperature->GetValue(i)+
-			      vtkMath::Distance2BetweenPoints(velocity->GetTuple3(i), output->GetPointData()->GetVectors("Particle Velocity")->GetTuple(point_list->GetId(j)))*gamma);							     	
-    }
+  for (int k=0;k<5;k++) {
+    outputs[k]->Modified();
+  }
 
-    for (vtkIdType j=0;j<point_list->GetNumberOfIds();j++) {
-      	
-      double rad2=vtkMath::Distance2BetweenPoints(output->GetPoints()->GetPoint(point_list->GetId(j)),
-						  output->GetPoints()->GetPoint(i));
+  vtkDebugMacro(<<"Main Loop done");
+}
 
-      rad2 = rad2 / LENGTH;
+int vtkGranularTemperature::RequestData(
+		      vtkInformation* vtkNotUsed(request),
+		      vtkInformationVector **inputVector,
+		      vtkInformationVector* outputVector )
+{
 
-      double gamma = 1.0/6.0*vtkMath::Pi()*pow(diameter,3)*exp(-rad2)*MODIFIER / (0.5 * LENGTH * LENGTH*(1.0-exp(-1.0))); 
+#ifndef NDEBUG
+  this->DebugOn();
+#endif
 
-      double lvel[3]={0,0,0};
+  vtkInformation* outInfo=outputVector->GetInformationObject(0);
+  vtkPolyData* output= vtkPolyData::SafeDownCast(outInfo->Get(vtkDataObject::DATA_OBJECT() ) );
 
-      vtkMath::Add(output->GetPoints()->GetPoint(point_list->GetId(j)),
-		        lvel, lvel);
-      vtkMath::Subtract(output->GetPoints()->GetPoint(i),
-		       lvel, lvel);
-      vtkMath::MultiplyScalar(lvel,density*radial_distribution(volume->GetValue(i))*gamma);
-      vtkMath::Add(grad_pres->GetTuple3(i),lvel,lvel);
-      // Now form the granular temperature and its gradient:
-      grad_pres->SetTuple3(i,lvel[0],lvel[1],lvel[2]);
-    }
+  vtkPolyData* input= vtkPolyData::GetData(inputVector[0]);
 
-    temperature->SetValue(i, temperature->GetValue(i)/volume->GetValue(i));
+  vtkDebugMacro(<<"In Granular temperature code");
 
-    pressure->SetValue(i,density*volume->GetValue(i)*radial_distribution(volume->GetValue(i))*temperature->GetValue(i));
+  // the output shares the input arrays, the averaged fields are
+  // always freshly allocated so the input is left untouched.
 
-   
-    point_list->Delete();
+  output->ShallowCopy(input);
+  for (int k=0;k<5;k++) {
+    output->GetPointData()->RemoveArray(OUTPUT_NAMES[k]);
   }
 
-  vtkDebugMacro(<<"Main Loop done");   
-  
-  output->GetPointData()->AddArray(volume);
-  output->GetPointData()->AddArray(velocity);
-  output->GetPointData()->AddArray(temperature);
-  output->GetPointData()->AddArray(pressure);
-  output->GetPointData()->AddArray(grad_pres);
-  locator->Delete();
+  vtkDebugMacro(<< output->GetNumberOfPoints());
+
+  this->Compute(output);
 
   return 1;
   }
@@ -1,4 +1,7 @@
 #include "vtkPolyDataAlgorithm.h"
+#include "vtkSetGet.h"
+
+class vtkAbstractPointLocator;
 
 class vtkGranularTemperature : public vtkPolyDataAlgorithm
 {
@@ -10,11 +13,27 @@ public:
   vtkTypeMacro(vtkGranularTemperature,vtkPolyDataAlgorithm);
 #endif
 
+  // Relative change in the number of particles below which the point
+  // locator (and its bin layout) is kept from the previous call.
+  vtkSetMacro(LocatorTolerance, double);
+  vtkGetMacro(LocatorTolerance, double);
+
+  // Calculate the averaged fields in place, writing into the point data
+  // of data. Arrays already present with the right name and shape are
+  // reused, otherwise they are allocated and added.
+  void Compute(vtkPolyData* data);
+
  protected:
 
   vtkGranularTemperature();
   ~vtkGranularTemperature();
 
+  double LocatorTolerance;
+  vtkAbstractPointLocator* Locator;
+  vtkIdType LocatorSize;
+
+  void UpdateLocator(vtkPolyData* data);
+
   virtual int RequestData(
 			  vtkInformation* request,
 			  vtkInformationVector** InputVector,